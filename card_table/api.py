@@ -1,44 +1,319 @@
+import contextlib
+import copy
+import heapq
+import itertools
 import json
+import logging
+import time
 
 import falcon
+import sqlalchemy.exc
+import sqlalchemy.orm.exc
+from sqlalchemy.orm import Query
 
+from falcon_autocrud.db_session import session_scope
 from falcon_autocrud.resource import CollectionResource, SingleResource
 
-from card_table import commands
-from card_table.common import ensure_modifiable, require_record
-from card_table.storage import db_verifier, Game, Stack, Card, Command
-
-
-def create_api(middleware, db_engine):
+from card_table import commands, events, health, queries, replay, shards
+from card_table.common import (ensure_modifiable, require_param,
+                               require_record, version_conflict)
+from card_table.storage import Game, Stack, Card, Command
+
+LOG = logging.getLogger(__name__)
+
+
+def create_api(middleware, db_engine, health_settings=None,
+               read_engine=None, allow_seeds=False):
+    """ The application
+
+    Every GET, and the health checks, read with the reader engines, and
+    everything else with the writers.
+
+    :param db_engine: the engine of the database, or a shards.ShardRouter
+        over the engines of several, each with its reader
+    :param health_settings: dict of keyword arguments of
+        health.HealthMonitor
+    :param read_engine: the engine to read the database of db_engine with,
+        such as a read only pool, by default db_engine itself
+    :param allow_seeds: whether commands may name the seeds of their
+        shuffles, for tests and administrators, see commands.execute
+    """
+    router = db_engine
+    if not isinstance(router, shards.ShardRouter):
+        router = shards.ShardRouter([db_engine],
+                                    [read_engine] if read_engine else None)
+    elif read_engine is not None:
+        raise ValueError('The readers of shards are given to the router')
     app = falcon.API(middleware=middleware)
-    app.add_route('/health', HealthResource(db_engine))
-    app.add_route('/games', GameCollectionResource(db_engine))
-    app.add_route('/games/{id}', GameResource(db_engine))
-    app.add_route('/stacks', StackCollectionResource(db_engine))
-    app.add_route('/stacks/{id}', StackResource(db_engine))
-    app.add_route('/cards', CardCollectionResource(db_engine))
-    app.add_route('/cards/{id}', CardResource(db_engine))
-    app.add_route('/commands', CommandCollectionResource(db_engine))
-    app.add_route('/commands/{id}', CommandResource(db_engine))
+    app.add_error_handler(sqlalchemy.orm.exc.StaleDataError, stale_data)
+    reader = router.readers[0]
+    monitor = health.HealthMonitor(reader, **(health_settings or {}))
+    app.add_route('/health', HealthResource(reader, monitor))
+    app.add_route('/health/live', LivenessResource())
+    app.add_route('/health/ready', ReadinessResource(reader, monitor))
+    app.add_route('/games', GameCollectionResource(router))
+    app.add_route('/games/{id}', GameResource(router))
+    app.add_route('/games/{id}/state', GameStateResource(router))
+    app.add_route('/games/{id}/view', GameViewResource(router))
+    app.add_route('/games/{id}/replay', GameReplayResource(router))
+    app.add_route('/games/{id}/events', GameEventsResource(router))
+    app.add_route('/stacks', StackCollectionResource(router))
+    app.add_route('/stacks/{id}', StackResource(router))
+    app.add_route('/cards', CardCollectionResource(router))
+    app.add_route('/cards/{id}', CardResource(router))
+    app.add_route('/commands', CommandCollectionResource(
+        router, allow_seeds=allow_seeds))
+    app.add_route('/commands/batch', CommandBatchResource(
+        router, allow_seeds=allow_seeds))
+    app.add_route('/commands/{id}', CommandResource(router))
     return app
 
 
+def stale_data(ex, req, resp, params):
+    """ Refuse a write through the ORM which lost a race, see
+    storage.Card.version """
+    raise version_conflict()
+
+
 class HealthResource(object):
+    """ Whether the database is available, as of the latest probe
+
+    Answered from the verdict kept by a health.HealthMonitor, so a probe
+    costs no query. Its details give the latency of the probe and how busy
+    the connection pool was.
+    """
 
     error_txt = 'Service failed health check'
-    ok_txt = json.dumps({'title': '200 OK',
-                         'description': 'Service passed health check'})
+    ok_txt = 'Service passed health check'
 
-    def __init__(self, db_engine):
-        self.is_db_available = db_verifier(db_engine)
+    def __init__(self, db_engine, monitor=None):
+        self.monitor = monitor or health.HealthMonitor(db_engine)
 
     def on_get(self, req, resp):
-        if self.is_db_available():
-            resp.status = falcon.HTTP_200
-            resp.body = self.ok_txt
-        else:
+        verdict = self.monitor.current()
+        if not verdict.available:
             raise falcon.HTTPServiceUnavailable(description=self.error_txt,
                                                 retry_after=60)
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps({'title': falcon.HTTP_200,
+                                'description': self.ok_txt,
+                                'details': self.monitor.details(verdict)})
+
+
+class LivenessResource(object):
+    """ Whether the process is serving requests at all
+
+    Never consults the database, so a slow or failing database does not get
+    a worker restarted.
+    """
+
+    ok_txt = json.dumps({'title': falcon.HTTP_200,
+                         'description': 'Service is alive'})
+
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_200
+        resp.body = self.ok_txt
+
+
+class ReadinessResource(HealthResource):
+    """ Whether the service should be sent requests
+
+    Beyond the database being available, its latest probe must be recent,
+    fast enough and have found connections to spare in the pool, see
+    health.HealthMonitor.ready.
+    """
+
+    ok_txt = 'Service is ready'
+
+    def on_get(self, req, resp):
+        verdict = self.monitor.current()
+        reason = self.monitor.ready(verdict)
+        if reason is not None:
+            raise falcon.HTTPServiceUnavailable(
+                description=reason, retry_after=max(1, int(self.monitor.ttl)))
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps({'title': falcon.HTTP_200,
+                                'description': self.ok_txt,
+                                'details': self.monitor.details(verdict)})
+
+
+class GameStateResource(object):
+    """ The whole state of a game in one response
+
+    Takes an optional since parameter, the id of the last command of the
+    game a client has seen, to get only the game, stacks and cards changed
+    after it. When since is unknown or too far behind, the whole state is
+    returned instead, and meta.full is true. Either way, meta.command_id is
+    the since to use next.
+    """
+
+    def __init__(self, router):
+        self.router = router
+
+    def on_get(self, req, resp, id):
+        since = req.get_param_as_int('since', min=0)
+        with self.router.reader_for(id).connect() as conn:
+            changes = None
+            if since is not None:
+                changes = queries.game_changes(conn, id, since)
+            if changes is not None:
+                meta = {'full': False, 'command_id': changes['command_id']}
+                state = changes
+            else:
+                # read first, a command committed meanwhile is then sent
+                # again, rather than never
+                command_id = queries.latest_command_id(conn, id)
+                state = queries.game_state(conn, id)
+                meta = {'full': True, 'command_id': command_id}
+        if state is None:
+            raise falcon.HTTPNotFound()
+
+        resp.status = falcon.HTTP_200
+        req.context['result'] = {'data': state, 'meta': meta}
+
+
+class GameViewResource(object):
+    """ A game as one player may see it, see queries.player_view
+
+    Takes a required player parameter, the owner_id of the player.
+    """
+
+    def __init__(self, router):
+        self.router = router
+
+    def on_get(self, req, resp, id):
+        player = req.get_param_as_int('player', required=True, min=1)
+        with self.router.reader_for(id).connect() as conn:
+            view = queries.player_view(conn, id, player)
+        if view is None:
+            raise falcon.HTTPNotFound()
+
+        resp.status = falcon.HTTP_200
+        req.context['result'] = {'data': view}
+
+
+class GameReplayResource(object):
+    """ The state of a game as of any of its commands, rebuilt from the log
+
+    Takes an optional command_id parameter, defaulting to the latest. The
+    replay starts from the snapshots taken as commands are written, see
+    take_snapshots. A log holding a command which cannot be replayed, see
+    replay.TableState.apply, is answered 422.
+    """
+
+    def __init__(self, router):
+        self.router = router
+
+    def on_get(self, req, resp, id):
+        command_id = req.get_param_as_int('command_id', min=1)
+        with session_scope(self.router.reader_for(id)) as db_session:
+            if not Game.get(id, db_session):
+                raise falcon.HTTPNotFound()
+            try:
+                state = replay.state_as_of(db_session, id, command_id)
+            except ValueError as error:
+                raise falcon.HTTPUnprocessableEntity(
+                    'Unable to replay', str(error))
+
+        resp.status = falcon.HTTP_200
+        req.context['result'] = {'data': state.as_dict()}
+
+
+class GameEventsResource(object):
+    """ Feed of the commands of a game, as they are committed
+
+    With an Accept header of text/event-stream, the commands are pushed as
+    server-sent events, with a keepalive comment each heartbeat, until the
+    stream times out and the client reconnects. Otherwise the request is
+    answered at once, or, with the optional wait parameter, is a long poll
+    answered as soon as there are commands to return, or after that many
+    seconds.
+
+    A waiting request holds a worker thread, so the service must be run with
+    threaded workers, and stream_timeout is kept below gunicorn's default
+    worker timeout of 30 seconds.
+
+    Either way, the feed resumes after the command id in the Last-Event-ID
+    header, or the after parameter, and otherwise starts with the next
+    command committed.
+    """
+
+    EVENT_STREAM = 'text/event-stream'
+
+    heartbeat = 10
+    stream_timeout = 25
+    long_poll_timeout = 25
+    """ milliseconds a client should wait before reconnecting """
+    retry = 1000
+    page_size = 100
+
+    def __init__(self, router, notifier=events.NOTIFIER):
+        self.router = router
+        self.notifier = notifier
+        notifier.listen()
+
+    def on_get(self, req, resp, id):
+        with self.router.reader_for(id).connect() as conn:
+            if queries.validators(conn, Game, id) is None:
+                raise falcon.HTTPNotFound()
+            game_id = int(id)
+            after = self.cursor(req)
+            if after is None:
+                after = queries.latest_command_id(conn, game_id)
+
+        resp.status = falcon.HTTP_200
+        if self.EVENT_STREAM in (req.accept or ''):
+            resp.content_type = self.EVENT_STREAM
+            resp.set_header('Cache-Control', 'no-cache')
+            resp.stream = self.stream(game_id, after)
+            return
+
+        wait = req.get_param_as_int('wait', min=0,
+                                    max=self.long_poll_timeout) or 0
+        found = self.poll(game_id, after, wait)
+        if found:
+            after = found[-1]['id']
+        req.context['result'] = {'data': found,
+                                 'meta': {'last_event_id': after}}
+
+    @staticmethod
+    def cursor(req):
+        last_event_id = req.get_header('Last-Event-ID')
+        if last_event_id is None:
+            return req.get_param_as_int('after', min=0)
+        try:
+            return int(last_event_id)
+        except ValueError:
+            raise falcon.HTTPInvalidHeader('Expected a command id',
+                                           'Last-Event-ID')
+
+    def poll(self, game_id, after, timeout):
+        """ Commands after the cursor, waiting up to timeout for any """
+        found = self.fetch(game_id, after)
+        if not found and timeout:
+            self.notifier.wait(game_id, after, timeout)
+            found = self.fetch(game_id, after)
+        return found
+
+    def fetch(self, game_id, after):
+        with self.router.reader_for(game_id).connect() as conn:
+            return events.command_events(conn, game_id, after,
+                                         self.page_size)
+
+    def stream(self, game_id, after):
+        deadline = time.monotonic() + self.stream_timeout
+        yield 'retry: {}\n\n'.format(self.retry).encode()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            found = self.poll(game_id, after, min(self.heartbeat, remaining))
+            if not found:
+                yield b': keepalive\n\n'
+            for item in found:
+                after = item['id']
+                yield 'id: {}\nevent: command\ndata: {}\n\n'.format(
+                    after, json.dumps(item)).encode()
 
 
 class ResourceHelper(object):
@@ -75,6 +350,27 @@ class ResourceHelper(object):
             pass
 
 
+class Routed(object):
+    """ An autocrud resource over the shards of a router, see
+    shards.ShardRouter
+
+    GETs are answered by a copy of the resource whose sessions read with
+    the readers of the router.
+    """
+
+    def __init__(self, router, **kwargs):
+        super(Routed, self).__init__(router.engines[0],
+                                     sessionmaker_=router.sessionmaker,
+                                     **kwargs)
+        self.router = router
+        self.reading = copy.copy(self)
+        self.reading.db_engine = router.readers[0]
+        self.reading.sessionmaker = router.reader_sessionmaker
+
+    def on_get(self, req, resp, *args, **kwargs):
+        return super(Routed, self.reading).on_get(req, resp, *args, **kwargs)
+
+
 class Protected(object):
 
     IMMUTABLE_PROPERTY = 'This property is not modifiable.'
@@ -89,11 +385,26 @@ class Protected(object):
                           allow_immutables=True)
 
 
-class RestCollectionResource(CollectionResource, Protected, ResourceHelper):
-    pass
+class RestCollectionResource(Routed, CollectionResource, Protected,
+                             ResourceHelper):
+
+    def filter_by_params(self, resources, params):
+        """ Refuse to filter or sort by secret properties """
+        secret_properties = getattr(self.model, 'secret_properties', list)
+        secrets = [p.key for p in secret_properties()]
+        sort = params.get('__sort', [])
+        if not isinstance(sort, list):
+            sort = [sort]
+        for key in list(params.keys()) + [f.lstrip('-') for f in sort]:
+            if key.split('__')[0] in secrets:
+                raise falcon.HTTPInvalidParam(msg='Not a filterable property',
+                                              param_name=key)
 
+        return super(RestCollectionResource, self).filter_by_params(
+            resources, params)
 
-class RestResource(SingleResource, Protected, ResourceHelper):
+
+class RestResource(Routed, SingleResource, Protected, ResourceHelper):
 
     @staticmethod
     def after_delete(req, resp, item, *args, **kwargs):
@@ -102,14 +413,304 @@ class RestResource(SingleResource, Protected, ResourceHelper):
         req.context['result'] = None
 
 
-class CommandCollectionResource(RestCollectionResource):
+class ConditionalGet(object):
+    """ ETag and Last-Modified validators for single resources
+
+    The ETag is derived from the version of the record, and Last-Modified
+    from updated_at. A GET with If-None-Match, or else If-Modified-Since,
+    is answered 304 Not Modified from a lookup of those two columns alone
+    when the client's copy is still current, without loading and
+    serializing the record.
+
+    A PATCH with If-Match is refused with 409 Conflict, as autocrud refuses
+    a failed patch_precondition, unless the record is still at the version
+    of one of the tags. Either way the version is checked again as the
+    change is written.
+    """
+
+    def on_get(self, req, resp, *args, **kwargs):
+        if req.if_none_match or req.if_modified_since:
+            db_engine = self.router.reader_for(kwargs['id'])
+            with db_engine.connect() as conn:
+                current = queries.validators(conn, self.model, kwargs['id'])
+            if current and self.not_modified(req, kwargs['id'], *current):
+                self.set_validators(resp, kwargs['id'], *current)
+                resp.status = falcon.HTTP_NOT_MODIFIED
+                return
+
+        return super(ConditionalGet, self).on_get(req, resp, *args, **kwargs)
+
+    def after_get(self, req, resp, item, *args, **kwargs):
+        super(ConditionalGet, self).after_get(req, resp, item, *args,
+                                              **kwargs)
+        self.set_validators(resp, item.id, item.version, item.updated_at)
+
+    def patch_precondition(self, req, resp, query, *args, **kwargs):
+        query = super(ConditionalGet, self).patch_precondition(
+            req, resp, query, *args, **kwargs)
+        if not req.if_match:
+            return query
+        tags = self.parse_tags(req.if_match)
+        if '*' in tags:
+            return query
+        # strong comparison, as for any If-Match
+        versions = [version for tag in tags
+                    for record_id, version in [self.parse_etag(tag)]
+                    if record_id == int(kwargs['id'])]
+        return query.filter(self.model.version.in_(versions))
+
+    def after_patch(self, req, resp, item, *args, **kwargs):
+        super(ConditionalGet, self).after_patch(req, resp, item, *args,
+                                                **kwargs)
+        self.set_validators(resp, item.id, item.version, item.updated_at)
+
+    def not_modified(self, req, record_id, version, updated_at):
+        if req.if_none_match:
+            etag = self.etag(record_id, version)
+            tags = self.parse_tags(req.if_none_match)
+            # weak comparison, as for any If-None-Match
+            return '*' in tags or etag in [t.replace('W/', '', 1)
+                                           for t in tags]
+        # HTTP dates have a resolution of one second
+        return updated_at.replace(microsecond=0) <= req.if_modified_since
+
+    def set_validators(self, resp, record_id, version, updated_at):
+        resp.etag = self.etag(record_id, version)
+        resp.last_modified = updated_at
+
+    @staticmethod
+    def etag(record_id, version):
+        """ A strong entity tag for a record at a version """
+        return '"{:x}-{:x}"'.format(int(record_id), version)
+
+    @staticmethod
+    def parse_etag(tag):
+        """ The (record id, version) of a strong entity tag, or (None, None)
+        """
+        try:
+            record_id, version = tag.strip('"').split('-')
+            return int(record_id, 16), int(version, 16)
+        except ValueError:
+            return None, None
+
+    @staticmethod
+    def parse_tags(header):
+        return [tag.strip() for tag in header.split(',')]
+
+
+class KeysetPagination(object):
+    """ Keyset pagination and NDJSON streaming for collection resources
+
+    Either of the parameters __after (a cursor from the next link of a
+    previous page) or __page_size selects a page, ordered by updated_at and
+    then id. The parameter __stream=ndjson, or an Accept header of
+    application/x-ndjson, streams the whole collection as one JSON document
+    per line, read from the database as it is sent. Filters apply as usual,
+    __sort, __offset and __limit do not.
+
+    With several shards, each shard the filters may find rows in is read
+    in the same order, and their rows merged.
+    """
+
+    AFTER = '__after'
+    PAGE_SIZE = '__page_size'
+    STREAM = '__stream'
+    NDJSON = 'application/x-ndjson'
+
+    default_page_size = 100
+    max_page_size = 1000
+
+    def on_get(self, req, resp, *args, **kwargs):
+        streaming = (req.get_param(self.STREAM) == 'ndjson' or
+                     (req.accept == self.NDJSON))
+        if not (streaming or self.AFTER in req.params or
+                self.PAGE_SIZE in req.params):
+            return super(KeysetPagination, self).on_get(
+                req, resp, *args, **kwargs)
+
+        # only the statement is used, executed on a connection of its own
+        query = self.filter_by_params(Query(self.model), req.params)
+        after = req.get_param(self.AFTER)
+        if after:
+            try:
+                query = query.filter(queries.after_cursor(self.model, after))
+            except ValueError:
+                raise falcon.HTTPInvalidParam(msg='Invalid cursor',
+                                              param_name=self.AFTER)
+        query = query.order_by(*queries.keyset_order(self.model))
+        engines = [self.router.readers[shard_id] for shard_id in
+                   self.router.shards_for_query(query)]
+
+        if streaming:
+            resp.status = falcon.HTTP_200
+            resp.content_type = self.NDJSON
+            resp.stream = self.stream(engines, query.statement)
+            return
+
+        page_size = req.get_param_as_int(
+            self.PAGE_SIZE, min=1,
+            max=self.max_page_size) or self.default_page_size
+        statement = query.limit(page_size + 1).statement
+        pages = []
+        for db_engine in engines:
+            with db_engine.connect() as conn:
+                pages.append([self.serialize_row(row)
+                              for row in conn.execute(statement)])
+        page = list(itertools.islice(heapq.merge(*pages, key=self.keyset),
+                                     page_size + 1))
+
+        next_cursor = None
+        if len(page) > page_size:
+            page.pop()
+            last = page[-1]
+            next_cursor = queries.encode_cursor(last['_updated_at'],
+                                                last['id'])
+        for item in page:
+            item.pop('_updated_at')
+
+        resp.status = falcon.HTTP_200
+        req.context['result'] = {'data': page,
+                                 'meta': {'next': next_cursor}}
+
+    def stream(self, engines, statement):
+        with contextlib.ExitStack() as connections:
+            streams = []
+            for db_engine in engines:
+                conn = connections.enter_context(db_engine.connect())
+                rows = conn.execution_options(stream_results=True).execute(
+                    statement)
+                streams.append(self.serialize_row(row) for row in rows)
+            for item in heapq.merge(*streams, key=self.keyset):
+                item.pop('_updated_at')
+                yield (json.dumps(item) + '\n').encode()
+
+    def serialize_row(self, row):
+        table = self.model.__table__
+        item = queries.serialize(self.model, table, row)
+        item['_updated_at'] = row[table.c.updated_at]
+        return item
+
+    @staticmethod
+    def keyset(item):
+        return item['_updated_at'], item['id']
+
+
+def take_snapshots(router, game_ids):
+    """ Snapshot the games which are due one, once their commands are
+    committed, see replay.take_snapshot_if_due
+
+    A game whose log cannot be replayed is logged and left without.
+    """
+    for game_id in sorted(set(game_ids)):
+        with session_scope(router.engine_for(game_id)) as db_session:
+            try:
+                if replay.take_snapshot_if_due(db_session, game_id):
+                    db_session.commit()
+            except ValueError as error:
+                LOG.warning('Unable to snapshot game %s: %s', game_id, error)
+
+
+class CommandCollectionResource(KeysetPagination, RestCollectionResource):
     model = Command
 
+    def __init__(self, router, allow_seeds=False):
+        super(CommandCollectionResource, self).__init__(router)
+        self.allow_seeds = allow_seeds
+
     def before_post(self, req, resp, db_session, resource, *args, **kwargs):
         super(CommandCollectionResource, self).before_post(
             req, resp, db_session, resource, *args, **kwargs)
 
-        commands.execute(db_session, resource)
+        # all of the statements of a command are of its game
+        self.router.pin(db_session, self.router.shard_of(resource.game_id))
+        commands.load_changes(resource)
+        commands.execute(db_session, resource, self.allow_seeds)
+
+    def on_post(self, req, resp, *args, **kwargs):
+        super(CommandCollectionResource, self).on_post(req, resp, *args,
+                                                       **kwargs)
+        # once the session of the command is closed
+        take_snapshots(self.router, [req.context['result']['data']['game_id']])
+
+
+class CommandBatchResource(object):
+    """ Execute an ordered list of commands in one transaction
+
+    Each command runs within a SAVEPOINT of its own. A command which fails
+    is rolled back alone, and the commands after it still run. The response
+    holds one result per command, in order.
+
+    With several shards, the commands of the games of each shard are
+    committed in a transaction of that shard. The games are then snapshot,
+    if due, see take_snapshots.
+    """
+
+    CONFLICT = 'Conflict'
+    UNIQUE_VIOLATED = 'Unique constraint violated'
+
+    def __init__(self, router, allow_seeds=False):
+        self.router = router
+        self.allow_seeds = allow_seeds
+
+    def on_post(self, req, resp):
+        batch = require_param('commands', req.context.get('doc') or {})
+        if not isinstance(batch, list):
+            raise falcon.HTTPInvalidParam(msg='Expected a list',
+                                          param_name='commands')
+
+        with contextlib.ExitStack() as scopes:
+            sessions = {}
+            results = []
+            played = []
+            for doc in batch:
+                game_id = doc.get('game_id') if isinstance(doc, dict) else None
+                db_engine = self.router.engine_for(game_id)
+                if db_engine not in sessions:
+                    sessions[db_engine] = scopes.enter_context(
+                        session_scope(db_engine))
+                results.append(self.execute(sessions[db_engine], doc))
+                if results[-1]['status'] == falcon.HTTP_CREATED:
+                    played.append(results[-1]['data']['game_id'])
+            for db_session in sessions.values():
+                db_session.commit()
+        take_snapshots(self.router, played)
+
+        resp.status = falcon.HTTP_200
+        req.context['result'] = {'data': results}
+
+    def execute(self, db_session, doc):
+        savepoint = db_session.begin_nested()
+        try:
+            if not isinstance(doc, dict):
+                raise falcon.HTTPInvalidParam(msg='Expected an object',
+                                              param_name='commands')
+            ensure_modifiable(Command, doc, allow_immutables=True)
+            columns = Command.__table__.columns.keys()
+            resource = Command(**{k: v for k, v in doc.items()
+                                  if k in columns})
+            commands.load_changes(resource)
+            commands.execute(db_session, resource, self.allow_seeds)
+            db_session.add(resource)
+            savepoint.commit()
+        except falcon.HTTPError as error:
+            savepoint.rollback()
+            return self.error_result(error)
+        except sqlalchemy.exc.IntegrityError:
+            savepoint.rollback()
+            return self.error_result(falcon.HTTPConflict(
+                self.CONFLICT, self.UNIQUE_VIOLATED))
+        except sqlalchemy.orm.exc.StaleDataError:
+            savepoint.rollback()
+            return self.error_result(version_conflict())
+
+        return {'status': falcon.HTTP_CREATED,
+                'data': queries.serialize_record(Command, resource)}
+
+    @staticmethod
+    def error_result(error):
+        return {'status': error.status,
+                'title': error.title,
+                'description': error.description}
 
 
 class CommandResource(RestResource):
@@ -119,11 +720,10 @@ class CommandResource(RestResource):
         super(CommandResource, self).modify_patch(
             req, resp, resource, *args, **kwargs)
 
-        if getattr(resource, 'changes', None):
-            resource.changes = json.dumps(resource.changes)
+        commands.load_changes(resource)
 
 
-class CardCollectionResource(RestCollectionResource):
+class CardCollectionResource(KeysetPagination, RestCollectionResource):
     model = Card
 
     def before_post(self, req, resp, db_session, resource, *args, **kwargs):
@@ -133,7 +733,7 @@ class CardCollectionResource(RestCollectionResource):
         require_record(db_session, Stack, 'stack_id', req.context['doc'])
 
 
-class CardResource(RestResource):
+class CardResource(ConditionalGet, RestResource):
     model = Card
     # TODO validate the card is landing in a valid stack, in the same game?
 
@@ -148,7 +748,7 @@ class StackCollectionResource(RestCollectionResource):
         require_record(db_session, Game, 'game_id', req.context['doc'])
 
 
-class StackResource(RestResource):
+class StackResource(ConditionalGet, RestResource):
     model = Stack
     # TODO validate the stack is in a valid game?
 
@@ -157,5 +757,5 @@ class GameCollectionResource(RestCollectionResource):
     model = Game
 
 
-class GameResource(RestResource):
+class GameResource(ConditionalGet, RestResource):
     model = Game
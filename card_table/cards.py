@@ -1,3 +1,5 @@
+from collections import namedtuple
+
 ACE = 'ace'
 TWO = '2'
 THREE = '3'
@@ -34,3 +36,24 @@ SPADE = '♠'
 
 COMMON_SUITS_LIST = [CLUB, DIAMOND, HEART, SPADE]
 COMMON_SUITS = dict(zip(COMMON_SUITS_LIST, COMMON_SUIT_NAMES_LIST))
+
+""" The identity of a card, independent of where it is placed """
+Face = namedtuple('Face', ['suit', 'suit_value', 'rank', 'rank_value'])
+
+
+def _deck_template(ranks_list, ranks):
+    return tuple(Face(suit, suit_value, rank, ranks[rank])
+                 for suit, suit_value in zip(COMMON_SUITS_LIST,
+                                             COMMON_SUIT_NAMES_LIST)
+                 for rank in ranks_list)
+
+
+""" A standard deck, ordered ascending by suit, built once at import """
+DECK_ACE_LOW = _deck_template(COMMON_RANKS_LIST_ACE_LOW, COMMON_RANKS_ACE_LOW)
+DECK_ACE_HIGH = _deck_template(COMMON_RANKS_LIST_ACE_HIGH,
+                               COMMON_RANKS_ACE_HIGH)
+
+ACE_LOW = 'ace low'
+ACE_HIGH = 'ace high'
+
+DECK_TEMPLATES = {ACE_LOW: DECK_ACE_LOW, ACE_HIGH: DECK_ACE_HIGH}
@@ -1,43 +1,166 @@
+import binascii
+import datetime as dt
+import functools
+import itertools
 import json
+import os
 import random
 
 import falcon
+from sqlalchemy import and_, bindparam, column, func, table
+from sqlalchemy.orm.util import identity_key
 
 import card_table.cards as cards
-from card_table.common import (ensure_integer, ensure_modifiable,
-                               require_param, require_record)
-from card_table.storage import Card, Stack
+from card_table.common import (all_modifiable, ensure_modifiable,
+                               ensure_version, require_loaded, require_param,
+                               require_record, version_conflict)
+from card_table.profiling import phase
+from card_table.schema import boolean, choice, compile_schema, integer, objects
+from card_table.storage import Card, Command, Facing, Stack
 
 RANDOM = random.SystemRandom()
+""" Bytes of system randomness in the seed of each virtual shoe """
+SHOE_SEED_BYTES = 16
 
 CREATE_DECK = 'create deck'
 MOVE_CARDS = 'move cards'
 NOOP = 'noop'
 SHUFFLE_STACK = 'shuffle stack'
 
-COMMANDS = [CREATE_DECK, MOVE_CARDS, NOOP, SHUFFLE_STACK]
+""" The most decks a command may combine into one stack or virtual shoe """
+MAX_DECKS = 100
 
+DRAW_FROM = 'draw_from'
+""" Key of a move naming the version of the card it expects to move """
+VERSION = 'version'
 
-def execute(db_session, resource):
-    if resource.operation in COMMANDS:
-        f_name = 'do_' + resource.operation.replace(' ', '_')
+""" The cards table without the types of its columns, to insert values
+already processed for the database, see _processed """
+UNTYPED_CARDS = table('cards', *[column(c.name)
+                                 for c in Card.__table__.columns])
+""" template name -> the rows of the faces of a deck, see cards.Face """
+DECK_ROWS = {name: tuple(dict(face._asdict()) for face in template)
+             for name, template in cards.DECK_TEMPLATES.items()}
 
-        func = getattr(Operations, f_name, None)
-        if func:
-            kwargs = __get_kwargs(resource)
-            return func(db_session, **kwargs)
+""" Key of the effects being recorded in db_session.info, see execute """
+EFFECTS = 'card_table.effects'
 
-    raise falcon.HTTPInvalidParam(msg=resource.operation,
-                                  param_name='operation')
+""" operation -> Registered, see register """
+REGISTRY = {}
+
+
+class Registered(object):
+    """ A command operation in the REGISTRY """
+
+    def __init__(self, operation, handler, validate):
+        self.operation = operation
+        self.handler = handler
+        self.validate = validate
+        # folds the command into a replay.TableState, see register_fold
+        self.fold = None
+
+
+def register(operation, **schema):
+    """ Register a function to perform a command operation
+
+    Game rules may register operations of their own. The schema is compiled
+    once, here, and the changes of each command are validated against it
+    before the handler is called.
+
+    :param operation: the name of the operation, as in Command.operation
+    :param schema: the parameters of the operation, see schema.Param
+    :return: a decorator of a function of (db_session, **changes), which
+        validates the changes of direct calls as well
+    """
+    validate = compile_schema(schema)
+
+    def decorator(handler):
+        REGISTRY[operation] = Registered(operation, handler, validate)
+
+        @functools.wraps(handler)
+        def validated(db_session, **kwargs):
+            return handler(db_session, **validate(kwargs))
+        return validated
+    return decorator
+
+
+def register_fold(operation):
+    """ Register a function to replay the commands of an operation
+
+    Each registered operation needs one for the games it is played in to be
+    replayed, see replay.TableState.apply.
+
+    :param operation: an operation already registered, see register
+    :return: a decorator of a function of (state, changes, effects), which
+        folds a command into a replay.TableState
+    :raise ValueError: if the operation is not registered
+    """
+    registered = REGISTRY.get(operation)
+    if registered is None:
+        raise ValueError('{} is not a registered operation'.format(operation))
+
+    def decorator(fold):
+        registered.fold = fold
+        return fold
+    return decorator
+
+
+def execute(db_session, resource, allow_secrets=False):
+    """ Perform the operation of a command
+
+    Outcomes of the operation which a replay needs, but which are not in its
+    changes, are recorded as the effects of the command.
+
+    :param db_session: db session to use
+    :param resource: the command to perform
+    :param allow_secrets: whether to accept the secret changes of
+        storage.Command.secret_changes, such as a seed choosing the order
+        of a shuffle, only for tests and administrators
+    :return: the result of the operation
+    """
+    registered = REGISTRY.get(resource.operation)
+    if registered is None:
+        raise falcon.HTTPInvalidParam(msg=resource.operation,
+                                      param_name='operation')
+
+    with phase('validate'):
+        kwargs = registered.validate(__get_kwargs(resource))
+        hidden = [key for key in Command.secret_changes() if key in kwargs]
+        if hidden and not allow_secrets:
+            raise falcon.HTTPInvalidParam(msg='Not accepted',
+                                          param_name=hidden[0])
+    if hidden:
+        # never stored, the effects keep what a replay needs
+        resource.changes = Command.public_changes(resource.changes)
+    effects = {}
+    info = getattr(db_session, 'info', {})
+    info[EFFECTS] = effects
+    try:
+        with phase('execute'):
+            result = registered.handler(db_session, **kwargs)
+    finally:
+        info.pop(EFFECTS, None)
+    if effects:
+        resource.effects = effects
+    return result
 
 
 class Operations(object):
 
     @staticmethod
+    @register(CREATE_DECK, stack_id=integer(required=True, minimum=1),
+              ace=choice(['high', 'low'], default='low'),
+              decks=integer(default=1, minimum=1, maximum=MAX_DECKS),
+              virtual=boolean(),
+              seed=integer())
     def do_create_deck(db_session, **kwargs):
         """ Create a standard deck of cards
 
-        The resulting deck is ordered consistently, ascending, by suit.
+        The resulting deck is ordered consistently, ascending, by suit. Cards
+        are copied from a precomputed deck template and written with a single
+        INSERT, bypassing the ORM unit of work. The values every card shares,
+        which would otherwise be defaulted and processed row by row, are
+        processed once.
 
         The command MUST contain (key, value): ('changes', dict())
         The kwargs MUST contain (key, value): ('stack_id', {integer}) where
@@ -45,51 +168,144 @@ class Operations(object):
         The changed dict MAY contain (key, value):
             ('ace': ['high', 'low']) to indicate the value of an ace in play
             DEFAULT: ace is low
+            ('decks': {integer}) the number of decks to combine, up to
+            MAX_DECKS
+            DEFAULT: 1
+            ('virtual': true) to make the stack a virtual shoe, which stores
+            only the template, a secret permutation seed of SHOE_SEED_BYTES
+            of system randomness and a draw cursor. Cards are stored as rows
+            only as they are drawn by 'move cards'.
+            ('seed': {integer}) to seed the permutation of a virtual shoe,
+            for tests. Refused from clients, see execute.
 
         :param db_session: db session to use
         :param kwargs: the command to perform
-        :return a new deck of cards
+        :return a new deck of cards, as the dicts of inserted values, or
+            the stack when it is made a virtual shoe
         """
-        stack_id = require_record(db_session, Stack, 'stack_id', kwargs)
-        if 'decks' in kwargs:
-            ensure_integer('decks', kwargs['decks'], minimum=1)
-
-        # default ace low
-        ranks = cards.COMMON_RANKS_ACE_LOW
-        if 'ace' in kwargs:
-            if kwargs['ace'] == 'high':
-                ranks = cards.COMMON_RANKS_ACE_HIGH
-
-        stack = []
-        for deck in range(0, kwargs.get('decks', 1)):
-            for suit, suit_value in cards.COMMON_SUITS.items():
-                for rank, rank_value in ranks.items():
-                    card = Card(stack_id=stack_id, position=len(stack),
-                                suit=suit, suit_value=suit_value, rank=rank,
-                                rank_value=rank_value)
-                    stack.append(card)
-        db_session.add_all(stack)
-        return stack
+        stack = require_record(db_session, Stack, 'stack_id', kwargs)
+        decks = kwargs['decks']
+
+        template_name = cards.ACE_LOW
+        if kwargs['ace'] == 'high':
+            template_name = cards.ACE_HIGH
+        template = cards.DECK_TEMPLATES[template_name]
+
+        if kwargs.get('virtual'):
+            if stack.is_shoe():
+                raise falcon.HTTPInvalidParam(msg='Already a virtual shoe',
+                                              param_name='stack_id')
+            stack.shoe_template = template_name
+            stack.shoe_size = len(template) * decks
+            seed = kwargs.get('seed')
+            if seed is None:
+                seed = binascii.hexlify(os.urandom(SHOE_SEED_BYTES)).decode()
+            stack.shoe_seed = str(seed)
+            stack.shoe_cursor = 0
+            db_session.add(stack)
+            _record_effects(db_session, shoe_seed=stack.shoe_seed)
+            return stack
+
+        now = dt.datetime.utcnow()
+        shared = _processed(db_session, Card, stack_id=stack.id,
+                            owner_facing=Facing.down,
+                            other_facing=Facing.down, version=1,
+                            created_at=now, updated_at=now)
+        deck = [dict(row, position=position, **shared) for position, row
+                in enumerate(DECK_ROWS[template_name] * decks)]
+        db_session.execute(UNTYPED_CARDS.insert(), deck)
+        _record_effects(db_session, first_card_id=_first_card_id(
+            db_session, len(deck)))
+        return deck
 
     @staticmethod
+    @register(MOVE_CARDS, cards=objects(required=True))
     def do_move_cards(db_session, **kwargs):
         """ Move one or more cards in some way
 
+        All referenced cards and stacks are loaded with one query each, the
+        whole batch is validated before anything is written, and the changes
+        are written with one UPDATE per distinct set of changed properties.
+        The first entry which is invalid is reported, whether it names an
+        unknown card or stack or a property which is not modifiable.
+
+        Each entry in cards MUST contain either (key, value): ('id', {integer})
+            naming an existing card which no other entry names, or
+            ('draw_from', {integer}) naming a virtual shoe to draw the next
+            card from. A drawn card is stored as a new row, so the entry MUST
+            also contain ('stack_id', {integer}) for the stack it lands in.
+        An entry naming a card MAY contain (key, value): ('version',
+            {integer}), the version of the card last read, to refuse the move
+            if the card has changed since.
+
+        Each card is only written while it is still at the version read, or
+        expected, so of two commands racing to move a card one is refused
+        with 409 Conflict, see versioned_update.
+
         :param db_session: db session to use
         :param kwargs: the command to perform
         """
-        update_sets = require_param('cards', kwargs)
+        update_sets = kwargs['cards']
+        moves = [props for props in update_sets if DRAW_FROM not in props]
+        # the keys of every move at once; the moves are only checked one by
+        # one, in order, if any is refused
+        modifiable = all_modifiable(Card, moves, exceptions=['id', VERSION])
+
+        card_ids = [require_param('id', props) for props in moves]
+        # each card is written once, at the version read
+        seen = set()
+        for card_id in card_ids:
+            if card_id in seen:
+                raise falcon.HTTPInvalidParam(msg='Moved more than once',
+                                              param_name='id')
+            seen.add(card_id)
+        found_cards = {}
+        if card_ids:
+            found_cards = _index_by_id(Card.find_by_ids(card_ids, db_session))
+        # not all moves will change stack_id
+        stack_ids = [props[key] for props in update_sets
+                     for key in ('stack_id', DRAW_FROM) if key in props]
+        found_stacks = {}
+        if stack_ids:
+            found_stacks = _index_by_id(Stack.find_by_ids(stack_ids,
+                                                          db_session))
+
+        grouped = {}
+        drawn = []
         for props in update_sets:
-            # also loads Card into db_session for later merge
-            require_record(db_session, Card, 'id', props)
-            ensure_modifiable(Card, props, exceptions=['id'])
-            # not all moves will change stack_id
+            if DRAW_FROM in props:
+                drawn.append(_draw_card(found_stacks, props))
+                continue
+
+            card = require_loaded(found_cards, 'id', props)
+            if not modifiable:
+                ensure_modifiable(Card, props, exceptions=['id', VERSION])
+            ensure_version(card, props)
             if 'stack_id' in props:
-                require_record(db_session, Stack, 'stack_id', props)
+                require_loaded(found_stacks, 'stack_id', props)
+
+            changes = {k: v for k, v in props.items()
+                       if k not in ('id', VERSION)}
+            if changes:
+                changes.update(record_id=card.id,
+                               expected_version=card.version)
+                grouped.setdefault(frozenset(changes), []).append(changes)
+
+        cards_table = Card.__table__
+        statement = versioned_update(cards_table)
+        for changes in grouped.values():
+            compare_and_swap(db_session, Card, statement, changes)
+        # drawn cards are inserted in order, for _last_card_ids
+        for _, values in itertools.groupby(drawn, key=frozenset):
+            db_session.execute(cards_table.insert(), list(values))
+        if drawn:
+            _record_effects(db_session, drawn_ids=_last_card_ids(
+                db_session, len(drawn)))
 
-            db_session.merge(Card(**props))
+        _expire_cards(db_session, found_cards.keys())
 
     @staticmethod
+    @register(NOOP)
     def do_noop(db_session, **kwargs):
         """ Perform a No-Op
 
@@ -100,33 +316,223 @@ class Operations(object):
         pass
 
     @staticmethod
+    @register(SHUFFLE_STACK, stack_id=integer(required=True, minimum=1),
+              seed=integer())
     def do_shuffle_stack(db_session, **kwargs):
         """ Shuffle cards in a stack
 
+        Only the card ids and versions are loaded. Their positions are
+        permuted in memory and all of the new positions are written with a
+        single UPDATE, refused if any of the cards changed meanwhile.
+
+        The kwargs MUST contain (key, value): ('stack_id', {integer}) where
+            {integer} is an existing stack to shuffle
+        The kwargs MAY contain (key, value): ('seed', {integer}) to use a
+            reproducible generator instead of the system random source, for
+            tests. Refused from clients, see execute.
+
+        A virtual shoe is refused: a new seed would reorder the cards already
+        drawn along with the rest, dealing some of them again.
+
         :param db_session: db session to use
         :param kwargs: the command to perform
         """
-        stack_id = require_record(db_session, Stack, 'stack_id', kwargs)
-        # use a copy of the found cards, for safety, testability
-        card_list = list(Card.find_by_stack(db_session, stack_id))
-        shuffled = 0
-
-        while card_list:
-            index = RANDOM.randrange(start=0, stop=len(card_list))
-            selected = card_list.pop(index)
-            selected.position = shuffled
-            db_session.add(selected)
-            shuffled += 1
+        stack = require_record(db_session, Stack, 'stack_id', kwargs)
+        if stack.is_shoe():
+            raise falcon.HTTPInvalidParam(msg='Cannot shuffle a virtual shoe',
+                                          param_name='stack_id')
+        versions = Card.find_versions_by_stack(stack.id, db_session)
+        if not versions:
+            return
+        card_ids = [card_id for card_id, _ in versions]
+
+        positions = shuffle(list(range(len(card_ids))),
+                            get_random(kwargs.get('seed')))
+
+        compare_and_swap(db_session, Card, versioned_update(Card.__table__), [
+            {'record_id': card_id, 'expected_version': version,
+             'position': position}
+            for (card_id, version), position in zip(versions, positions)])
+
+        _expire_cards(db_session, card_ids)
+        shuffled = [None] * len(card_ids)
+        for card_id, position in zip(card_ids, positions):
+            shuffled[position] = card_id
+        _record_effects(db_session, card_ids=shuffled)
         # not returning the shuffled stack to prevent leaking secrets
 
 
-def __get_kwargs(command):
-    try:
-        changes = command.changes
-        if changes:
-            return json.loads(changes)
+def versioned_update(table):
+    """ An UPDATE of a record by id, only while it is at the version expected
+
+    The counterpart, for bulk UPDATEs, of the version checks the ORM makes,
+    see storage.Card.version. The version is advanced by each UPDATE.
 
+    :param table: a table with id and version columns
+    :return: a statement to execute with record_id, expected_version and
+        the new values of each record, see compare_and_swap
+    """
+    return table.update().where(and_(
+        table.c.id == bindparam('record_id'),
+        table.c.version == bindparam('expected_version'))).values(
+        version=table.c.version + 1)
+
+
+def compare_and_swap(db_session, model, statement, params):
+    """ Execute a versioned_update, all or nothing
+
+    :raise falcon.HTTPConflict: if any of the records was no longer at the
+        version expected, so the transaction must be rolled back
+    """
+    result = db_session.execute(statement, params)
+    if result.rowcount != len(params):
+        raise version_conflict(model)
+
+
+def get_random(seed=None):
+    """ Select the random number generator to shuffle with
+
+    :param seed: when given, a reproducible generator seeded with it
+    :return: the system random source, or a seeded generator
+    """
+    if seed is None:
+        return RANDOM
+    return random.Random(seed)
+
+
+def shuffle(items, rng=None):
+    """ Fisher-Yates shuffle, in place
+
+    :param items: a mutable sequence to permute
+    :param rng: the random number generator to use, defaults to RANDOM
+    :return: the shuffled items
+    """
+    rng = rng or RANDOM
+    for i in range(len(items) - 1, 0, -1):
+        j = rng.randrange(i + 1)
+        items[i], items[j] = items[j], items[i]
+    return items
+
+
+@functools.lru_cache(maxsize=256)
+def shoe_order(seed, size):
+    """ The reproducible order of the cards in a virtual shoe
+
+    :param seed: the seed of the shoe
+    :param size: the number of cards in the shoe
+    :return: a tuple of indexes into the repeated deck template
+    """
+    return tuple(shuffle(list(range(size)), get_random(seed)))
+
+
+def shoe_face(template_name, seed, size, cursor):
+    """ The face of the card at the cursor of a virtual shoe """
+    template = cards.DECK_TEMPLATES[template_name]
+    index = shoe_order(seed, size)[cursor]
+    return template[index % len(template)]
+
+
+def _draw_card(found_stacks, props):
+    """ Take the next card off a virtual shoe
+
+    :param found_stacks: dict of loaded stacks, keyed by id
+    :param props: the move entry, naming the shoe and the destination
+    :return: the values of the card row to insert
+    """
+    shoe = require_loaded(found_stacks, DRAW_FROM, props)
+    if not shoe.is_shoe() or not shoe.shoe_remaining():
+        raise falcon.HTTPInvalidParam(msg=props[DRAW_FROM],
+                                      param_name=DRAW_FROM)
+
+    values = {k: v for k, v in props.items() if k != DRAW_FROM}
+    ensure_modifiable(Card, values)
+    require_loaded(found_stacks, 'stack_id', values)
+
+    face = shoe_face(shoe.shoe_template, shoe.shoe_seed, shoe.shoe_size,
+                     shoe.shoe_cursor)
+    shoe.shoe_cursor += 1
+
+    values.update(suit=face.suit, suit_value=face.suit_value,
+                  rank=face.rank, rank_value=face.rank_value)
+    return values
+
+
+def _processed(db_session, model, **values):
+    """ Values of columns of a model, processed for the database of the
+    session as bind parameters of the columns would be """
+    dialect = db_session.get_bind(model).dialect
+    columns = model.__table__.c
+    processed = {}
+    for name, value in values.items():
+        process = columns[name].type.dialect_impl(dialect).bind_processor(
+            dialect)
+        processed[name] = process(value) if process else value
+    return processed
+
+
+def _record_effects(db_session, **effects):
+    """ Note outcomes which a replay of the command needs, see execute """
+    recording = db_session.info.get(EFFECTS)
+    if recording is not None:
+        recording.update(effects)
+
+
+def _first_card_id(db_session, count):
+    """ Id of the first of the count cards most recently inserted in this
+    transaction, the rest of which follow it
+
+    Relies on ascending ids being assigned to rows in the order inserted,
+    while the transaction holds the write lock.
+    """
+    return db_session.query(func.max(Card.id)).scalar() - count + 1
+
+
+def _last_card_ids(db_session, count):
+    """ Ids of the cards most recently inserted in this transaction, see
+    _first_card_id """
+    first_id = _first_card_id(db_session, count)
+    return list(range(first_id, first_id + count))
+
+
+def _expire_cards(db_session, card_ids):
+    """ Expire any loaded cards made stale by a bulk UPDATE """
+    for card_id in card_ids:
+        card = db_session.identity_map.get(identity_key(Card, card_id))
+        if card is not None:
+            db_session.expire(card)
+
+
+def _index_by_id(records):
+    return {record.id: record for record in records}
+
+
+def load_changes(command):
+    """ Decode the changes of a command, if they are still JSON text
+
+    Called once, as a command comes in through the API. The decoded changes
+    replace the text on the command, and are stored encoded as they are,
+    even where they are a string, see storage.JSONText.
+
+    :param command: the command
+    :return: the changes, or None if there are none
+    """
+    changes = command.changes
+    if isinstance(changes, str):
+        try:
+            changes = json.loads(changes)
+        except ValueError:
+            raise falcon.HTTPInvalidParam(msg='Invalid JSON',
+                                          param_name='changes')
+        command.changes = changes
+    return changes
+
+
+def __get_kwargs(command):
+    changes = command.changes
+    if changes is None:
         raise falcon.HTTPMissingParam(param_name='changes')
-    except ValueError:
-        raise falcon.HTTPInvalidParam(msg='Invalid JSON',
+
+    if not isinstance(changes, dict):
+        raise falcon.HTTPInvalidParam(msg='Expected an object',
                                       param_name='changes')
+    return changes
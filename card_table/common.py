@@ -1,3 +1,6 @@
+import functools
+import itertools
+
 import falcon
 
 
@@ -14,18 +17,12 @@ def ensure_modifiable(model, props, exceptions=None, allow_immutables=False):
         allow
     :param allow_immutables: whether or not immutable properties are
         modifiable in this context or not. Defaults to False.
-    :return: the list of exceptions + immutables which were found and allowed
+    :return: the set of properties which are not modifiable, always empty
+        as any found are refused
     """
-    if not exceptions:
-        exceptions = []
-
-    blacklist = model.protected_properties()
-    if not allow_immutables:
-        blacklist += model.immutable_properties()
-
-    # ensure no immutable props included in props, should contain 'id'
-    protected_props = [p.key for p in blacklist if p.key not in exceptions]
-    intersecting = set(props.keys()) & set(protected_props)
+    blacklist = unmodifiable_keys(model, allow_immutables,
+                                  frozenset(exceptions or ()))
+    intersecting = blacklist.intersection(props)
     if intersecting:
         raise falcon.HTTPInvalidParam(msg="One or more properties are not "
                                           "modifiable.",
@@ -33,6 +30,65 @@ def ensure_modifiable(model, props, exceptions=None, allow_immutables=False):
     return intersecting
 
 
+def all_modifiable(model, props_list, exceptions=None,
+                   allow_immutables=False):
+    """ Whether the properties of each of many payloads are modifiable
+
+    As ensure_modifiable, for bulk changes, but the keys of all of the
+    payloads are checked at once and nothing is raised.
+
+    :param model: the class under scrutiny
+    :param props_list: a list of the properties of each payload
+    :param exceptions: optional list of individual white-listed properties to
+        allow
+    :param allow_immutables: whether or not immutable properties are
+        modifiable in this context or not. Defaults to False.
+    :return: True if none of the properties is refused
+    """
+    blacklist = unmodifiable_keys(model, allow_immutables,
+                                  frozenset(exceptions or ()))
+    return blacklist.isdisjoint(itertools.chain.from_iterable(props_list))
+
+
+def ensure_all_modifiable(model, props_list, exceptions=None,
+                          allow_immutables=False):
+    """ Ensure the properties of each of many payloads are modifiable
+
+    As ensure_modifiable, for bulk changes. The keys of all of the payloads
+    are checked at once, see all_modifiable, and the payloads are only
+    looked at one by one to report the first which is refused.
+
+    :param model: the class under scrutiny
+    :param props_list: a list of the properties of each payload
+    :param exceptions: optional list of individual white-listed properties to
+        allow
+    :param allow_immutables: whether or not immutable properties are
+        modifiable in this context or not. Defaults to False.
+    """
+    if all_modifiable(model, props_list, exceptions, allow_immutables):
+        return
+
+    for props in props_list:
+        ensure_modifiable(model, props, exceptions, allow_immutables)
+
+
+@functools.lru_cache(maxsize=None)
+def unmodifiable_keys(model, allow_immutables=False, exceptions=frozenset()):
+    """ The keys of the properties of model which may not be modified
+
+    Computed once per model and mode, see ensure_modifiable.
+
+    :param model: the class under scrutiny
+    :param allow_immutables: whether immutable properties are allowed
+    :param exceptions: frozenset of individual white-listed properties
+    :return: a frozenset of property keys
+    """
+    blacklist = list(model.protected_properties())
+    if not allow_immutables:
+        blacklist.extend(model.immutable_properties())
+    return frozenset(p.key for p in blacklist if p.key not in exceptions)
+
+
 def require_param(named, data_dict):
     """ Require that the given data dictionary contains the property named
 
@@ -74,11 +130,55 @@ def require_record(session, accessor, named, data_dict):
     return record
 
 
-def ensure_integer(named, value, minimum=None, maximum=None):
-    if value == int(value):
-        if not minimum or value >= minimum:
-            if not maximum or value <= maximum:
-                return
+def require_loaded(records, named, data_dict):
+    """ Require that a record was among those already loaded from the DB
+
+    Counterpart to require_record for bulk operations, where the records were
+    fetched up front with a single query and are looked up here in memory.
+    Will raise an appropriate falcon.HTTPBadRequest exception if not found
+
+    :param records: dict of persistent objects, keyed by primary key
+    :param named: the property which contains the record primary key
+    :param data_dict: the dictionary to look for the named property
+    :return: the persistent object
+    """
+    record_id = require_param(named, data_dict)
+
+    record = records.get(record_id)
+    if not record:
+        raise falcon.HTTPInvalidParam(msg=record_id,
+                                      param_name=named)
+
+    return record
+
+
+def version_conflict(model=None, record_id=None):
+    """ The error for a write which lost a race with another writer
+
+    :param model: the class of the record which changed, if known
+    :param record_id: the primary key of the record, if known
+    :return: a falcon.HTTPConflict to raise, asking the client to read the
+        record again and retry
+    """
+    name = 'record' if model is None else model.__tablename__[:-1]
+    if record_id is not None:
+        name = '{} {}'.format(name, record_id)
+    return falcon.HTTPConflict('Conflict',
+                               'The {} was changed by another request, '
+                               'read it again and retry'.format(name))
+
+
+def ensure_version(record, props, named='version'):
+    """ Ensure a record is still at the version the client last read
 
-    raise falcon.HTTPInvalidParam(msg=value,
-                                  param_name=named)
+    :param record: the persistent object, with a version column
+    :param props: the payload, which may name the version expected
+    :param named: the property which contains the version expected
+    """
+    if named not in props:
+        return
+    expected = props[named]
+    if isinstance(expected, bool) or not isinstance(expected, int):
+        raise falcon.HTTPInvalidParam(msg=expected, param_name=named)
+    if expected != record.version:
+        raise version_conflict(type(record), record.id)
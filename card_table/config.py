@@ -0,0 +1,53 @@
+import configparser
+import os
+
+""" Names an optional ini style config file """
+CONFIG_FILE_ENV = 'CARD_TABLE_CONFIG'
+ENV_PREFIX = 'CARD_TABLE'
+
+TRUTHY = ['1', 'true', 'yes', 'on']
+
+
+def settings(section, defaults):
+    """ Read a section of settings
+
+    Each key is looked up in the environment as CARD_TABLE_{SECTION}_{KEY},
+    then in the [section] of the config file named by CARD_TABLE_CONFIG, and
+    otherwise taken from defaults. Values found are coerced to the type of
+    the default value.
+
+    :param section: the name of the group of settings
+    :param defaults: dict of every known key and its default value
+    :return: a new dict of the settings
+    """
+    from_file = _read_file(section)
+
+    result = {}
+    for key, default in defaults.items():
+        env_key = '_'.join([ENV_PREFIX, section, key]).upper()
+        value = os.environ.get(env_key, from_file.get(key))
+        result[key] = default if value is None else _coerce(value, default)
+    return result
+
+
+def _read_file(section):
+    path = os.environ.get(CONFIG_FILE_ENV)
+    if not path:
+        return {}
+
+    parser = configparser.ConfigParser()
+    if not parser.read(path):
+        raise ValueError('Unable to read config file {}'.format(path))
+    if not parser.has_section(section):
+        return {}
+    return dict(parser.items(section))
+
+
+def _coerce(value, default):
+    if isinstance(default, bool):
+        return value.strip().lower() in TRUTHY
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
@@ -0,0 +1,114 @@
+""" Change feed of the commands of each game, see ChangeNotifier """
+import threading
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from card_table import queries
+from card_table.commands import DRAW_FROM, MOVE_CARDS
+from card_table.storage import Command
+
+""" Keys the commands flushed but not yet committed, in session.info """
+PENDING = 'card_table.events'
+""" Properties of each entry of a move which every player may see. The id
+of the card moved is not one, as it would reveal the face of a card moved
+face down, see queries.FACE_COLUMNS """
+PUBLIC_MOVE_PROPERTIES = frozenset(['stack_id', 'position', 'owner_facing',
+                                    'other_facing', DRAW_FROM])
+
+
+class ChangeNotifier(object):
+    """ Wakes the subscribers of a game as commands of it are committed
+
+    A worker needs only one notifier, see NOTIFIER, which all of its
+    subscribers share. It hears only of the commits made by its own worker,
+    so a subscriber should also look in the database whenever a wait times
+    out. Notifications are only hints; the commands table is the feed.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        """ game_id -> the greatest command id committed """
+        self.latest = {}
+
+    def listen(self, target=Session):
+        """ Be notified of the commands committed by sessions of target """
+        for name, listener in [('after_flush', self._collect),
+                               ('after_commit', self._committed),
+                               ('after_rollback', self._discard)]:
+            if not event.contains(target, name, listener):
+                event.listen(target, name, listener)
+
+    def notify(self, game_id, command_id):
+        with self.condition:
+            if command_id > self.latest.get(game_id, 0):
+                self.latest[game_id] = command_id
+            self.condition.notify_all()
+
+    def wait(self, game_id, after, timeout):
+        """ Wait for a command of the game newer than after to be committed
+
+        :param game_id: the game to watch
+        :param after: the id of the last command already seen
+        :param timeout: seconds to wait at most
+        :return: True if such a command was committed by this worker
+        """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.latest.get(game_id, 0) > after, timeout)
+
+    def _collect(self, session, flush_context):
+        pending = session.info.setdefault((PENDING, id(self)), [])
+        pending.extend((record.game_id, record.id) for record in session.new
+                       if isinstance(record, Command))
+
+    def _committed(self, session):
+        for game_id, command_id in session.info.pop((PENDING, id(self)), []):
+            self.notify(game_id, command_id)
+
+    def _discard(self, session):
+        session.info.pop((PENDING, id(self)), None)
+
+
+NOTIFIER = ChangeNotifier()
+
+
+def command_events(conn, game_id, after, limit=None):
+    """ The commands of a game after a cursor, as events for its players
+
+    Only what every player may see of each command is included.
+
+    :param conn: the connection to use
+    :param game_id: the game
+    :param after: the id of the last command already seen
+    :param limit: the greatest number of events to return
+    :return: a list of event dicts, in the order executed
+    """
+    table = Command.__table__
+    statement = select([table.c.id, table.c.operation, table.c.actor_id,
+                        table.c.changes, table.c.created_at]).where(
+        (table.c.game_id == game_id) & (table.c.id > after)).order_by(
+        table.c.id).limit(limit)
+
+    return [{'id': row.id,
+             'operation': row.operation,
+             'actor_id': row.actor_id,
+             'changes': public_changes(row.operation, row.changes),
+             'created_at': row.created_at.strftime(queries.DATETIME_FORMAT)}
+            for row in conn.execute(statement)]
+
+
+def public_changes(operation, changes):
+    """ What every player may see of the changes of a command
+
+    Besides the secret changes of every command, see
+    storage.Command.public_changes, the entries of a move keep only
+    PUBLIC_MOVE_PROPERTIES.
+    """
+    changes = Command.public_changes(changes)
+    moves = changes.get('cards') if isinstance(changes, dict) else None
+    if operation != MOVE_CARDS or not isinstance(moves, list):
+        return changes
+    return dict(changes, cards=[
+        {k: v for k, v in props.items() if k in PUBLIC_MOVE_PROPERTIES}
+        for props in moves if isinstance(props, dict)])
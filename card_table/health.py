@@ -0,0 +1,146 @@
+""" Database health, probed off the request path, see HealthMonitor """
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from card_table import storage
+
+LOG = logging.getLogger(__name__)
+
+""" The verdict of one probe
+
+available: whether the probe query succeeded
+latency_ms: how long the probe took, in milliseconds
+pool: a dict describing the connection pool, see pool_status
+checked_at: time.monotonic() when the probe finished
+"""
+Health = namedtuple('Health', ['available', 'latency_ms', 'pool',
+                               'checked_at'])
+
+
+class HealthMonitor(object):
+    """ Keeps the verdict of the latest probe of the database
+
+    A daemon thread, started on first use, probes every ttl seconds so that
+    reading the verdict costs no more than an attribute lookup. Where each
+    thread sees a database of its own, see storage.is_thread_local, a probe
+    from another thread would check the wrong database, so the verdict is
+    refreshed by the reader instead once it is older than ttl.
+
+    :param db_engine: the engine to probe
+    :param ttl: seconds between probes
+    :param max_latency_ms: a slower probe leaves the service not ready
+    :param max_saturation: a larger fraction of the pool in use leaves the
+        service not ready
+    :param stale_after: a verdict this many ttls old, as from a probe stuck
+        on the database, leaves the service not ready
+    :param background: whether to probe from a thread, by default unless
+        the database is thread local
+    """
+
+    def __init__(self, db_engine, ttl=1.0, max_latency_ms=250.0,
+                 max_saturation=0.9, stale_after=3.0, background=None):
+        self.db_engine = db_engine
+        self.ttl = ttl
+        self.max_latency_ms = max_latency_ms
+        self.max_saturation = max_saturation
+        self.stale_after = stale_after
+        if background is None:
+            background = not storage.is_thread_local(db_engine)
+        self.background = background
+        self.is_db_available = storage.db_verifier(db_engine)
+        self.health = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def current(self):
+        """ The verdict of the latest probe, probing first if there is none
+        or, without a background thread, if it has expired """
+        health = self.health
+        if health is None or (not self.background and
+                              self.age(health) >= self.ttl):
+            health = self.probe()
+        if self.background:
+            self.start()
+        return health
+
+    def ready(self, health):
+        """ Why the service is not ready to take requests, or None if it is
+        """
+        if not health.available:
+            return 'Database unavailable'
+        if self.age(health) >= self.ttl * self.stale_after:
+            return 'Database probe overdue'
+        if health.latency_ms > self.max_latency_ms:
+            return 'Database responding slowly'
+        saturation = health.pool.get('saturation')
+        if saturation is not None and saturation >= self.max_saturation:
+            return 'Database connections exhausted'
+        return None
+
+    def probe(self):
+        start = time.perf_counter()
+        available = self.is_db_available()
+        latency = (time.perf_counter() - start) * 1000
+        self.health = Health(available, round(latency, 3),
+                             pool_status(self.db_engine), time.monotonic())
+        return self.health
+
+    def start(self):
+        """ Start the probing thread, unless it is already running """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run,
+                                           name='health-monitor', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.ttl):
+            try:
+                self.probe()
+            except Exception:
+                LOG.exception('Failure probing the health of the database')
+
+    @staticmethod
+    def age(health):
+        return time.monotonic() - health.checked_at
+
+    @staticmethod
+    def details(health):
+        """ The verdict as a dict to send to clients """
+        return {'available': health.available,
+                'latency_ms': health.latency_ms,
+                'age_ms': round(HealthMonitor.age(health) * 1000, 3),
+                'pool': health.pool}
+
+
+def pool_status(db_engine):
+    """ The connections of a pool, where the pool keeps count of them
+
+    :return: a dict of size, checked_out, overflow, the connections open
+        beyond size, and saturation, the fraction of the connections the
+        pool may open which are in use, or an empty dict
+    """
+    pool = db_engine.pool
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    size = pool.size()
+    checked_out = pool.checkedout()
+    max_overflow = getattr(pool, '_max_overflow', 0)
+    saturation = None
+    # a negative max_overflow means no limit
+    if max_overflow >= 0 and size + max_overflow:
+        saturation = round(checked_out / (size + max_overflow), 3)
+    return {'size': size, 'checked_out': checked_out,
+            'overflow': max(pool.overflow(), 0), 'saturation': saturation}
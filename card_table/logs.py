@@ -0,0 +1,180 @@
+""" Logging off the request thread, see configure """
+import atexit
+import json
+import logging
+import queue
+import random
+import signal
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from card_table import config
+
+TEXT_FORMAT = ('[%(asctime)s] [%(process)d] [%(name)s] [%(levelname)s] '
+               '%(message)s')
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S +0000'
+
+""" The queue handler and listener installed by configure, if any """
+_pipeline = None
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, for log shippers to parse """
+
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'process': record.process,
+                 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    """ Pass only a fraction of the chatty records of some loggers
+
+    Records below WARNING from the named loggers, or their children, pass
+    with probability rate. All other records pass.
+
+    :param names: the names of the loggers to sample
+    :param rate: the fraction of their records to pass, 0 to 1
+    """
+
+    def __init__(self, names, rate, rng=None):
+        super().__init__()
+        self.prefixes = tuple(names)
+        self.rate = rate
+        self.random = rng or random.Random()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.sampled(record.name):
+            return True
+        return self.random.random() < self.rate
+
+    def sampled(self, name):
+        return any(name == prefix or name.startswith(prefix + '.')
+                   for prefix in self.prefixes)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ Enqueue records without ever blocking the logging thread
+
+    When the queue is full the record is dropped and counted, rather than
+    waiting on the listener. Only the message is rendered here; formatting,
+    including of tracebacks, is left to the handlers of the listener.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure(level='INFO', format='text', queue_size=10000,
+              sampled='sqlalchemy.engine', sample_rate=0.01, level_signal='',
+              stream=None):
+    """ Send the records of every logger through a queue to stream
+
+    Replaces any pipeline installed before, stopping its listener once it
+    has written the records already queued.
+
+    :param level: the name of the level of the root logger
+    :param format: text, or json for one JSON object per line
+    :param queue_size: the records to hold before dropping new ones
+    :param sampled: comma separated names of loggers to sample, see
+        SamplingFilter
+    :param sample_rate: the fraction of their records to keep
+    :param level_signal: the name of a signal, such as SIGUSR2, on which to
+        read the level again from the settings, see reload_level
+    :param stream: where to write, by default sys.stderr
+    :return: the DroppingQueueHandler, which counts the records dropped
+    """
+    global _pipeline
+    unconfigure()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    if format == 'json':
+        output.setFormatter(JsonFormatter())
+    elif format == 'text':
+        output.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    else:
+        raise ValueError('Unknown log format {}'.format(format))
+
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    names = [name.strip() for name in sampled.split(',') if name.strip()]
+    if names:
+        handler.addFilter(SamplingFilter(names, sample_rate))
+    listener = QueueListener(handler.queue, output)
+
+    root = logging.getLogger()
+    set_level(level)
+    root.addHandler(handler)
+    listener.start()
+    _pipeline = (handler, listener)
+
+    if level_signal:
+        _on_signal(level_signal, reload_level)
+    return handler
+
+
+def unconfigure():
+    """ Remove the pipeline installed by configure, if any, once the
+    records already queued are written """
+    global _pipeline
+    if _pipeline is None:
+        return
+    handler, listener = _pipeline
+    _pipeline = None
+    logging.getLogger().removeHandler(handler)
+    listener.stop()
+
+
+def set_level(level, name=None):
+    """ Set the level of a logger, by default the root logger
+
+    :param level: the name of a level, such as DEBUG
+    :raises ValueError: if there is no such level
+    """
+    number = logging.getLevelName(level.upper())
+    if not isinstance(number, int):
+        raise ValueError('Unknown log level {}'.format(level))
+    logging.getLogger(name).setLevel(number)
+
+
+def reload_level(*args):
+    """ Set the level of the root logger from the settings once more
+
+    For a level changed in the config file since; the environment of a
+    process is fixed once it has started.
+    """
+    current = logging.getLevelName(logging.getLogger().level)
+    set_level(config.settings('logging', {'level': current})['level'])
+
+
+def _on_signal(name, handler):
+    signum = getattr(signal, name, None)
+    if signum is None:
+        raise ValueError('Unknown signal {}'.format(name))
+    # signal handlers can only be set from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signum, handler)
+
+
+atexit.register(unconfigure)
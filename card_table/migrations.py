@@ -0,0 +1,158 @@
+""" Upgrades to the schema of existing databases
+
+    $ python -m card_table.migrations [URL] [--list]
+
+storage.sync creates the tables missing from a database, with their
+indexes, but never alters a table which already exists. Each migration
+brings a database created by an earlier version of the models up to date,
+and is recorded in the schema_migrations table once applied. Migrations
+inspect the database before changing it, so that they are also harmless on
+a database created by the current models.
+"""
+import argparse
+import datetime as dt
+import logging
+import sys
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        inspect, select)
+
+from card_table import config, storage
+
+LOG = logging.getLogger(__name__)
+
+Migration = namedtuple('Migration', ['version', 'name', 'upgrade'])
+
+""" version -> Migration, in the order to apply them, see migration """
+MIGRATIONS = OrderedDict()
+
+schema_migrations = Table(
+    'schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('name', String),
+    Column('applied_at', DateTime, default=dt.datetime.utcnow))
+
+
+def migration(version, name):
+    """ Register a function of a connection as the upgrade to version """
+    def decorator(f):
+        if MIGRATIONS and version <= next(reversed(MIGRATIONS)):
+            raise ValueError('Migration {} is out of order'.format(version))
+        MIGRATIONS[version] = Migration(version, name, f)
+        return f
+    return decorator
+
+
+def applied(conn):
+    """ The versions already applied to the database """
+    if not schema_migrations.exists(conn):
+        return set()
+    return {row.version for row in conn.execute(
+        select([schema_migrations.c.version]))}
+
+
+def pending(conn):
+    """ The migrations not yet applied to the database, in order """
+    done = applied(conn)
+    return [m for m in MIGRATIONS.values() if m.version not in done]
+
+
+def migrate(db_engine):
+    """ Create missing tables, then apply each pending migration
+
+    Each migration is applied and recorded in a transaction of its own.
+
+    :return: the migrations applied
+    """
+    storage.sync(db_engine)
+    with db_engine.connect() as conn:
+        schema_migrations.create(conn, checkfirst=True)
+        todo = pending(conn)
+        for step in todo:
+            with conn.begin():
+                LOG.info('Applying migration %s: %s', step.version,
+                         step.name)
+                step.upgrade(conn)
+                conn.execute(schema_migrations.insert(),
+                             version=step.version, name=step.name)
+    return todo
+
+
+def ensure_indexes(conn, table):
+    """ Create the indexes of a table which the database lacks """
+    existing = {index['name'] for index in inspect(conn).get_indexes(
+        table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+
+def ensure_columns(conn, table, names):
+    """ Add the named columns of a table which the database lacks
+
+    Only columns which are nullable, or have a server default, can be added
+    to a table with rows.
+    """
+    existing = {column['name'] for column in inspect(conn).get_columns(
+        table.name)}
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, name, column.type.compile(conn.dialect))
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        if column.server_default is not None:
+            ddl += " DEFAULT '{}'".format(column.server_default.arg)
+        conn.execute(ddl)
+
+
+@migration(1, 'composite indexes for the stacks and cards of a game')
+def composite_indexes(conn):
+    ensure_indexes(conn, storage.Card.__table__)
+    ensure_indexes(conn, storage.Command.__table__)
+    ensure_indexes(conn, storage.Stack.__table__)
+    ensure_indexes(conn, storage.Snapshot.__table__)
+
+
+@migration(2, 'version columns for optimistic concurrency')
+def version_columns(conn):
+    for model in (storage.Game, storage.Stack, storage.Card):
+        ensure_columns(conn, model.__table__, ['version'])
+
+
+@migration(3, 'virtual shoes of stacks, and the effects of commands')
+def shoe_and_effect_columns(conn):
+    ensure_columns(conn, storage.Stack.__table__,
+                   ['shoe_template', 'shoe_size', 'shoe_seed', 'shoe_cursor'])
+    ensure_columns(conn, storage.Command.__table__, ['effects'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m card_table.migrations')
+    parser.add_argument('url', nargs='?',
+                        help='the database to upgrade, by default the url '
+                             'of the [database] settings')
+    parser.add_argument('--list', action='store_true',
+                        help='only list the pending migrations')
+    args = parser.parse_args(argv)
+
+    url = args.url or config.settings('database', {'url': ''})['url']
+    if not url:
+        parser.error('no database url given or configured')
+    db_engine = storage.build_engine(url)
+
+    if args.list:
+        with db_engine.connect() as conn:
+            steps = pending(conn)
+    else:
+        steps = migrate(db_engine)
+    for step in steps:
+        print('{} {}'.format(step.version, step.name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
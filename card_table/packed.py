@@ -0,0 +1,204 @@
+""" Cards packed into small integers, for holding many games in memory
+
+A packed card fits in 32 bits, from the least significant:
+
+    other_facing  2 bits, the value of storage.Facing
+    owner_facing  2 bits, the value of storage.Facing
+    suit          2 bits, the index in cards.COMMON_SUITS_LIST, 0 for a joker
+    rank          4 bits, the index in cards.COMMON_RANKS_LIST_ACE_LOW, or
+                  JOKER_RANK for a joker
+    ace high      1 bit, whether an ace ranks above a king
+    deck          7 bits, the index of the deck the card came from, in a
+                  shoe of up to commands.MAX_DECKS decks
+"""
+from array import array
+from collections import namedtuple
+
+import card_table.cards as cards
+from card_table.commands import MAX_DECKS, shuffle
+from card_table.storage import Facing
+
+OTHER_FACING_SHIFT = 0
+OWNER_FACING_SHIFT = 2
+FACE_SHIFT = 4
+DECK_SHIFT = 11
+
+FACING_MASK = 0b11
+FACE_MASK = 0b1111111
+DECK_BITS = 7
+
+SUIT_BITS = 2
+JOKER_RANK = len(cards.COMMON_RANKS_LIST_ACE_LOW)
+ACE_HIGH_BIT = 1 << 6
+
+""" Array typecode of unsigned 32 bit integers """
+TYPECODE = 'I'
+
+JOKER = cards.Face(None, None, cards.JOKER, None)
+
+Unpacked = namedtuple('Unpacked',
+                      ['face', 'deck', 'owner_facing', 'other_facing'])
+
+
+def _face_codes():
+    """ The face code of every face in the deck templates, and the reverse """
+    codes = {}
+    for template_name, ace_high in [(cards.ACE_LOW, 0),
+                                    (cards.ACE_HIGH, ACE_HIGH_BIT)]:
+        for face in cards.DECK_TEMPLATES[template_name]:
+            suit = cards.COMMON_SUITS_LIST.index(face.suit)
+            rank = cards.COMMON_RANKS_LIST_ACE_LOW.index(face.rank)
+            # faces other than aces are the same in either template
+            codes.setdefault(face, ace_high | rank << SUIT_BITS | suit)
+    codes[JOKER] = JOKER_RANK << SUIT_BITS
+
+    faces = [None] * (FACE_MASK + 1)
+    for face, code in codes.items():
+        faces[code] = face
+    return codes, faces
+
+
+""" Face to face code, and face code to Face, built once at import """
+FACE_CODES, FACES = _face_codes()
+FACINGS = list(Facing)
+
+
+def pack(face, deck=0, owner_facing=Facing.down, other_facing=Facing.down):
+    """ Pack a card into an integer
+
+    :param face: the cards.Face of the card
+    :param deck: the index of the deck the card came from
+    :param owner_facing: the storage.Facing to the owner of its stack
+    :param other_facing: the storage.Facing to other players
+    :return: the packed card
+    :raise ValueError: if the face is not of a standard deck, or the deck
+        is out of range
+    """
+    if face not in FACE_CODES:
+        raise ValueError('Unable to pack {}'.format(face))
+    if not 0 <= deck < MAX_DECKS:
+        raise ValueError('Deck out of range {}'.format(deck))
+    return (deck << DECK_SHIFT | FACE_CODES[face] << FACE_SHIFT |
+            owner_facing.value << OWNER_FACING_SHIFT |
+            other_facing.value << OTHER_FACING_SHIFT)
+
+
+def unpack(code):
+    """ Reverse of pack
+
+    :return: an Unpacked of the card
+    """
+    return Unpacked(face_of(code), code >> DECK_SHIFT,
+                    FACINGS[code >> OWNER_FACING_SHIFT & FACING_MASK],
+                    FACINGS[code >> OTHER_FACING_SHIFT & FACING_MASK])
+
+
+def face_of(code):
+    """ The cards.Face of a packed card """
+    return FACES[code >> FACE_SHIFT & FACE_MASK]
+
+
+def turned(code, owner_facing=None, other_facing=None):
+    """ A packed card turned to new facings
+
+    :param code: the packed card
+    :param owner_facing: if given, the new storage.Facing to the owner
+    :param other_facing: if given, the new storage.Facing to other players
+    :return: the packed card, turned
+    """
+    if owner_facing is not None:
+        code = (code & ~(FACING_MASK << OWNER_FACING_SHIFT) |
+                owner_facing.value << OWNER_FACING_SHIFT)
+    if other_facing is not None:
+        code = (code & ~(FACING_MASK << OTHER_FACING_SHIFT) |
+                other_facing.value << OTHER_FACING_SHIFT)
+    return code
+
+
+class PackedStack(object):
+    """ A stack of packed cards in an array, index 0 at the top
+
+    Positions follow storage.Card, where position 0 is the top or left.
+    """
+
+    def __init__(self, codes=()):
+        self.codes = array(TYPECODE, codes)
+
+    @staticmethod
+    def deck(template_name=cards.ACE_LOW, decks=1):
+        """ A new stack of standard decks, ordered as cards.DECK_TEMPLATES
+
+        :param template_name: a key of cards.DECK_TEMPLATES
+        :param decks: the number of decks to combine
+        :return: the new stack, face down
+        """
+        return PackedStack(pack(face, deck) for deck in range(decks)
+                           for face in cards.DECK_TEMPLATES[template_name])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(self.codes)
+
+    def __getitem__(self, position):
+        return self.codes[position]
+
+    def __eq__(self, other):
+        return isinstance(other, PackedStack) and self.codes == other.codes
+
+    def faces(self):
+        """ The cards.Face of each card, from the top """
+        return [face_of(code) for code in self.codes]
+
+    def move(self, destination, count=1, start=0, position=None):
+        """ Move cards onto another stack, keeping their order
+
+        :param destination: the PackedStack to move the cards onto
+        :param count: the number of cards to move
+        :param start: the position of the first card to move
+        :param position: where to place them in destination, by default on
+            top
+        """
+        if not 0 <= start <= start + count <= len(self.codes):
+            raise IndexError('Unable to move {} cards from {}'.format(
+                count, start))
+        moving = self.codes[start:start + count]
+        del self.codes[start:start + count]
+        position = 0 if position is None else position
+        destination.codes[position:position] = moving
+
+    def shuffle(self, rng=None):
+        """ Shuffle the cards in place, as commands.shuffle """
+        shuffle(self.codes, rng)
+
+    def cut(self, position):
+        """ Move the cards above position to the bottom """
+        self.codes = self.codes[position:] + self.codes[:position]
+
+    def deal(self, hands, count=1):
+        """ Deal from the top, one card at a time to each hand in turn
+
+        :param hands: the PackedStacks to deal to
+        :param count: the number of cards to deal to each hand
+        """
+        if count * len(hands) > len(self.codes):
+            raise IndexError('Unable to deal {} cards to {} hands'.format(
+                count, len(hands)))
+        for _ in range(count):
+            for hand in hands:
+                self.move(hand)
+
+    def turn(self, position, owner_facing=None, other_facing=None):
+        """ Turn a card to new facings, see turned """
+        self.codes[position] = turned(self.codes[position], owner_facing,
+                                      other_facing)
+
+    def tobytes(self):
+        return self.codes.tobytes()
+
+    @staticmethod
+    def frombytes(data):
+        stack = PackedStack()
+        stack.codes.frombytes(data)
+        return stack
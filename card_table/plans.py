@@ -0,0 +1,175 @@
+""" How SQLite plans the hot queries, to catch a query losing its index
+
+    $ python -m card_table.plans [URL]
+
+Each hot query is built the way the code which runs it builds it, with
+placeholder parameters, and explained with EXPLAIN QUERY PLAN. A step which
+scans a whole table, rather than searching it by an index, is a regression.
+Scans of subqueries, such as those of window functions, are not.
+"""
+import argparse
+import datetime as dt
+import sys
+from collections import OrderedDict
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from card_table import config, queries, storage
+from card_table.storage import Card, Command, Snapshot, Stack
+
+""" name -> function returning a statement, see hot_query """
+HOT_QUERIES = OrderedDict()
+
+_SINCE = dt.datetime(2017, 1, 1)
+
+
+def hot_query(name):
+    def decorator(f):
+        HOT_QUERIES[name] = f
+        return f
+    return decorator
+
+
+@hot_query('cards of a stack by position')
+def cards_of_stack():
+    cards = Card.__table__
+    return select([cards.c.id]).where(cards.c.stack_id == 1).order_by(
+        cards.c.position)
+
+
+@hot_query('stacks of a game by owner and label')
+def stacks_by_owner_and_label():
+    stacks = Stack.__table__
+    return select([stacks]).where(and_(stacks.c.game_id == 1,
+                                       stacks.c.owner_id == 1,
+                                       stacks.c.label == 'hand'))
+
+
+@hot_query('stacks of an owner')
+def stacks_by_owner():
+    stacks = Stack.__table__
+    return select([stacks]).where(stacks.c.owner_id == 1)
+
+
+@hot_query('stacks by label')
+def stacks_by_label():
+    stacks = Stack.__table__
+    return select([stacks]).where(stacks.c.label == 'hand')
+
+
+@hot_query('game state')
+def game_state():
+    stacks = Stack.__table__
+    cards = Card.__table__
+    return select([stacks, cards], use_labels=True).select_from(
+        stacks.outerjoin(cards, cards.c.stack_id == stacks.c.id)).where(
+        stacks.c.game_id == 1).order_by(stacks.c.id, cards.c.position)
+
+
+@hot_query('player view')
+def player_view():
+    return queries.player_view_query(1, 1)
+
+
+@hot_query('cards of a game changed since')
+def changed_cards():
+    stacks = Stack.__table__
+    cards = Card.__table__
+    return select([cards]).select_from(
+        cards.join(stacks, cards.c.stack_id == stacks.c.id)).where(and_(
+            stacks.c.game_id == 1, cards.c.updated_at > _SINCE)).order_by(
+        cards.c.stack_id, cards.c.position)
+
+
+@hot_query('commands of a game after')
+def commands_after():
+    commands = Command.__table__
+    return select([commands]).where(and_(
+        commands.c.game_id == 1, commands.c.id > 1)).order_by(commands.c.id)
+
+
+@hot_query('latest command of a game')
+def latest_command():
+    commands = Command.__table__
+    return select([func.max(commands.c.id)]).where(commands.c.game_id == 1)
+
+
+@hot_query('latest snapshot of a game')
+def latest_snapshot():
+    snapshots = Snapshot.__table__
+    return select([snapshots]).where(and_(
+        snapshots.c.game_id == 1, snapshots.c.command_id <= 1)).order_by(
+        snapshots.c.command_id.desc()).limit(1)
+
+
+class Explain(Executable, ClauseElement):
+    """ EXPLAIN QUERY PLAN of a statement, binding its parameters as the
+    statement itself would """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kw)
+
+
+def explain(conn, statement):
+    """ The steps of the plan of a statement, as SQLite describes them """
+    if conn.dialect.name != 'sqlite':
+        raise ValueError('Query plans are only explained for SQLite')
+    return [row[-1] for row in conn.execute(Explain(statement))]
+
+
+def full_scans(steps):
+    """ The steps which read every row of a table of the models, rather
+    than of a subquery """
+    scans = []
+    for step in steps:
+        words = step.split()
+        if words[0] != 'SCAN' or ' USING ' in step:
+            continue
+        # SQLite before 3.36 writes SCAN TABLE cards, after SCAN cards
+        name = words[2] if words[1] == 'TABLE' else words[1]
+        if name in storage.Base.metadata.tables:
+            scans.append(step)
+    return scans
+
+
+def report(db_engine):
+    """ The plan of every hot query
+
+    :return: an ordered dict of query name to the steps of its plan
+    """
+    with db_engine.connect() as conn:
+        return OrderedDict((name, explain(conn, build()))
+                           for name, build in HOT_QUERIES.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m card_table.plans')
+    parser.add_argument('url', nargs='?',
+                        help='the database to explain, by default an empty '
+                             'database of the current models')
+    args = parser.parse_args(argv)
+
+    url = args.url or config.settings('database', {'url': ''})['url']
+    db_engine = storage.build_engine(url or 'sqlite:///:memory:')
+    if not url:
+        storage.sync(db_engine)
+
+    regressions = 0
+    for name, steps in report(db_engine).items():
+        print(name)
+        for step in steps:
+            flag = '!' if full_scans([step]) else ' '
+            print('  {} {}'.format(flag, step))
+        regressions += len(full_scans(steps))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+""" Where the time of each request goes, see ProfilingMiddleware """
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Timing(object):
+    """ The phases of one request, and the SQL statements it executed """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        """ phase name -> seconds, in the order first entered """
+        self.phases = OrderedDict()
+        self.statements = 0
+        self.sql = 0.0
+        self.commit_start = None
+        # when the other middleware were entered, and the responder left
+        self.mark = None
+        self.responded = None
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total):
+        """ The value of a Server-Timing header, durations in milliseconds """
+        metrics = ['{};dur={:.3f}'.format(name, seconds * 1000)
+                   for name, seconds in self.phases.items()]
+        metrics.append('db;dur={:.3f};desc="{} queries"'.format(
+            self.sql * 1000, self.statements))
+        metrics.append('total;dur={:.3f}'.format(total * 1000))
+        return ', '.join(metrics)
+
+
+def current():
+    """ The Timing of the request being handled by this thread, if any """
+    return getattr(_local, 'timing', None)
+
+
+@contextmanager
+def phase(name):
+    """ Time a phase of the current request, if it is being profiled """
+    timing = current()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start)
+
+
+class ProfilingMiddleware(object):
+    """ Server-Timing, SQL accounting, slow request logs and sampled cProfile
+
+    Use around() to place it on either side of the other middleware, so
+    that parsing the request body and serializing the response are timed
+    as phases of their own. Phases timed elsewhere, such as by
+    commands.execute, are added with phase(). Statements are counted and
+    timed for every engine, and commits for every session.
+
+    :param server_timing: whether to send the Server-Timing header
+    :param slow_ms: requests taking this long or longer are slow
+    :param slow_sample: the fraction of slow requests to log
+    :param profile_sample: the fraction of requests to run under cProfile
+    :param profile_limit: the number of functions to log from a profile
+    """
+
+    def __init__(self, server_timing=True, slow_ms=500, slow_sample=1.0,
+                 profile_sample=0.0, profile_limit=25):
+        self.server_timing = server_timing
+        self.slow_ms = slow_ms
+        self.slow_sample = slow_sample
+        self.profile_sample = profile_sample
+        self.profile_limit = profile_limit
+        self.random = random.Random()
+        listen()
+
+    def around(self, middleware):
+        """ The middleware, with this on the outside and a marker inside """
+        return [self] + list(middleware) + [_InnerMarker()]
+
+    def process_request(self, req, resp):
+        _local.timing = Timing()
+        _local.profile = None
+        if self.profile_sample and self.random.random() < self.profile_sample:
+            _local.profile = cProfile.Profile()
+            _local.profile.enable()
+
+    def process_resource(self, req, resp, resource, params):
+        timing = current()
+        if timing is not None:
+            timing.mark = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        timing = current()
+        if timing is None:
+            return
+        profile = _local.profile
+        _local.timing = _local.profile = None
+        if profile is not None:
+            profile.disable()
+
+        if timing.responded is not None:
+            timing.add('serialize', time.perf_counter() - timing.responded)
+        total = timing.elapsed()
+        header = timing.server_timing(total)
+        if self.server_timing:
+            resp.set_header('Server-Timing', header)
+
+        if (total * 1000 >= self.slow_ms and
+                self.random.random() < self.slow_sample):
+            LOG.warning('Slow request %s %s %s: %s', req.method, req.path,
+                        resp.status, header)
+        if profile is not None:
+            LOG.info('Profile of %s %s:\n%s', req.method, req.path,
+                     profile_report(profile, self.profile_limit))
+
+
+class _InnerMarker(object):
+    """ Marks the phases between the other middleware and the responder """
+
+    def process_resource(self, req, resp, resource, params):
+        timing = current()
+        if timing is not None and timing.mark is not None:
+            timing.add('parse', time.perf_counter() - timing.mark)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        timing = current()
+        if timing is not None:
+            timing.responded = time.perf_counter()
+
+
+def profile_report(profile, limit):
+    """ The functions of a profile taking the most cumulative time """
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(
+        limit)
+    return out.getvalue()
+
+
+def listen():
+    """ Account for the statements of every engine and commits of every
+    session, once """
+    for target, name, listener in [
+            (Engine, 'before_cursor_execute', _before_execute),
+            (Engine, 'after_cursor_execute', _after_execute),
+            (Session, 'before_commit', _before_commit),
+            (Session, 'after_commit', _after_commit)]:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, many):
+    if current() is not None and context is not None:
+        context._profiling_start = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, many):
+    timing = current()
+    start = getattr(context, '_profiling_start', None)
+    if timing is not None and start is not None:
+        timing.statements += 1
+        timing.sql += time.perf_counter() - start
+
+
+def _before_commit(session):
+    timing = current()
+    if timing is not None:
+        timing.commit_start = time.perf_counter()
+
+
+def _after_commit(session):
+    timing = current()
+    if timing is not None and timing.commit_start is not None:
+        timing.add('commit', time.perf_counter() - timing.commit_start)
+        timing.commit_start = None
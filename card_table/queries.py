@@ -0,0 +1,290 @@
+""" Read side of the CQRS split: denormalized views of the table state """
+import base64
+import binascii
+import datetime as dt
+import json
+
+from sqlalchemy import and_, case, func, literal, or_, select
+
+from card_table.storage import Card, Command, Facing, Game, Stack
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+""" The most commands a client may be behind and still be sent a diff """
+MAX_DIFF_COMMANDS = 100
+CURSOR_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']
+""" Columns of a card withheld from a player it is face down to. The id is
+withheld too: the ids of a new deck follow the order of its template, so
+they would reveal the faces. """
+FACE_COLUMNS = ['id', 'suit', 'suit_value', 'rank', 'rank_value']
+
+
+def game_state(conn, game_id):
+    """ Snapshot of a game, its stacks and the ordered cards of each stack
+
+    Served by two queries: one for the game, and one joining the stacks of
+    the game to their cards.
+
+    :param conn: the connection to use
+    :param game_id: the game to describe
+    :return: a dict of the game with its stacks, or None if no such game
+    """
+    games = Game.__table__
+    game = conn.execute(select([games]).where(games.c.id == game_id)).first()
+    if game is None:
+        return None
+
+    stacks = Stack.__table__
+    cards = Card.__table__
+    statement = select([stacks, cards], use_labels=True).select_from(
+        stacks.outerjoin(cards, cards.c.stack_id == stacks.c.id)).where(
+        stacks.c.game_id == game_id).order_by(stacks.c.id, cards.c.position)
+
+    result = serialize(Game, games, game)
+    result['stacks'] = []
+    stack = None
+    for row in conn.execute(statement):
+        if stack is None or stack['id'] != row[stacks.c.id]:
+            stack = serialize(Stack, stacks, row)
+            stack['cards'] = []
+            result['stacks'].append(stack)
+        if row[cards.c.id] is not None:
+            stack['cards'].append(serialize(Card, cards, row))
+    return result
+
+
+def player_view(conn, game_id, player_id):
+    """ A game as one of its players may see it, in one query
+
+    Each card is seen by the owner of its stack as its owner_facing says,
+    and by everyone else as its other_facing says; the face and the id of a
+    card seen face down are withheld. Other than the owner, players see only
+    the top size_visibility cards of a stack, and its size counted as far.
+    Window functions number the cards of each stack and count them, so the
+    cards a player may not see are never sent from the database.
+
+    :param conn: the connection to use
+    :param game_id: the game to describe
+    :param player_id: the owner_id of the player viewing the game
+    :return: a dict of the game with its stacks, each with the visible size
+        and cards, or None if no such game
+    """
+    games = Game.__table__
+    stacks = Stack.__table__
+    cards = Card.__table__
+    result = None
+    stack = None
+    for row in conn.execute(player_view_query(game_id, player_id)):
+        if result is None:
+            result = serialize(Game, games, _unlabel(games, 'games_', row))
+            result['stacks'] = []
+        if row.stacks_id is None:
+            continue
+        if stack is None or stack['id'] != row.stacks_id:
+            stack = serialize(Stack, stacks, _unlabel(stacks, 'stacks_', row))
+            stack['size'] = row.visible_size
+            stack['cards'] = []
+            result['stacks'].append(stack)
+        if row.shown:
+            stack['cards'].append(
+                serialize(Card, cards, _unlabel(cards, 'cards_', row)))
+    return result
+
+
+def player_view_query(game_id, player_id):
+    """ The statement of player_view
+
+    Each row has the columns of a game, a stack and a card, labelled with
+    the name of their table, and the depth of the card in the stack, the
+    visible_size of the stack and whether the card is shown at all. The
+    first row of each stack is included for the stack, shown or not, and
+    a game without stacks has one row.
+    """
+    games = Game.__table__
+    stacks = Stack.__table__
+    cards = Card.__table__
+
+    is_owner = stacks.c.owner_id == literal(player_id)
+    face_down = case([(is_owner, cards.c.owner_facing == Facing.down)],
+                     else_=cards.c.other_facing == Facing.down)
+    depth = func.row_number().over(partition_by=stacks.c.id,
+                                   order_by=cards.c.position)
+    size = func.count(cards.c.id).over(partition_by=stacks.c.id)
+    unlimited = or_(is_owner, stacks.c.size_visibility.is_(None))
+
+    columns = [c.label('games_' + c.name) for c in games.columns]
+    columns += [c.label('stacks_' + c.name) for c in stacks.columns]
+    columns += [(case([(face_down, None)], else_=c)
+                 if c.name in FACE_COLUMNS else c).label('cards_' + c.name)
+                for c in cards.columns]
+    columns += [
+        depth.label('depth'),
+        case([(unlimited, size),
+              (size < stacks.c.size_visibility, size)],
+             else_=stacks.c.size_visibility).label('visible_size'),
+        and_(cards.c.id.isnot(None),
+             or_(unlimited, depth <= stacks.c.size_visibility)).label(
+            'shown')]
+    ranked = select(columns).select_from(
+        games.outerjoin(stacks, stacks.c.game_id == games.c.id).outerjoin(
+            cards, cards.c.stack_id == stacks.c.id)).where(
+        games.c.id == game_id).alias('ranked')
+
+    return select([ranked]).where(
+        or_(ranked.c.shown, ranked.c.depth == 1)).order_by(
+        ranked.c.stacks_id, ranked.c.depth)
+
+
+def _unlabel(table, prefix, row):
+    """ The values of the columns of table in a row of prefixed labels """
+    return {column: row[prefix + column.name] for column in table.columns}
+
+
+def game_changes(conn, game_id, since, max_commands=MAX_DIFF_COMMANDS):
+    """ What changed in a game after one of its commands
+
+    Records are found by the updated_at indexes, as those updated after the
+    command was recorded. The changes made by a command are written before
+    the command itself, so its own changes are not included. Deleted records
+    are not reported.
+
+    :param conn: the connection to use
+    :param game_id: the game to describe
+    :param since: the id of the last command the client has seen
+    :param max_commands: the most commands since may be behind by
+    :return: a dict of the changed game, stacks and cards, or None if since
+        is not a command of the game, or is too far behind for a diff
+    """
+    commands = Command.__table__
+    of_game = commands.c.game_id == game_id
+    changed_after = conn.execute(select([commands.c.created_at]).where(
+        and_(of_game, commands.c.id == since))).scalar()
+    if changed_after is None:
+        return None
+    behind, command_id = conn.execute(
+        select([func.count(), func.max(commands.c.id)]).where(
+            and_(of_game, commands.c.id > since))).first()
+    if behind > max_commands:
+        return None
+
+    games = Game.__table__
+    stacks = Stack.__table__
+    cards = Card.__table__
+    game = conn.execute(select([games]).where(and_(
+        games.c.id == game_id, games.c.updated_at > changed_after))).first()
+    changed_stacks = conn.execute(select([stacks]).where(and_(
+        stacks.c.game_id == game_id,
+        stacks.c.updated_at > changed_after)).order_by(stacks.c.id))
+    changed_cards = conn.execute(select([cards]).select_from(
+        cards.join(stacks, cards.c.stack_id == stacks.c.id)).where(and_(
+            stacks.c.game_id == game_id,
+            cards.c.updated_at > changed_after)).order_by(
+        cards.c.stack_id, cards.c.position))
+
+    if game is not None:
+        game = serialize(Game, games, game)
+    return {'id': int(game_id),
+            'since': since,
+            'command_id': command_id or since,
+            'game': game,
+            'stacks': [serialize(Stack, stacks, row)
+                       for row in changed_stacks],
+            'cards': [serialize(Card, cards, row) for row in changed_cards]}
+
+
+def latest_command_id(conn, game_id):
+    """ The id of the latest command of the game, or 0 if none """
+    table = Command.__table__
+    return conn.execute(select([func.max(table.c.id)]).where(
+        table.c.game_id == game_id)).scalar() or 0
+
+
+def validators(conn, model, record_id):
+    """ The version and last modification of a record, by a lookup of the
+    primary key
+
+    :param conn: the connection to use
+    :param model: the model class, with version, updated_at and id columns
+    :param record_id: the record to look up
+    :return: a row of version and updated_at, or None if no such record
+    """
+    table = model.__table__
+    return conn.execute(select([table.c.version, table.c.updated_at]).where(
+        table.c.id == record_id)).first()
+
+
+def keyset_order(model):
+    """ Order of a keyset paginated query of model, see after_cursor """
+    return [model.updated_at, model.id]
+
+
+def after_cursor(model, cursor):
+    """ Criterion for the rows of model after the one a cursor refers to
+
+    Rows are ordered by updated_at and then id, which the index on
+    updated_at serves, so each page is a range scan rather than an offset.
+
+    :param model: the model class, with updated_at and id columns
+    :param cursor: a cursor from encode_cursor
+    :return: the criterion to filter by
+    """
+    updated_at, record_id = decode_cursor(cursor)
+    return or_(model.updated_at > updated_at,
+               and_(model.updated_at == updated_at, model.id > record_id))
+
+
+def encode_cursor(updated_at, record_id):
+    """ An opaque cursor referring to a row, for keyset pagination """
+    text = json.dumps([updated_at.isoformat(), record_id])
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ Reverse of encode_cursor
+
+    :raise ValueError: if the cursor is not valid
+    """
+    try:
+        iso, record_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+
+    for datetime_format in CURSOR_FORMATS:
+        try:
+            return dt.datetime.strptime(iso, datetime_format), int(record_id)
+        except (ValueError, TypeError):
+            pass
+    raise ValueError('Invalid cursor {}'.format(cursor))
+
+
+def serialize_record(model, record):
+    """ Serialize the columns of a persistent object, as the REST API would
+
+    :param model: the model class of the record
+    :param record: the persistent object
+    :return: a new dict of the serialized columns
+    """
+    table = model.__table__
+    row = {column: getattr(record, column.key) for column in table.columns}
+    return serialize(model, table, row)
+
+
+def serialize(model, table, row):
+    """ Serialize the columns of table found in row, as the REST API would
+
+    :param model: the model class, which may implement serialize_specials
+    :param table: the table of the model
+    :param row: a result row containing the columns of table
+    :return: a new dict of the serialized columns
+    """
+    thing = {}
+    for column in table.columns:
+        value = row[column]
+        if isinstance(value, dt.datetime):
+            value = value.strftime(DATETIME_FORMAT)
+        thing[column.key] = value
+
+    specials = getattr(model, 'serialize_specials', None)
+    if specials:
+        specials(thing)
+    return thing
@@ -0,0 +1,220 @@
+""" Rebuilds the state of a game by folding its command log, in order """
+import json
+
+import falcon
+
+import card_table.cards as cards
+from card_table.commands import (CREATE_DECK, DRAW_FROM, MOVE_CARDS, NOOP,
+                                 REGISTRY, register_fold, shoe_face,
+                                 SHUFFLE_STACK, VERSION)
+from card_table.storage import Command, Snapshot
+
+""" Commands after the latest snapshot of a game which make another one due,
+see take_snapshot_if_due """
+SNAPSHOT_INTERVAL = 100
+
+""" Order of the properties in a compact snapshot """
+CARD_PROPERTIES = ['stack_id', 'position', 'owner_facing', 'other_facing',
+                   'suit', 'suit_value', 'rank', 'rank_value']
+SHOE_PROPERTIES = ['template', 'size', 'seed', 'cursor']
+
+
+class TableState(object):
+    """ The cards of a game, in memory, as of one of its commands
+
+    Only what commands changed is known. A card created outside of the
+    command log is known only by the properties commands changed.
+    """
+
+    def __init__(self, command_id=None, cards=None, shoes=None):
+        # the last command folded into the state
+        self.command_id = command_id
+        # card id to a dict of CARD_PROPERTIES
+        self.cards = cards or {}
+        # virtual shoe stack id to a dict of SHOE_PROPERTIES
+        self.shoes = shoes or {}
+
+    def apply(self, command):
+        """ Fold a command into the state
+
+        :param command: the next command of the game
+        :raise ValueError: if no fold is registered for the operation of the
+            command, see commands.register_fold, if its changes are not valid
+            for the operation, or if it cannot be folded into the state, such
+            as a command recorded before its effects were
+        """
+        registered = REGISTRY.get(command.operation)
+        if registered is None or registered.fold is None:
+            raise ValueError('Unable to replay {}'.format(command.operation))
+        changes = command.changes or {}
+        if not isinstance(changes, dict):
+            raise ValueError('Unable to replay command {}'.format(command.id))
+        try:
+            changes = registered.validate(changes)
+        except falcon.HTTPError as error:
+            raise ValueError('Unable to replay command {}: {}'.format(
+                command.id, error.description))
+
+        try:
+            registered.fold(self, changes, command.effects or {})
+        except (KeyError, TypeError) as error:
+            raise ValueError('Unable to replay command {}: {!r}'.format(
+                command.id, error))
+        self.command_id = command.id
+
+    @register_fold(CREATE_DECK)
+    def _create_deck(self, changes, effects):
+        template_name = cards.ACE_LOW
+        if changes.get('ace') == 'high':
+            template_name = cards.ACE_HIGH
+        template = cards.DECK_TEMPLATES[template_name]
+        deck = template * changes.get('decks', 1)
+        stack_id = changes['stack_id']
+
+        if changes.get('virtual'):
+            self.shoes[stack_id] = {'template': template_name,
+                                    'size': len(deck),
+                                    'seed': effects['shoe_seed'],
+                                    'cursor': 0}
+            return
+
+        first_id = effects['first_card_id']
+        for position, face in enumerate(deck):
+            self.cards[first_id + position] = _new_card(
+                face, stack_id=stack_id, position=position)
+
+    @register_fold(MOVE_CARDS)
+    def _move_cards(self, changes, effects):
+        drawn_ids = iter(effects.get('drawn_ids', []))
+        for props in changes['cards']:
+            if DRAW_FROM in props:
+                shoe = self.shoes[props[DRAW_FROM]]
+                face = shoe_face(shoe['template'], shoe['seed'],
+                                 shoe['size'], shoe['cursor'])
+                shoe['cursor'] += 1
+                values = {k: v for k, v in props.items() if k != DRAW_FROM}
+                self.cards[next(drawn_ids)] = _new_card(face, **values)
+            else:
+                card = self.cards.setdefault(props['id'], {})
+                # the version a move expected is not a change to the card
+                card.update((k, v) for k, v in props.items()
+                            if k not in ('id', VERSION))
+
+    @register_fold(NOOP)
+    def _noop(self, changes, effects):
+        pass
+
+    @register_fold(SHUFFLE_STACK)
+    def _shuffle_stack(self, changes, effects):
+        for position, card_id in enumerate(effects.get('card_ids', [])):
+            card = self.cards.setdefault(card_id, {})
+            card.update(stack_id=changes['stack_id'], position=position)
+
+    def as_dict(self, secrets=False):
+        """ The state for a response
+
+        :param secrets: whether to include the seeds of virtual shoes
+        :return: a new dict of the state
+        """
+        shoes = []
+        for stack_id, shoe in sorted(self.shoes.items()):
+            shoe = dict(shoe, stack_id=stack_id)
+            if not secrets:
+                del shoe['seed']
+            shoes.append(shoe)
+        return {'command_id': self.command_id,
+                'cards': [dict(card, id=card_id)
+                          for card_id, card in sorted(self.cards.items())],
+                'shoes': shoes}
+
+    def dumps(self):
+        """ Compact serialization, for snapshots """
+        return json.dumps({
+            'command_id': self.command_id,
+            'cards': [[card_id] + [card.get(p) for p in CARD_PROPERTIES]
+                      for card_id, card in self.cards.items()],
+            'shoes': [[stack_id] + [shoe[p] for p in SHOE_PROPERTIES]
+                      for stack_id, shoe in self.shoes.items()]},
+            separators=(',', ':'))
+
+    @staticmethod
+    def loads(text):
+        """ Reverse of dumps """
+        data = json.loads(text)
+        return TableState(
+            command_id=data['command_id'],
+            cards={row[0]: {p: v for p, v in zip(CARD_PROPERTIES, row[1:])
+                            if v is not None}
+                   for row in data['cards']},
+            shoes={row[0]: dict(zip(SHOE_PROPERTIES, row[1:]))
+                   for row in data['shoes']})
+
+
+def state_as_of(db_session, game_id, command_id=None):
+    """ The state of a game as of one of its commands
+
+    Starts from the latest snapshot at or before command_id and folds only
+    the commands after it. Nothing is written.
+
+    :param db_session: db session to use
+    :param game_id: the game to replay
+    :param command_id: the last command to fold, defaults to the latest
+    :return: the TableState
+    :raise ValueError: if a command cannot be folded, see TableState.apply
+    """
+    snapshot = Snapshot.find_latest(game_id, db_session, until=command_id)
+    state = TableState()
+    if snapshot:
+        state = TableState.loads(snapshot.state)
+
+    commands = Command.find_by_game(game_id, db_session,
+                                    after=state.command_id, until=command_id)
+    for command in commands.yield_per(500):
+        state.apply(command)
+    return state
+
+
+def take_snapshot_if_due(db_session, game_id, interval=SNAPSHOT_INTERVAL):
+    """ Add a snapshot of a game to db_session, if interval commands follow
+    its latest snapshot
+
+    Called as commands are written, so that a replay never folds many more
+    than interval commands. The caller should commit.
+
+    :param db_session: db session to use
+    :param game_id: the game to snapshot
+    :param interval: commands after the latest snapshot which make a new one
+        due
+    :return: the new Snapshot, or None if none is due
+    :raise ValueError: if a command cannot be folded, see TableState.apply
+    """
+    latest = Snapshot.find_latest(game_id, db_session)
+    after = latest.command_id if latest else None
+    behind = Command.find_by_game(game_id, db_session, after=after).order_by(
+        None).count()
+    if behind < interval:
+        return None
+    return take_snapshot(db_session, game_id, state_as_of(db_session,
+                                                          game_id))
+
+
+def take_snapshot(db_session, game_id, state):
+    """ Add a snapshot of the state to db_session
+
+    :param db_session: db session to use
+    :param game_id: the game of the state
+    :param state: the TableState to snapshot
+    :return: the new Snapshot
+    """
+    snapshot = Snapshot(game_id=game_id, command_id=state.command_id,
+                        state=state.dumps())
+    db_session.add(snapshot)
+    return snapshot
+
+
+def _new_card(face, **values):
+    card = {'owner_facing': 'down', 'other_facing': 'down',
+            'suit': face.suit, 'suit_value': face.suit_value,
+            'rank': face.rank, 'rank_value': face.rank_value}
+    card.update(values)
+    return card
@@ -0,0 +1,84 @@
+""" Parameter schemas of commands, compiled once into validators
+
+A schema is a dict of parameter name to a Param, as built by the functions
+below. compile_schema turns it into a function which checks the changes of
+a command, raising the same falcon errors as the helpers of common.
+"""
+from collections import namedtuple
+
+import falcon
+
+""" How to check one parameter
+
+check: a function of (name, value) which raises if the value is invalid
+required: whether the parameter must be present
+default: the value used when the parameter is absent, unless None
+"""
+Param = namedtuple('Param', ['check', 'required', 'default'])
+
+
+def integer(required=False, default=None, minimum=None, maximum=None):
+    """ An integer parameter, optionally bounded """
+    def check(name, value):
+        if (not isinstance(value, int) or isinstance(value, bool) or
+                (minimum is not None and value < minimum) or
+                (maximum is not None and value > maximum)):
+            raise falcon.HTTPInvalidParam(msg=value, param_name=name)
+    return Param(check, required, default)
+
+
+def boolean(default=None):
+    """ A true or false parameter """
+    def check(name, value):
+        if not isinstance(value, bool):
+            raise falcon.HTTPInvalidParam(msg=value, param_name=name)
+    return Param(check, False, default)
+
+
+def choice(choices, required=False, default=None):
+    """ A parameter which is one of a fixed set of values """
+    choices = frozenset(choices)
+
+    def check(name, value):
+        if value not in choices:
+            raise falcon.HTTPInvalidParam(msg=value, param_name=name)
+    return Param(check, required, default)
+
+
+def objects(required=False):
+    """ A non-empty list of dicts """
+    def check(name, value):
+        if (not value or not isinstance(value, list) or
+                not all(isinstance(item, dict) for item in value)):
+            raise falcon.HTTPInvalidParam(msg='Expected a list of objects',
+                                          param_name=name)
+    return Param(check, required, None)
+
+
+def compile_schema(schema):
+    """ Compile a schema into a validator of the changes of a command
+
+    Parameters which are not in the schema are passed through unchecked.
+
+    :param schema: dict of parameter name to Param
+    :return: a function of the changes, returning them with the defaults of
+        any absent parameters filled in
+    """
+    required = frozenset(name for name, param in schema.items()
+                         if param.required)
+    checks = tuple((name, param.check) for name, param in sorted(
+        schema.items()))
+    defaults = {name: param.default for name, param in schema.items()
+                if param.default is not None}
+
+    def validate(changes):
+        if not required.issubset(changes):
+            missing = sorted(required.difference(changes))
+            raise falcon.HTTPMissingParam(param_name=missing[0])
+        for name, check in checks:
+            if name in changes:
+                check(name, changes[name])
+        if defaults:
+            return dict(defaults, **changes)
+        return changes
+    return validate
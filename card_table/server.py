@@ -1,17 +1,108 @@
 from falcon_autocrud.middleware import Middleware
-from sqlalchemy import create_engine
 
-from card_table import api, storage
+from card_table import (api, config, logs, migrations, profiling, shards,
+                        storage)
+
+""" Database settings, see config.settings and storage.build_engine """
+DATABASE = {'url': 'sqlite:///:memory:',
+            'pool_size': 5,
+            'max_overflow': 10,
+            'pool_timeout': 30,
+            'pool_recycle': -1,
+            'pool_pre_ping': True,
+            'shared_cache': False,
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 268435456,
+            'cache_size': -16000,
+            'busy_timeout': 5000}
+
+
+""" Read only connection pools for GET requests, one per database, beside
+the pools of the database settings, see storage.build_engine. Only for file
+backed SQLite databases. """
+READER = {'enabled': False,
+          'pool_size': 10,
+          'max_overflow': 10}
+
+
+""" Databases to spread games over beside the one of the database settings,
+see shards.ShardRouter. A comma separated list of urls, each built with the
+other database settings; append to it, never reorder it. """
+SHARDS = {'urls': ''}
+
+
+""" Command settings. allow_seeds lets clients choose the seeds of shuffles,
+and so the order of the cards, for tests only, see commands.execute """
+COMMANDS = {'allow_seeds': False}
+
+
+""" Logging settings, see logs.configure """
+LOGGING = {'level': 'INFO',
+           'format': 'text',
+           'queue_size': 10000,
+           'sampled': 'sqlalchemy.engine',
+           'sample_rate': 0.01,
+           'level_signal': ''}
+
+
+""" Request profiling settings, see profiling.ProfilingMiddleware """
+PROFILING = {'enabled': False,
+             'server_timing': True,
+             'slow_ms': 500,
+             'slow_sample': 1.0,
+             'profile_sample': 0.0,
+             'profile_limit': 25}
+
+
+""" Health check settings, see health.HealthMonitor """
+HEALTH = {'ttl': 1.0,
+          'max_latency_ms': 250.0,
+          'max_saturation': 0.9,
+          'stale_after': 3.0}
 
 
 def middleware():
-    return [Middleware()]
+    components = [Middleware()]
+    settings = config.settings('profiling', PROFILING)
+    if settings.pop('enabled'):
+        components = profiling.ProfilingMiddleware(**settings).around(
+            components)
+    return components
 
 
-def engine():
-    db_engine = create_engine("sqlite:///:memory:")
-    storage.sync(db_engine)
+def engine(url=None):
+    settings = config.settings('database', DATABASE)
+    if url:
+        settings['url'] = url
+    db_engine = storage.build_engine(**settings)
+    migrations.migrate(db_engine)
     return db_engine
 
 
-application = api.create_api(middleware(), engine())
+def reader(url=None):
+    settings = config.settings('database', DATABASE)
+    reads = config.settings('reader', READER)
+    del reads['enabled']
+    settings.update(reads, read_only=True)
+    if url:
+        settings['url'] = url
+    return storage.build_engine(**settings)
+
+
+def router():
+    urls = config.settings('shards', SHARDS)['urls'].split(',')
+    urls = [None] + [url.strip() for url in urls if url.strip()]
+    engines = [engine(url) for url in urls]
+    readers = None
+    if config.settings('reader', READER)['enabled']:
+        readers = [reader(url) for url in urls]
+    db_router = shards.ShardRouter(engines, readers)
+    db_router.prepare()
+    return db_router
+
+
+logs.configure(**config.settings('logging', LOGGING))
+application = api.create_api(
+    middleware(), router(), config.settings('health', HEALTH),
+    allow_seeds=config.settings('commands', COMMANDS)['allow_seeds'])
@@ -0,0 +1,304 @@
+""" Games spread over several databases, see ShardRouter """
+import itertools
+
+from sqlalchemy import text
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import (BinaryExpression, BindParameter,
+                                     BooleanClauseList, UnaryExpression)
+from sqlalchemy.sql.schema import Column
+
+from card_table.storage import Card, Command, Game, Snapshot, Stack
+
+""" The number of ids of each table given to each shard """
+BLOCK = 2 ** 40
+
+""" Keys the shard a session is pinned to, in session.info, see pin """
+PINNED = 'card_table.shard'
+""" Keys the shard of the games a session creates, in session.info """
+NEW_GAMES = 'card_table.shard.new_games'
+
+""" model -> the attribute naming the record whose shard it belongs in """
+PARENTS = {Stack: 'game_id', Card: 'stack_id', Command: 'game_id',
+           Snapshot: 'game_id'}
+
+TABLES = [model.__table__ for model in (Game, Stack, Card, Command,
+                                        Snapshot)]
+
+
+class ShardRouter(object):
+    """ Maps each game, and every record of it, to one of several engines
+
+    Shard n gives out the ids of its tables from block n, ids n * BLOCK + 1
+    up to (n + 1) * BLOCK, so that the shard of any record follows from its
+    id, and the shard of a stack, card or command from the id of its game.
+    New games are dealt to the shards in turn. Each shard being a database
+    of its own, writes to the games of different shards never wait on one
+    another.
+
+    The order of the engines is fixed once games are stored: shards may be
+    added at the end, but never removed or reordered. A router of a single
+    engine routes everything to it, as if there were no shards.
+
+    Each shard may also have an engine of its own for reads, such as a read
+    only pool of the same SQLite file, see storage.build_engine, so that
+    reads never wait for a connection behind writes.
+
+    :param engines: the engine of each shard, in order
+    :param readers: the engine to read each shard with, by default its
+        engine
+    """
+
+    def __init__(self, engines, readers=None):
+        self.engines = list(engines)
+        if not self.engines:
+            raise ValueError('At least one shard is required')
+        self.readers = list(readers or self.engines)
+        if len(self.readers) != len(self.engines):
+            raise ValueError('Each shard needs one reader')
+        self._dealt = itertools.count()
+
+    @property
+    def sharded(self):
+        return len(self.engines) > 1
+
+    def shard_of(self, record_id):
+        """ The shard holding the record of an id, or None if no shard
+        would give out the id """
+        try:
+            shard_id = (int(record_id) - 1) // BLOCK
+        except (TypeError, ValueError):
+            return None
+        return shard_id if 0 <= shard_id < len(self.engines) else None
+
+    def engine_for(self, record_id):
+        """ The engine of the shard of a record, or of a game
+
+        Ids no shard gives out are looked up, in vain, in the first shard.
+        """
+        return self.engines[self.shard_of(record_id) or 0]
+
+    def reader_for(self, record_id):
+        """ The engine to read the shard of a record, or of a game, with """
+        return self.readers[self.shard_of(record_id) or 0]
+
+    def deal(self):
+        """ The shard to create the next new game in """
+        return next(self._dealt) % len(self.engines)
+
+    def shards_for_query(self, query):
+        """ The shards a query may find rows in
+
+        Those of the ids the query is filtered by, where it is filtered by
+        a primary or foreign key, else every shard.
+        """
+        session = query.session
+        if session is not None and session.info.get(PINNED) is not None:
+            return [session.info[PINNED]]
+
+        found = None
+        for clause in _conjuncts(query._criterion):
+            ids = _key_values(clause, query._params)
+            if ids is None:
+                continue
+            shards = {self.shard_of(record_id) for record_id in ids}
+            shards.discard(None)
+            found = shards if found is None else found & shards
+        if found is None:
+            return list(range(len(self.engines)))
+        return sorted(found)
+
+    def shards_for_ids(self, query, ident):
+        shard_id = self.shard_of(ident[0])
+        return [] if shard_id is None else [shard_id]
+
+    def sessionmaker(self, bind=None, **kwargs):
+        """ A session factory routing each record to its shard, for
+        autocrud's sessionmaker_ """
+        return self._sessionmaker(self.engines, **kwargs)
+
+    def reader_sessionmaker(self, bind=None, **kwargs):
+        """ As sessionmaker, of sessions reading with the readers """
+        return self._sessionmaker(self.readers, **kwargs)
+
+    def _sessionmaker(self, engines, **kwargs):
+        if not self.sharded:
+            return sessionmaker(bind=engines[0], **kwargs)
+        return sessionmaker(class_=ShardSession, router=self,
+                            engines=engines, **kwargs)
+
+    @staticmethod
+    def pin(db_session, shard_id):
+        """ Route every statement of a session to one shard
+
+        For a session executing statements which name no record, such as
+        the bulk UPDATEs of a command, all of which are of one game.
+        """
+        db_session.info[PINNED] = shard_id or 0
+
+    def prepare(self):
+        """ Have each shard give out the ids of its own block, see seed_ids
+        """
+        if not self.sharded:
+            return
+        for shard_id, db_engine in enumerate(self.engines):
+            seed_ids(db_engine, shard_id)
+
+
+class ShardSession(ShardedSession):
+    """ A session over every shard of a router
+
+    Each record is written to the shard of its id, or of its parent while
+    it has no id yet, and each query read from the shards it may find rows
+    in, see ShardQuery.
+    """
+
+    def __init__(self, router, engines=None, **kwargs):
+        kwargs.pop('bind', None)
+        super(ShardSession, self).__init__(
+            self.choose_shard, router.shards_for_ids,
+            router.shards_for_query,
+            shards=dict(enumerate(engines or router.engines)),
+            query_cls=ShardQuery, **kwargs)
+        self.router = router
+
+    def choose_shard(self, mapper, instance, clause=None):
+        if self.info.get(PINNED) is not None:
+            return self.info[PINNED]
+        if instance is None:
+            raise ValueError('No record to choose a shard by, pin the '
+                             'session to the shard of a game first')
+        if instance.id is not None:
+            return self.router.shard_of(instance.id) or 0
+        if isinstance(instance, Game):
+            return self.info.setdefault(NEW_GAMES, self.router.deal())
+        parent = getattr(instance, PARENTS[type(instance)])
+        return self.router.shard_of(parent) or 0
+
+
+class ShardQuery(ShardedQuery):
+    """ A query of several shards, answered as one database would
+
+    The rows of every shard read are put in the order of the query before
+    its offset and limit are applied, and counts are summed.
+    """
+
+    def __iter__(self):
+        if self._shard_id is not None or not (
+                self._order_by or self._limit is not None or
+                self._offset is not None):
+            return super(ShardQuery, self).__iter__()
+
+        offset = self._offset or 0
+        window = None if self._limit is None else offset + self._limit
+        everywhere = self.offset(None).limit(window)
+        rows = []
+        for shard_id in self.query_chooser(self):
+            rows.extend(everywhere.set_shard(shard_id))
+        # stable sorts, from the least significant key
+        for key, descending in reversed(_order_keys(self._order_by or [])):
+            rows.sort(key=lambda row: _nulls_first(getattr(row, key)),
+                      reverse=descending)
+        return iter(rows[offset:window])
+
+    def count(self):
+        if self._shard_id is not None:
+            return super(ShardQuery, self).count()
+        return sum(self.set_shard(shard_id).count()
+                   for shard_id in self.query_chooser(self))
+
+
+def seed_ids(db_engine, shard_id):
+    """ Start the ids of each table of a shard in the block of the shard
+
+    SQLite gives out ids after the greatest in the sqlite_sequence table,
+    for the tables created with AUTOINCREMENT. Safe to repeat.
+
+    The first shard needs no seeding, as the ids of any table start at 1, so
+    a database created before there were shards, whose tables lack
+    AUTOINCREMENT, may be the first shard as it is.
+
+    :raise ValueError: if the shard is not a SQLite database, or is not the
+        first and its tables were created without AUTOINCREMENT
+    """
+    if db_engine.dialect.name != 'sqlite':
+        raise ValueError('Only SQLite databases may be shards')
+    if shard_id == 0:
+        return
+    start = shard_id * BLOCK
+    with db_engine.begin() as conn:
+        if not conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = 'sqlite_sequence'")).first():
+            raise ValueError('The tables of shard {} were created without '
+                             'AUTOINCREMENT'.format(shard_id))
+        for table in TABLES:
+            conn.execute(text(
+                'INSERT INTO sqlite_sequence (name, seq) SELECT :name, 0 '
+                'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence '
+                'WHERE name = :name)'), name=table.name)
+            conn.execute(text(
+                'UPDATE sqlite_sequence SET seq = :start '
+                'WHERE name = :name AND seq < :start'),
+                name=table.name, start=start)
+
+
+def _conjuncts(criterion):
+    """ The clauses a criterion requires all of """
+    if criterion is None:
+        return []
+    if (isinstance(criterion, BooleanClauseList) and
+            criterion.operator is operators.and_):
+        return [part for clause in criterion.clauses
+                for part in _conjuncts(clause)]
+    return [criterion]
+
+
+def _key_values(clause, params):
+    """ The ids a clause requires a primary or foreign key to be one of,
+    or None if it does not """
+    if not isinstance(clause, BinaryExpression):
+        return None
+    column = clause.left
+    if not (isinstance(column, Column) and
+            (column.primary_key or column.foreign_keys)):
+        return None
+    if clause.operator is operators.eq:
+        binds = [clause.right]
+    elif clause.operator is operators.in_op:
+        binds = [element for element in visitors.iterate(clause.right, {})
+                 if isinstance(element, BindParameter)]
+    else:
+        return None
+
+    values = []
+    for bind in binds:
+        if not isinstance(bind, BindParameter):
+            return None
+        value = bind.value if bind.value is not None else params.get(
+            bind.key)
+        if value is None:
+            return None
+        values.append(value)
+    return values
+
+
+def _order_keys(order_by):
+    """ (attribute name, descending) of each column of an ORDER BY """
+    keys = []
+    for clause in order_by:
+        descending = (isinstance(clause, UnaryExpression) and
+                      clause.modifier is operators.desc_op)
+        if isinstance(clause, UnaryExpression):
+            clause = clause.element
+        if not isinstance(clause, Column):
+            # not sortable in memory, leave the rows in the order read
+            return []
+        keys.append((clause.key, descending))
+    return keys
+
+
+def _nulls_first(value):
+    """ A sort key putting NULL first, as SQLite does """
+    return value is not None, value
@@ -1,42 +1,116 @@
 import datetime as dt
 import enum
 import json
+import os
+import sqlite3
+import uuid
+from urllib.request import pathname2url
 
 import logging
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import bindparam, select, Text
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Enum
+from sqlalchemy import bindparam, create_engine, event, exc, select, Text
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
+from sqlalchemy import Enum
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+from sqlalchemy.types import TypeDecorator
 
 Base = declarative_base()
 LOG = logging.getLogger(__name__)
 
+""" Table options for ids which are never reused, and which start from the
+block of a shard, see shards.seed_ids """
+AUTOINCREMENT = {'sqlite_autoincrement': True}
+
+
+class JSONText(TypeDecorator):
+    """ JSON stored compactly as text, decoded once as each row is loaded
+
+    Every value is encoded, strings included, so JSON text must be decoded
+    before it is stored, see commands.load_changes.
+    """
+    impl = Text
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return json.dumps(value, separators=(',', ':'))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return json.loads(value)
+
 
 class Command(Base):
     """ Describes a step of play in a Game """
     __tablename__ = 'commands'
+    __table_args__ = (
+        # the commands of a game, in the order executed
+        Index('ix_commands_game_id_id', 'game_id', 'id'),
+        AUTOINCREMENT)
     id = Column(Integer, primary_key=True)
     game_id = Column(Integer, ForeignKey('games.id'))
     actor_id = Column(Integer)
     operation = Column(String, index=True)
     """ json blob describing the changes made by the command """
-    changes = Column(Text)
+    changes = Column(JSONText)
+    """ json blob of the outcomes needed to replay the command, such as the
+    ids of cards created and the order of a shuffle. Secret, never
+    serialized. """
+    effects = Column(JSONText, nullable=True)
     memo = Column(String, nullable=True)
     created_at = Column(DateTime, default=dt.datetime.utcnow)
-    updated_at = Column(DateTime, default=dt.datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=dt.datetime.utcnow,
+                        onupdate=dt.datetime.utcnow, index=True)
+
+    @staticmethod
+    def find_by_game(game_id, db_session, after=None, until=None):
+        """ Commands of the game in the order executed
+
+        :param after: if given, only commands with an id greater than this
+        :param until: if given, only commands with an id up to this
+        """
+        query = db_session.query(Command).filter(Command.game_id == game_id)
+        if after is not None:
+            query = query.filter(Command.id > after)
+        if until is not None:
+            query = query.filter(Command.id <= until)
+        return query.order_by(Command.id)
 
     @staticmethod
     def protected_properties():
-        return [Command.id, Command.created_at, Command.updated_at]
+        return [Command.id, Command.effects, Command.created_at,
+                Command.updated_at]
 
     @staticmethod
     def immutable_properties():
         return [Command.game_id, Command.actor_id]
 
+    @staticmethod
+    def secret_properties():
+        return [Command.effects]
+
+    @staticmethod
+    def secret_changes():
+        """ Keys of the changes which only the actor may see, such as the
+        seeds which would reveal the order of a shuffle """
+        return ['seed']
+
+    @staticmethod
+    def public_changes(changes):
+        """ A copy of the changes of a command, without secret_changes """
+        if not isinstance(changes, dict):
+            return changes
+        secrets = Command.secret_changes()
+        return {k: v for k, v in changes.items() if k not in secrets}
+
     @staticmethod
     def serialize_specials(item):
+        for prop in Command.secret_properties():
+            item.pop(prop.key, None)
         if 'changes' in item:
-            changes = item['changes'].replace("'", '"')
-            item['changes'] = json.loads(changes)
+            item['changes'] = Command.public_changes(item['changes'])
 
 
 class Facing(enum.Enum):
@@ -51,6 +125,10 @@ class Facing(enum.Enum):
 class Card(Base):
     """ An individual card """
     __tablename__ = 'cards'
+    __table_args__ = (
+        # the cards of a stack, in order
+        Index('ix_cards_stack_id_position', 'stack_id', 'position'),
+        AUTOINCREMENT)
     id = Column(Integer, primary_key=True)
     stack_id = Column(Integer, ForeignKey('stacks.id'))
     """ position == 0 indicates top or left """
@@ -63,20 +141,43 @@ class Card(Base):
     rank = Column(String, nullable=True)
     """ Effective sortable rank """
     rank_value = Column(Integer, nullable=True, default=rank)
+    """ Counts the writes to the record. Each UPDATE through the ORM checks
+    and advances it, raising StaleDataError if another transaction wrote
+    first; bulk UPDATEs do the same, see commands.versioned_update """
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     created_at = Column(DateTime, default=dt.datetime.utcnow)
-    updated_at = Column(DateTime, default=dt.datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=dt.datetime.utcnow,
+                        onupdate=dt.datetime.utcnow, index=True)
+    __mapper_args__ = {'version_id_col': version}
 
     @staticmethod
     def get(record_id, db_session):
         return db_session.query(Card).get(record_id)
 
+    @staticmethod
+    def find_by_ids(record_ids, db_session):
+        return db_session.query(Card).filter(Card.id.in_(record_ids)).all()
+
     @staticmethod
     def find_by_stack(stack_id, db_session):
         return db_session.query(Card).filter(Card.stack_id == stack_id).all()
 
+    @staticmethod
+    def find_ids_by_stack(stack_id, db_session):
+        """ Card ids in the stack, ordered by position """
+        query = db_session.query(Card.id).filter(Card.stack_id == stack_id)
+        return [row.id for row in query.order_by(Card.position)]
+
+    @staticmethod
+    def find_versions_by_stack(stack_id, db_session):
+        """ (id, version) of the cards in the stack, ordered by position """
+        query = db_session.query(Card.id, Card.version).filter(
+            Card.stack_id == stack_id)
+        return [tuple(row) for row in query.order_by(Card.position)]
+
     @staticmethod
     def protected_properties():
-        return [Card.id, Card.created_at, Card.updated_at]
+        return [Card.id, Card.version, Card.created_at, Card.updated_at]
 
     @staticmethod
     def immutable_properties():
@@ -93,13 +194,23 @@ class Card(Base):
 class Stack(Base):
     """ A stack of cards """
     __tablename__ = 'stacks'
+    __table_args__ = (
+        # the stacks of a game, of a player, by label
+        Index('ix_stacks_game_id_owner_id_label', 'game_id', 'owner_id',
+              'label'),
+        AUTOINCREMENT)
     id = Column(Integer, primary_key=True)
     game_id = Column(Integer, ForeignKey('games.id'))
     """ owner_id == 0 : a shared stack, such as a shared draw pile """
+    # also indexed alone, for /stacks?owner_id= and ?label= across games
     owner_id = Column(Integer, index=True)
     label = Column(String, index=True)
+    """ Counts the writes to the record, as Card.version does """
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     created_at = Column(DateTime, default=dt.datetime.utcnow)
-    updated_at = Column(DateTime, default=dt.datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=dt.datetime.utcnow,
+                        onupdate=dt.datetime.utcnow, index=True)
+    __mapper_args__ = {'version_id_col': version}
     # META-PROPERTIES, for use by a game engine to store state
     """ Indicates maximum visible size of the deck to observers.
 
@@ -114,19 +225,67 @@ class Stack(Base):
     size_visibility = Column(Integer, nullable=True)
     """ An actual limit on the number of cards held in a stack. """
     size_limit = Column(Integer, nullable=True)
+    # VIRTUAL SHOE, a draw pile whose cards are not yet stored as rows
+    """ Names the deck template in cards.DECK_TEMPLATES dealt from.
+
+    shoe_template IS NULL : an ordinary stack, not a virtual shoe
+    """
+    shoe_template = Column(String, nullable=True)
+    """ Total number of cards in the shoe, before any are drawn """
+    shoe_size = Column(Integer, nullable=True)
+    """ Seeds the permutation of the shoe, as text. Secret, never serialized.
+    """
+    shoe_seed = Column(String, nullable=True)
+    """ Number of cards drawn from the shoe so far """
+    shoe_cursor = Column(Integer, nullable=True)
 
     @staticmethod
     def get(record_id, db_session):
         return db_session.query(Stack).get(record_id)
 
+    @staticmethod
+    def find_by_ids(record_ids, db_session):
+        return db_session.query(Stack).filter(Stack.id.in_(record_ids)).all()
+
     @staticmethod
     def protected_properties():
-        return [Stack.id, Stack.created_at, Stack.updated_at]
+        return [Stack.id, Stack.version, Stack.created_at, Stack.updated_at,
+                Stack.shoe_template, Stack.shoe_size, Stack.shoe_seed,
+                Stack.shoe_cursor]
 
     @staticmethod
     def immutable_properties():
         return [Stack.game_id]
 
+    @staticmethod
+    def secret_properties():
+        return [Stack.shoe_seed]
+
+    @staticmethod
+    def visible_size(size, size_visibility):
+        """ The size of a stack as observers are allowed to count it """
+        if size_visibility is None:
+            return size
+        return min(size, size_visibility)
+
+    def is_shoe(self):
+        return self.shoe_template is not None
+
+    def shoe_remaining(self):
+        return self.shoe_size - self.shoe_cursor
+
+    @staticmethod
+    def serialize_specials(thing):
+        for prop in Stack.secret_properties():
+            thing.pop(prop.key, None)
+        cursor = thing.pop('shoe_cursor', None)
+        if thing.get('shoe_template') is not None:
+            remaining = thing['shoe_size'] - cursor
+            thing['shoe_remaining'] = Stack.visible_size(
+                remaining, thing.get('size_visibility'))
+            if thing.get('size_visibility') is not None:
+                del thing['shoe_size']
+
 
 class GameState(enum.Enum):
     forming = 0
@@ -141,11 +300,16 @@ class GameState(enum.Enum):
 class Game(Base):
     """ An individual game at a specific table """
     __tablename__ = 'games'
+    __table_args__ = AUTOINCREMENT
     id = Column(Integer, primary_key=True)
     name = Column(String)
     state = Column(Enum(GameState), default=GameState.forming)
+    """ Counts the writes to the record, as Card.version does """
+    version = Column(Integer, nullable=False, default=1, server_default='1')
     created_at = Column(DateTime, default=dt.datetime.utcnow)
-    updated_at = Column(DateTime, default=dt.datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=dt.datetime.utcnow,
+                        onupdate=dt.datetime.utcnow, index=True)
+    __mapper_args__ = {'version_id_col': version}
 
     @staticmethod
     def get(record_id, db_session):
@@ -153,7 +317,7 @@ class Game(Base):
 
     @staticmethod
     def protected_properties():
-        return [Game.id, Game.created_at, Game.updated_at]
+        return [Game.id, Game.version, Game.created_at, Game.updated_at]
 
     @staticmethod
     def immutable_properties():
@@ -165,7 +329,192 @@ class Game(Base):
             thing['state'] = thing['state'].name
 
 
+class Snapshot(Base):
+    """ The folded state of a game as of one of its commands """
+    __tablename__ = 'snapshots'
+    __table_args__ = (
+        # the latest snapshot of a game
+        Index('ix_snapshots_game_id_command_id', 'game_id', 'command_id'),
+        AUTOINCREMENT)
+    id = Column(Integer, primary_key=True)
+    game_id = Column(Integer, ForeignKey('games.id'))
+    """ the last command folded into the state """
+    command_id = Column(Integer, ForeignKey('commands.id'))
+    """ json blob of replay.TableState """
+    state = Column(Text)
+    created_at = Column(DateTime, default=dt.datetime.utcnow)
+
+    @staticmethod
+    def find_latest(game_id, db_session, until=None):
+        """ The latest snapshot of the game, as of command until if given """
+        query = db_session.query(Snapshot).filter(
+            Snapshot.game_id == game_id)
+        if until is not None:
+            query = query.filter(Snapshot.command_id <= until)
+        return query.order_by(Snapshot.command_id.desc()).first()
+
+
+def build_engine(url, pool_size=5, max_overflow=10, pool_timeout=30,
+                 pool_recycle=-1, pool_pre_ping=True, shared_cache=False,
+                 journal_mode='WAL', synchronous='NORMAL', mmap_size=0,
+                 cache_size=-2000, busy_timeout=5000, read_only=False):
+    """ Create an engine for the database at url
+
+    A private in-memory SQLite database is used as is, one per thread. With
+    shared_cache, every connection of the engine shares one in-memory
+    database instead, which is useful for tests. File backed SQLite
+    databases get a sized connection pool and the tuning pragmas below.
+
+    With read_only, the connections of a file backed SQLite database open it
+    for reading only, and leave its journal_mode as the engines writing to
+    it set it. In WAL mode such a pool reads alongside a writer without
+    waiting on it.
+
+    :param url: the database URL
+    :param pool_size: connections kept open in the pool
+    :param max_overflow: connections allowed beyond pool_size under load
+    :param pool_timeout: seconds to wait for a free connection
+    :param pool_recycle: seconds after which connections are replaced
+    :param pool_pre_ping: test connections as they are checked out
+    :param shared_cache: share one in-memory SQLite database per engine
+    :param journal_mode: SQLite journal_mode pragma, for file databases
+    :param synchronous: SQLite synchronous pragma, for file databases
+    :param mmap_size: SQLite mmap_size pragma, bytes of memory mapped I/O
+    :param cache_size: SQLite cache_size pragma, negative values are KiB
+    :param busy_timeout: SQLite busy_timeout pragma, milliseconds
+    :param read_only: open an existing SQLite file for reading only
+    :return: the engine
+    :raise ValueError: if read_only is asked of another database
+    """
+    url = make_url(url)
+    if read_only and (url.get_backend_name() != 'sqlite' or
+                      url.database in (None, '', ':memory:')):
+        raise ValueError('Only SQLite files can be opened read only')
+    if url.get_backend_name() != 'sqlite':
+        db_engine = create_engine(url, pool_size=pool_size,
+                                  max_overflow=max_overflow,
+                                  pool_timeout=pool_timeout,
+                                  pool_recycle=pool_recycle)
+        if pool_pre_ping:
+            event.listen(db_engine, 'engine_connect', _ping_connection)
+        return db_engine
+
+    if url.database in (None, '', ':memory:'):
+        if not shared_cache:
+            db_engine = create_engine(url)
+        else:
+            db_engine = create_engine(url, creator=_shared_memory_creator(),
+                                      poolclass=QueuePool,
+                                      pool_size=pool_size,
+                                      max_overflow=max_overflow,
+                                      pool_timeout=pool_timeout)
+    else:
+        options = {}
+        if read_only:
+            options['creator'] = _read_only_creator(url.database)
+        db_engine = create_engine(
+            url, poolclass=QueuePool, pool_size=pool_size,
+            max_overflow=max_overflow, pool_timeout=pool_timeout,
+            pool_recycle=pool_recycle,
+            connect_args={'check_same_thread': False}, **options)
+        pragmas = [('journal_mode', journal_mode),
+                   ('synchronous', synchronous),
+                   ('mmap_size', mmap_size),
+                   ('cache_size', cache_size),
+                   ('busy_timeout', busy_timeout)]
+        if read_only:
+            pragmas = pragmas[1:]
+        event.listen(db_engine, 'connect', _pragma_setter(pragmas))
+        if pool_pre_ping:
+            event.listen(db_engine, 'engine_connect', _ping_connection)
+
+    _enable_savepoints(db_engine)
+    return db_engine
+
+
+def _enable_savepoints(db_engine):
+    """ Let SQLAlchemy, not pysqlite, decide where transactions begin
+
+    pysqlite defers BEGIN until the first write of a transaction, so a
+    SAVEPOINT issued before then opens a transaction of its own which ends
+    when the savepoint is released.
+    """
+
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    def begin(conn):
+        conn.execute('BEGIN')
+
+    event.listen(db_engine, 'connect', connect)
+    event.listen(db_engine, 'begin', begin)
+
+
+def _shared_memory_creator():
+    uri = 'file:card_table_{}?mode=memory&cache=shared'.format(
+        uuid.uuid4().hex)
+
+    def connect():
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    def creator():
+        return connect()
+
+    # the database lives only as long as a connection to it is open
+    creator.anchor = connect()
+    return creator
+
+
+def _read_only_creator(path):
+    uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+
+    def creator():
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+    return creator
+
+
+def _pragma_setter(pragmas):
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+    return set_pragmas
+
+
+def _ping_connection(connection, branch):
+    """ Pessimistic disconnect handling, tests connections as checked out """
+    if branch:
+        return
+
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        if not err.connection_invalidated:
+            raise
+        # the pool was invalidated, try once more on a fresh connection
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def is_thread_local(db_engine):
+    """ Whether each thread sees a database of its own
+
+    As it does with a private in-memory SQLite database, whose connection
+    is kept one per thread.
+    """
+    return isinstance(db_engine.pool, SingletonThreadPool)
+
+
 def sync(engine):
+    """ Create the tables missing from the database, see migrations.migrate
+    for upgrading those which exist """
     Base.metadata.create_all(engine)
 
 
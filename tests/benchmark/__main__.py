@@ -0,0 +1,50 @@
+""" Run the benchmarks
+
+    $ python -m tests.benchmark [-n ITERATIONS] [-k NAME ...]
+        [--compare BASELINE] [--save PATH]
+
+With --compare, exits non-zero if any scenario regressed against the
+baseline, see harness.compare.
+"""
+import argparse
+import logging
+import os
+import sys
+
+import tests.benchmark.bench_api  # noqa: F401 registers scenarios
+import tests.benchmark.bench_operations  # noqa: F401 registers scenarios
+from tests.benchmark import harness
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tests.benchmark')
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('-k', dest='selected', action='append',
+                        help='only scenarios whose name contains this')
+    parser.add_argument('--compare', nargs='?', const=BASELINE,
+                        help='baseline to compare with, by default '
+                             'tests/benchmark/baseline.json')
+    parser.add_argument('--save', nargs='?', const=BASELINE,
+                        help='where to save the results as a baseline')
+    args = parser.parse_args(argv)
+
+    # SQLAlchemy logs each statement at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = harness.run_all(args.iterations, args.selected)
+    print(harness.format_table(results))
+
+    if args.save:
+        harness.save(results, args.save)
+    if args.compare:
+        regressions = harness.compare(results, harness.load(args.compare))
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+""" Scenarios of the whole API, from api.create_api, one request per call """
+import itertools
+
+from tests.benchmark.bench_operations import table
+from tests.benchmark.harness import Run, scenario
+from tests.unit.card_table import FakeClient
+
+from card_table import api, server
+from card_table.commands import MOVE_CARDS
+
+
+def client_for(decks):
+    db_engine, session = table(decks)
+    session.close()
+    return db_engine, FakeClient(api.create_api(server.middleware(),
+                                                db_engine))
+
+
+def cycle(requests):
+    """ Run each of the requests in turn, one per call """
+    requests = itertools.cycle(requests)
+
+    def run(client):
+        resp = next(requests)(client)
+        assert resp.status_code < 400, resp.body
+    return run
+
+
+def move(card_id, stack_id):
+    return {'operation': MOVE_CARDS, 'game_id': 1, 'actor_id': 1,
+            'changes': {'cards': [{'id': card_id, 'stack_id': stack_id}]}}
+
+
+@scenario('api polling mix', [{'decks': 1}, {'decks': 8}])
+def polling_mix(decks):
+    """ Players watching a table: mostly unchanged state, some paging """
+    db_engine, client = client_for(decks)
+    etag = client.get('/games/1').headers['etag']
+    not_modified = {'If-None-Match': etag}
+    return Run(db_engine, lambda: client, cycle([
+        lambda c: c.get('/games/1', headers=not_modified),
+        lambda c: c.get('/games/1', headers=not_modified),
+        lambda c: c.get('/games/1/state?since=0'),
+        lambda c: c.get('/games/1/events?wait=0'),
+        lambda c: c.get('/cards?stack_id=2&__page_size=20'),
+        lambda c: c.get('/games/1', headers=not_modified),
+        lambda c: c.get('/games/1/state')]), None)
+
+
+@scenario('api playing mix', [{'decks': 1}, {'decks': 8}])
+def playing_mix(decks):
+    """ A player's turn: moving cards by command, then reading the table """
+    db_engine, client = client_for(decks)
+    return Run(db_engine, lambda: client, cycle([
+        lambda c: c.post('/commands', move(1, 2)),
+        lambda c: c.get('/games/1/events?wait=0&after=0'),
+        lambda c: c.post('/commands', move(1, 1)),
+        lambda c: c.get('/cards/1'),
+        lambda c: c.post('/commands/batch', {'commands': [
+            move(card_id, 2) for card_id in range(2, 12)]}),
+        lambda c: c.get('/cards?stack_id=2')]), None)
+
+
+@scenario('api crud mix')
+def crud_mix():
+    """ The falcon_autocrud resources alone """
+    db_engine, client = client_for(1)
+    return Run(db_engine, lambda: client, cycle([
+        lambda c: c.get('/games'),
+        lambda c: c.get('/stacks/1'),
+        lambda c: c.get('/cards?stack_id=1'),
+        lambda c: c.patch('/cards/5', {'position': 60}),
+        lambda c: c.get('/cards/5'),
+        lambda c: c.patch('/games/1', {'name': 'renamed'})]), None)
+
+
+@scenario('api shuffle', [{'decks': 1}, {'decks': 8}])
+def shuffle(decks):
+    db_engine, client = client_for(decks)
+    command = {'operation': 'shuffle stack', 'game_id': 1, 'actor_id': 1,
+               'changes': {'stack_id': 1}}
+    return Run(db_engine, lambda: client, cycle([
+        lambda c: c.post('/commands', command)]), None)
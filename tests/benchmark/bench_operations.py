@@ -0,0 +1,89 @@
+""" Scenarios of each commands.Operations method """
+from tests.benchmark.harness import fresh_engine, Run, scenario, session_for
+
+from card_table.commands import Operations
+from card_table.storage import Card, Game, Stack
+
+""" 1 to 80 decks, 52 to 4,160 cards """
+STACK_SIZES = [{'decks': 1}, {'decks': 10}, {'decks': 80}]
+""" and the 8 deck shoe (416 cards) dealt at a blackjack table """
+DECK_SIZES = STACK_SIZES[:1] + [{'decks': 8}] + STACK_SIZES[1:]
+BATCH_SIZES = [{'batch': 1}, {'batch': 10}, {'batch': 100},
+               {'batch': 1000}]
+
+
+def table(decks=0, virtual=False):
+    """ A game with a draw pile of decks, and an empty hand """
+    db_engine = fresh_engine()
+    session = session_for(db_engine)
+    session.add(Game(name='benchmark'))
+    session.flush()
+    session.add_all([Stack(game_id=1, owner_id=0, label='draw pile'),
+                     Stack(game_id=1, owner_id=1, label='hand')])
+    session.flush()
+    if decks:
+        Operations.do_create_deck(session, stack_id=1, decks=decks,
+                                  virtual=virtual, seed=1234)
+    session.commit()
+    return db_engine, session
+
+
+def rollback(session):
+    session.rollback()
+
+
+@scenario('create deck', DECK_SIZES)
+def create_deck(decks):
+    db_engine, session = table()
+
+    def run(session):
+        Operations.do_create_deck(session, stack_id=1, decks=decks)
+        session.flush()
+    return Run(db_engine, lambda: session, run, rollback)
+
+
+@scenario('create virtual shoe', STACK_SIZES)
+def create_virtual_shoe(decks):
+    db_engine, session = table()
+
+    def run(session):
+        Operations.do_create_deck(session, stack_id=1, decks=decks,
+                                  virtual=True)
+        session.flush()
+    return Run(db_engine, lambda: session, run, rollback)
+
+
+@scenario('shuffle stack', STACK_SIZES)
+def shuffle_stack(decks):
+    db_engine, session = table(decks)
+
+    def run(session):
+        Operations.do_shuffle_stack(session, stack_id=1)
+        session.flush()
+    return Run(db_engine, lambda: session, run, rollback)
+
+
+@scenario('move cards', BATCH_SIZES)
+def move_cards(batch):
+    db_engine, session = table(decks=80)
+    card_ids = Card.find_ids_by_stack(1, session)[:batch]
+    moves = [{'id': card_id, 'stack_id': 2, 'position': position,
+              'owner_facing': 'up'}
+             for position, card_id in enumerate(card_ids)]
+
+    def run(session):
+        Operations.do_move_cards(session, cards=moves)
+        session.flush()
+    return Run(db_engine, lambda: session, run, rollback)
+
+
+@scenario('draw from virtual shoe', BATCH_SIZES)
+def draw_cards(batch):
+    db_engine, session = table(decks=80, virtual=True)
+    draws = [{'draw_from': 1, 'stack_id': 2, 'position': position}
+             for position in range(batch)]
+
+    def run(session):
+        Operations.do_move_cards(session, cards=draws)
+        session.flush()
+    return Run(db_engine, lambda: session, run, rollback)
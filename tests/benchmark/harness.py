@@ -0,0 +1,140 @@
+""" Measures scenarios and compares the results to a baseline
+
+A scenario is a function of its parameters returning a Run: a setup
+function, whose result is passed to each timed call of run, and an optional
+reset, called untimed after each call to restore the starting state.
+"""
+import json
+import statistics
+import time
+from collections import namedtuple, OrderedDict
+
+from sqlalchemy.orm import sessionmaker
+from tests.unit.card_table import recorded_statements
+
+from card_table import storage
+
+Run = namedtuple('Run', ['engine', 'setup', 'run', 'reset'])
+
+""" name -> (function, list of parameter dicts), see scenario """
+SCENARIOS = OrderedDict()
+
+""" Latency, relative to the baseline, reported as a regression """
+TOLERANCE = 1.25
+
+
+def scenario(name, params=({},)):
+    """ Register a scenario, to be measured once per dict of params """
+    def decorator(f):
+        SCENARIOS[name] = (f, list(params))
+        return f
+    return decorator
+
+
+def fresh_engine():
+    """ A private, empty in-memory database """
+    db_engine = storage.build_engine('sqlite:///:memory:')
+    storage.sync(db_engine)
+    return db_engine
+
+
+def session_for(db_engine):
+    return sessionmaker(bind=db_engine)()
+
+
+def scenario_key(name, params):
+    if not params:
+        return name
+    return '{} [{}]'.format(name, ', '.join(
+        '{}={}'.format(k, v) for k, v in sorted(params.items())))
+
+
+def measure(run, iterations):
+    """ Time run.run over iterations, counting its SQL statements
+
+    :return: a dict of throughput, latency percentiles in milliseconds and
+        the most statements executed by one call
+    """
+    context = run.setup()
+    timings = []
+    queries = 0
+    for _ in range(iterations):
+        with recorded_statements(run.engine) as statements:
+            start = time.perf_counter()
+            run.run(context)
+            timings.append(time.perf_counter() - start)
+        queries = max(queries, len(statements))
+        if run.reset:
+            run.reset(context)
+
+    timings.sort()
+    return OrderedDict([
+        ('iterations', iterations),
+        ('ops_per_sec', round(iterations / sum(timings), 1)),
+        ('p50_ms', round(percentile(timings, 50) * 1000, 3)),
+        ('p99_ms', round(percentile(timings, 99) * 1000, 3)),
+        ('mean_ms', round(statistics.mean(timings) * 1000, 3)),
+        ('queries', queries)])
+
+
+def percentile(ordered, pct):
+    """ Nearest rank percentile of an ascending list """
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_all(iterations, selected=None):
+    """ Measure every registered scenario, or those named in selected
+
+    :return: an ordered dict of scenario key to result
+    """
+    results = OrderedDict()
+    for name, (f, param_sets) in SCENARIOS.items():
+        if selected and not any(s in name for s in selected):
+            continue
+        for params in param_sets:
+            results[scenario_key(name, params)] = measure(f(**params),
+                                                          iterations)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Regressions of results against a baseline
+
+    Any increase in the statements executed is a regression, as is a p50
+    latency beyond tolerance times that of the baseline.
+
+    :return: a list of messages, one per regression
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            regressions.append('{}: {} queries, was {}'.format(
+                key, result['queries'], base['queries']))
+        if result['p50_ms'] > base['p50_ms'] * tolerance:
+            regressions.append('{}: p50 {}ms, was {}ms'.format(
+                key, result['p50_ms'], base['p50_ms']))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+        f.write('\n')
+
+
+def format_table(results):
+    lines = ['{:<58} {:>10} {:>10} {:>10} {:>8}'.format(
+        'scenario', 'ops/s', 'p50 ms', 'p99 ms', 'queries')]
+    for key, r in results.items():
+        lines.append('{:<58} {:>10} {:>10} {:>10} {:>8}'.format(
+            key, r['ops_per_sec'], r['p50_ms'], r['p99_ms'], r['queries']))
+    return '\n'.join(lines)
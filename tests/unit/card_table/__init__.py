@@ -1,7 +1,21 @@
 import json
+import sqlite3
+from contextlib import contextmanager
 from urllib.parse import urlparse, urlencode
 
+import pytest
 from falcon import testing
+from sqlalchemy import event
+
+TRANSACTION_CONTROL = ['BEGIN', 'COMMIT', 'ROLLBACK']
+NDJSON = 'application/x-ndjson'
+EVENT_STREAM = 'text/event-stream'
+
+""" Skips tests of the player view, whose window functions need SQLite 3.25
+"""
+window_functions = pytest.mark.skipif(
+    sqlite3.sqlite_version_info < (3, 25, 0),
+    reason='window functions need SQLite 3.25 or later')
 
 
 class FakeClient(object):
@@ -49,7 +63,12 @@ class FakeClient(object):
         resp.headers = resp.headers_dict
         resp.status_code = int(resp.status.split(' ')[0])
         resp.body = b''.join(list(body)) if body else b''
-        if body:
+        if body and resp.headers.get('content-type') == NDJSON:
+            resp.body = resp.body.decode()
+            resp.json = [json.loads(line) for line in resp.body.splitlines()]
+        elif body and resp.headers.get('content-type') == EVENT_STREAM:
+            resp.body = resp.body.decode()
+        elif body:
             resp.body = resp.body.decode()
             json_payload = json.loads(resp.body)
             if 'data' in json_payload:
@@ -66,3 +85,19 @@ class FakeClient(object):
             json_headers.update(headers)
         headers = json_headers
         return headers
+
+
+@contextmanager
+def recorded_statements(engine):
+    """ Record the SQL statements executed, other than transaction control """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, many):
+        if statement not in TRANSACTION_CONTROL:
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
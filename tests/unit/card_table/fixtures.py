@@ -1,12 +1,10 @@
-import json
-
 import pytest
 from sqlalchemy.orm import sessionmaker
 
 from card_table import server, storage, HAND, DRAW_PILE, DISCARDS, IN_PLAY
 from card_table.cards import ACE, EIGHT, FOUR, JACK, NINE, QUEEN, TEN, HEART
 from card_table.cards import DIAMOND, DIAMONDS, HEARTS, SPADES
-from card_table.commands import MOVE_CARDS, NOOP
+from card_table.commands import execute, MOVE_CARDS, NOOP
 from card_table.storage import Facing
 
 games = [{'name': 'forming', 'state': storage.GameState.forming},
@@ -55,17 +53,17 @@ cards = [{'stack_id': 1, 'position': 0, 'suit': SPADES, 'suit_value': SPADES,
 
 
 commands = [{'operation': MOVE_CARDS, 'game_id': 2, 'actor_id': 700,
-             'changes': json.dumps({'cards': [
+             'changes': {'cards': [
                  {'id': 9, 'owner_facing': [Facing.down.name, Facing.up.name],
-                  'other_facing': [Facing.down.name, Facing.up.name]}]}),
+                  'other_facing': [Facing.down.name, Facing.up.name]}]},
              'memo': 'flip the top card in the draw pile'},
             {'operation': MOVE_CARDS, 'game_id': 2, 'actor_id': 700,
-             'changes': json.dumps({'cards': [
+             'changes': {'cards': [
                  {'id': 9, 'other_facing': [Facing.up.name, Facing.down.name],
-                  'stack_id': [8, 9], 'position': [0, 1]}]}),
+                  'stack_id': [8, 9], 'position': [0, 1]}]},
              'memo': 'draw the top card from the draw pile'},
             {'operation': NOOP, 'game_id': 2, 'actor_id': 700,
-             'changes': '{}', 'memo': 'nothing to see here'}]
+             'changes': {}, 'memo': 'nothing to see here'}]
 
 
 @pytest.fixture
@@ -105,3 +103,13 @@ def with_fixtures(session):
         session.add(storage.Command(**model))
 
     session.commit()
+
+
+def run(session, game_id, operation, changes, actor_id=700):
+    """ Execute and commit a command of a game, returning it """
+    command = storage.Command(operation=operation, game_id=game_id,
+                              actor_id=actor_id, changes=changes)
+    execute(session, command)
+    session.add(command)
+    session.commit()
+    return command
@@ -1,13 +1,20 @@
+import json
+import threading
+
 import falcon
 import pytest
+import mock
 from mock import patch
-from tests.unit.card_table import FakeClient
+from sqlalchemy.orm import sessionmaker
+from tests.unit.card_table import (FakeClient, recorded_statements,
+                                   window_functions)
 
 import tests.unit.card_table.fixtures as fixtures
-from card_table import api, HAND, IN_PLAY
+from card_table import (api, commands, events, migrations, shards, storage,
+                        HAND, IN_PLAY)
 from card_table.cards import DIAMONDS, SPADES, SIX, SPADE
-from card_table.commands import MOVE_CARDS, NOOP
-from card_table.storage import Facing
+from card_table.commands import CREATE_DECK, MOVE_CARDS, NOOP
+from card_table.storage import Command, Facing, Game
 
 
 @pytest.fixture()
@@ -21,6 +28,40 @@ def rest_api(app):
     return FakeClient(app)
 
 
+@pytest.fixture()
+def sharded_api(middleware, engine):
+    """ The API over two shards, the second of which holds game 1 << 40
+    and its records, see seat """
+    other = storage.build_engine('sqlite:///:memory:')
+    migrations.migrate(other)
+    router = shards.ShardRouter([engine, other])
+    router.prepare()
+    return FakeClient(api.create_api(middleware, router))
+
+
+@pytest.fixture()
+def split_engines(tmpdir):
+    """ A writer of a single connection and a read only pool, both of one
+    SQLite file """
+    url = 'sqlite:///' + str(tmpdir.join('cards.db'))
+    writer = storage.build_engine(url, pool_size=1, max_overflow=0,
+                                  pool_timeout=1)
+    migrations.migrate(writer)
+    reader = storage.build_engine(url, pool_size=3, read_only=True)
+    return writer, reader
+
+
+def seat(client, name):
+    """ Create a game with a deck, returning the ids of both """
+    game_id = client.post('/games', {'name': name}).json['id']
+    stack_id = client.post('/stacks', {'game_id': game_id,
+                                       'label': 'deck'}).json['id']
+    client.post('/commands', {'operation': CREATE_DECK, 'game_id': game_id,
+                              'actor_id': 600,
+                              'changes': {'stack_id': stack_id}})
+    return game_id, stack_id
+
+
 class TestApiHealth(object):
 
     def test_get_health_ok(self, client):
@@ -58,6 +99,48 @@ class TestApiHealth(object):
         resp = client.options('/health')
         assert resp.status == falcon.HTTP_NO_CONTENT
 
+    def test_get_health_details(self, client):
+        resp = client.get('/health')
+        assert resp.json['details']['available'] is True
+        assert resp.json['details']['latency_ms'] >= 0
+        assert resp.json['details']['pool'] == {}
+
+    def test_get_health_cached(self, middleware, engine):
+        client = FakeClient(api.create_api(middleware, engine,
+                                           {'ttl': 60}))
+        client.get('/health')
+        with recorded_statements(engine) as statements:
+            resp = client.get('/health')
+        assert resp.status == falcon.HTTP_OK
+        assert statements == []
+
+    def test_get_live(self, engine, client):
+        from card_table.storage import Base
+        Base.metadata.drop_all(engine)
+        resp = client.get('/health/live')
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['description'] == 'Service is alive'
+
+    def test_get_ready(self, client):
+        resp = client.get('/health/ready')
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['details']['available'] is True
+
+    def test_get_ready_failure(self, engine, client):
+        from card_table.storage import Base
+        Base.metadata.drop_all(engine)
+        resp = client.get('/health/ready')
+        assert resp.status == falcon.HTTP_SERVICE_UNAVAILABLE
+        assert resp.json['description'] == 'Database unavailable'
+
+    def test_get_ready_slow(self, middleware, engine):
+        client = FakeClient(api.create_api(middleware, engine,
+                                           {'max_latency_ms': 0.0}))
+        resp = client.get('/health/ready')
+        assert resp.status == falcon.HTTP_SERVICE_UNAVAILABLE
+        assert resp.json['description'] == 'Database responding slowly'
+        assert client.get('/health').status == falcon.HTTP_OK
+
 
 class TestApiGame(object):
     def test_get_all(self, rest_api, with_fixtures):
@@ -75,6 +158,61 @@ class TestApiGame(object):
         assert resp.json['name'] == 'cancelled'
         assert resp.json['state'] == 'cancelled'
 
+    def test_get_validators(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/3')
+
+        assert resp.headers['etag'].startswith('"3-')
+        assert resp.headers['last-modified'].endswith(' GMT')
+
+    def test_get_if_none_match(self, engine, rest_api, with_fixtures):
+        etag = rest_api.get('/games/3').headers['etag']
+
+        with recorded_statements(engine) as statements:
+            resp = rest_api.get('/games/3', headers={'If-None-Match': etag})
+
+        assert resp.status == falcon.HTTP_NOT_MODIFIED
+        assert resp.body == b''
+        assert resp.headers['etag'] == etag
+        assert len(statements) == 1
+
+    def test_get_if_none_match_weak(self, rest_api, with_fixtures):
+        etag = rest_api.get('/games/3').headers['etag']
+
+        resp = rest_api.get('/games/3',
+                            headers={'If-None-Match': '"x", W/' + etag})
+
+        assert resp.status == falcon.HTTP_NOT_MODIFIED
+
+    def test_get_if_none_match_changed(self, rest_api, with_fixtures):
+        etag = rest_api.get('/games/3').headers['etag']
+        rest_api.patch('/games/3', {'name': 'renamed'})
+
+        resp = rest_api.get('/games/3', headers={'If-None-Match': etag})
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['name'] == 'renamed'
+        assert resp.headers['etag'] != etag
+
+    def test_get_if_modified_since(self, rest_api, with_fixtures):
+        last_modified = rest_api.get('/games/3').headers['last-modified']
+
+        resp = rest_api.get('/games/3',
+                            headers={'If-Modified-Since': last_modified})
+
+        assert resp.status == falcon.HTTP_NOT_MODIFIED
+
+    def test_get_if_modified_since_earlier(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/3', headers={
+            'If-Modified-Since': 'Mon, 15 Aug 2016 09:45:52 GMT'})
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['id'] == 3
+
+    def test_get_missing_if_none_match(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/80', headers={'If-None-Match': '*'})
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
     def test_get_by_state(self, rest_api, with_fixtures):
         resp = rest_api.get('/games?state=playing')
 
@@ -138,6 +276,318 @@ class TestApiGame(object):
         assert 'not modifiable' in resp.body
 
 
+class TestApiGameState(object):
+    def test_get(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/4/state')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['id'] == 4
+        assert resp.json['state'] == 'playing'
+        stacks = resp.json['stacks']
+        assert [s['id'] for s in stacks] == [1, 2, 3, 4, 5, 6, 7]
+        assert [c['id'] for c in stacks[1]['cards']] == [3, 4, 5, 6, 7]
+        assert [c['position'] for c in stacks[1]['cards']] == [0, 1, 2, 3, 4]
+        assert stacks[1]['cards'][0]['owner_facing'] == Facing.up.name
+        assert stacks[2]['cards'] == []
+
+    def test_get_hides_secrets(self, rest_api, with_fixtures):
+        data = {'operation': 'create deck', 'game_id': 1, 'actor_id': 600,
+                'changes': '{"stack_id": 10, "virtual": true}'}
+        rest_api.post('/commands', data)
+
+        resp = rest_api.get('/games/1/state')
+
+        assert resp.status == falcon.HTTP_OK
+        assert 'shoe_seed' not in resp.json['stacks'][0]
+        assert resp.json['stacks'][0]['shoe_remaining'] == 52
+
+    def test_shuffle_shoe_refused(self, rest_api, with_fixtures):
+        rest_api.post('/commands', {
+            'operation': 'create deck', 'game_id': 1, 'actor_id': 600,
+            'changes': {'stack_id': 10, 'virtual': True}})
+
+        resp = rest_api.post('/commands', {
+            'operation': 'shuffle stack', 'game_id': 1, 'actor_id': 600,
+            'changes': {'stack_id': 10}})
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_get_without_stacks(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/3/state')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['stacks'] == []
+
+    def test_get_meta(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/state')
+
+        assert json.loads(resp.body)['meta'] == {'full': True,
+                                                 'command_id': 3}
+
+    def test_get_command_between_reads(self, rest_api, session,
+                                       with_fixtures):
+        game_state = api.queries.game_state
+
+        def commit_first(conn, game_id):
+            fixtures.run(session, 2, MOVE_CARDS,
+                         {'cards': [{'id': 9, 'position': 1}]})
+            return game_state(conn, game_id)
+
+        with patch.object(api.queries, 'game_state', commit_first):
+            resp = rest_api.get('/games/2/state')
+        since = json.loads(resp.body)['meta']['command_id']
+        resp = rest_api.get('/games/2/state?since={}'.format(since))
+
+        assert since == 3
+        assert 9 in [c['id'] for c in resp.json['cards']]
+
+    def test_get_since(self, rest_api, with_fixtures):
+        rest_api.post('/commands', {'operation': NOOP, 'game_id': 2,
+                                    'actor_id': 700, 'changes': '{}'})
+        rest_api.post('/commands', {
+            'operation': MOVE_CARDS, 'game_id': 2, 'actor_id': 700,
+            'changes': {'cards': [{'id': 9, 'stack_id': 9,
+                                   'position': 1}]}})
+
+        resp = rest_api.get('/games/2/state?since=4')
+
+        assert resp.status == falcon.HTTP_OK
+        assert json.loads(resp.body)['meta'] == {'full': False,
+                                                 'command_id': 5}
+        assert resp.json['game'] is None
+        assert resp.json['stacks'] == []
+        assert [c['id'] for c in resp.json['cards']] == [9]
+        assert resp.json['cards'][0]['stack_id'] == 9
+
+    def test_get_since_unknown(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/4/state?since=2')
+
+        assert resp.status == falcon.HTTP_OK
+        assert json.loads(resp.body)['meta']['full'] is True
+        assert len(resp.json['stacks']) == 7
+
+    def test_get_since_invalid(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/state?since=first')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_get_since_missing(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/80/state?since=1')
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
+    def test_get_missing(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/80/state')
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
+
+@window_functions
+class TestApiGameView(object):
+
+    def test_get_owner(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/4/view?player=100')
+
+        assert resp.status == falcon.HTTP_OK
+        hand = resp.json['stacks'][1]
+        assert hand['size'] == 5
+        assert [c['rank'] for c in hand['cards']] == [
+            '8', 'ace', 'jack', '10', '9']
+
+    def test_get_other_player(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/4/view?player=200')
+
+        assert resp.status == falcon.HTTP_OK
+        hand = resp.json['stacks'][1]
+        assert [c['position'] for c in hand['cards']] == [0, 1, 2, 3, 4]
+        assert {c['id'] for c in hand['cards']} == {None}
+        assert {c['rank'] for c in hand['cards']} == {None}
+        assert {c['suit'] for c in hand['cards']} == {None}
+        discards = resp.json['stacks'][3]
+        assert discards['cards'][0]['rank'] == '4'
+
+    def test_get_size_visibility(self, rest_api, with_fixtures):
+        rest_api.patch('/stacks/2', {'size_visibility': 2})
+
+        resp = rest_api.get('/games/4/view?player=200')
+
+        hand = resp.json['stacks'][1]
+        assert hand['size'] == 2
+        assert [c['position'] for c in hand['cards']] == [0, 1]
+
+    def test_get_hidden_stack(self, rest_api, with_fixtures):
+        rest_api.patch('/stacks/2', {'size_visibility': 0})
+
+        resp = rest_api.get('/games/4/view?player=200')
+
+        hand = resp.json['stacks'][1]
+        assert hand['id'] == 2
+        assert hand['size'] == 0
+        assert hand['cards'] == []
+        assert len(resp.json['stacks']) == 7
+
+    def test_get_one_query(self, engine, rest_api, with_fixtures):
+        with recorded_statements(engine) as statements:
+            resp = rest_api.get('/games/4/view?player=200')
+
+        assert resp.status == falcon.HTTP_OK
+        assert len(statements) == 1
+
+    def test_get_missing_player(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/4/view')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_get_invalid_player(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/4/view?player=0')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_get_missing(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/80/view?player=100')
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
+
+class TestApiGameReplay(object):
+    def test_get(self, rest_api, with_fixtures):
+        data = {'commands': [
+            {'operation': 'create deck', 'game_id': 1, 'actor_id': 600,
+             'changes': '{"stack_id": 10}'},
+            {'operation': 'move cards', 'game_id': 1, 'actor_id': 600,
+             'changes': '{"cards": [{"id": 11, "position": 60}]}'}]}
+        rest_api.post('/commands/batch', data)
+
+        latest = rest_api.get('/games/1/replay')
+        first = rest_api.get('/games/1/replay?command_id=4')
+
+        assert latest.status == falcon.HTTP_OK
+        assert latest.json['command_id'] == 5
+        assert latest.json['cards'][0]['id'] == 11
+        assert latest.json['cards'][0]['position'] == 60
+        assert first.json['command_id'] == 4
+        assert first.json['cards'][0]['position'] == 0
+
+    def test_get_missing(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/80/replay')
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
+    def test_get_not_replayable(self, rest_api, session, with_fixtures):
+        session.add(Command(operation='flip', game_id=2, actor_id=700,
+                            changes={'card_id': 9}))
+        session.commit()
+
+        resp = rest_api.get('/games/2/replay')
+
+        assert resp.status == falcon.HTTP_UNPROCESSABLE_ENTITY
+        assert 'flip' in resp.body
+
+    @pytest.mark.parametrize('operation,changes,effects', [
+        (CREATE_DECK, {'stack_id': 8}, None),
+        (MOVE_CARDS, {'cards': [{'draw_from': 99, 'stack_id': 8}]},
+         {'drawn_ids': [40]})])
+    def test_get_not_foldable(self, rest_api, session, with_fixtures,
+                              operation, changes, effects):
+        session.add(Command(operation=operation, game_id=2, actor_id=700,
+                            changes=changes, effects=effects))
+        session.commit()
+
+        resp = rest_api.get('/games/2/replay')
+
+        assert resp.status == falcon.HTTP_UNPROCESSABLE_ENTITY
+
+    def test_get_invalid_command_id(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/1/replay?command_id=first')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+
+class TestApiGameEvents(object):
+    def test_get(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/events?after=1')
+
+        assert resp.status == falcon.HTTP_OK
+        assert [e['id'] for e in resp.json] == [2, 3]
+        assert json.loads(resp.body)['meta']['last_event_id'] == 3
+
+    def test_get_last_event_id(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/events',
+                            headers={'Last-Event-ID': '2'})
+
+        assert resp.status == falcon.HTTP_OK
+        assert [e['id'] for e in resp.json] == [3]
+
+    def test_get_nothing_new(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/events?wait=0')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json == []
+        assert json.loads(resp.body)['meta']['last_event_id'] == 3
+
+    @patch.object(events.ChangeNotifier, 'wait')
+    def test_get_no_wait_by_default(self, wait, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/events')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json == []
+        assert not wait.called
+
+    def test_get_woken(self, middleware):
+        # threads share an in-memory database only through a shared cache
+        db_engine = storage.build_engine('sqlite:///:memory:',
+                                         shared_cache=True)
+        storage.sync(db_engine)
+        sessions = sessionmaker(bind=db_engine)
+        session = sessions()
+        session.add(Game(name='waiting'))
+        session.commit()
+        session.close()
+
+        def play():
+            other = sessions()
+            other.add(Command(operation=NOOP, game_id=1, actor_id=100,
+                              changes={}))
+            other.commit()
+            other.close()
+
+        app = falcon.API(middleware=middleware)
+        app.add_route('/games/{id}/events', api.GameEventsResource(
+            shards.ShardRouter([db_engine]), events.ChangeNotifier()))
+        timer = threading.Timer(0.05, play)
+        timer.start()
+        resp = FakeClient(app).get('/games/1/events?wait=5')
+        timer.join()
+
+        assert resp.status == falcon.HTTP_OK
+        assert [e['operation'] for e in resp.json] == [NOOP]
+
+    @patch.object(api.GameEventsResource, 'stream_timeout', 0.05)
+    @patch.object(api.GameEventsResource, 'heartbeat', 0.01)
+    def test_get_stream(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/events', headers={
+            'Accept': 'text/event-stream', 'Last-Event-ID': '1'})
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.headers['content-type'] == 'text/event-stream'
+        chunks = resp.body.split('\n\n')
+        assert chunks[0] == 'retry: 1000'
+        assert chunks[1].startswith('id: 2\nevent: command\ndata: {')
+        assert json.loads(chunks[2].split('data: ')[1])['id'] == 3
+        assert ': keepalive' in chunks[3:]
+
+    def test_get_missing(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/80/events')
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
+    def test_get_invalid_last_event_id(self, rest_api, with_fixtures):
+        resp = rest_api.get('/games/2/events',
+                            headers={'Last-Event-ID': 'first'})
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+
 class TestApiStack(object):
     def test_get_all(self, rest_api, with_fixtures):
         resp = rest_api.get('/stacks')
@@ -163,6 +613,13 @@ class TestApiStack(object):
         assert resp.json[1]['owner_id'] == 100
         assert resp.json[2]['owner_id'] == 100
 
+    def test_get_if_none_match(self, rest_api, with_fixtures):
+        etag = rest_api.get('/stacks/2').headers['etag']
+
+        resp = rest_api.get('/stacks/2', headers={'If-None-Match': etag})
+
+        assert resp.status == falcon.HTTP_NOT_MODIFIED
+
     def test_get_missing_by_id(self, rest_api, with_fixtures):
         resp = rest_api.get('/stacks/80')
 
@@ -224,6 +681,35 @@ class TestApiStack(object):
         assert resp.status == falcon.HTTP_BAD_REQUEST
         assert 'not modifiable' in resp.body
 
+    def test_get_shoe(self, rest_api, with_fixtures):
+        data = {'operation': 'create deck', 'game_id': 1, 'actor_id': 600,
+                'changes': '{"stack_id": 10, "decks": 8, "virtual": true}'}
+        rest_api.post('/commands', data)
+
+        resp = rest_api.get('/stacks/10')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['shoe_template'] == 'ace low'
+        assert resp.json['shoe_remaining'] == 416
+        assert 'shoe_seed' not in resp.json
+
+    def test_filter_by_secret_forbidden(self, rest_api, with_fixtures):
+        resp = rest_api.get('/stacks?shoe_seed__lt=100')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_sort_by_secret_forbidden(self, rest_api, with_fixtures):
+        resp = rest_api.get('/stacks?__sort=-shoe_seed')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_patch_shoe_forbidden(self, rest_api, with_fixtures):
+        data = {"shoe_cursor": 0}
+        resp = rest_api.patch('/stacks/5', data)
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'not modifiable' in resp.body
+
     def test_post_missing_game_id(self, rest_api, with_fixtures):
         data = {'owner_id': 300, 'label': HAND}
 
@@ -271,6 +757,77 @@ class TestApiCards(object):
         assert resp.json[2]['stack_id'] == 2
         assert resp.json[2]['position'] == 2
 
+    def test_get_pages(self, rest_api, with_fixtures):
+        resp = rest_api.get('/cards?__page_size=4')
+
+        assert resp.status == falcon.HTTP_OK
+        assert [c['id'] for c in resp.json] == [1, 2, 3, 4]
+        cursor = json.loads(resp.body)['meta']['next']
+
+        resp = rest_api.get('/cards?__page_size=4&__after=' + cursor)
+        assert [c['id'] for c in resp.json] == [5, 6, 7, 8]
+        cursor = json.loads(resp.body)['meta']['next']
+
+        resp = rest_api.get('/cards?__page_size=4&__after=' + cursor)
+        assert [c['id'] for c in resp.json] == [9, 10]
+        assert json.loads(resp.body)['meta']['next'] is None
+
+    def test_get_pages_by_stack_id(self, rest_api, with_fixtures):
+        resp = rest_api.get('/cards?stack_id=2&__page_size=3')
+
+        assert resp.status == falcon.HTTP_OK
+        assert len(resp.json) == 3
+        cursor = json.loads(resp.body)['meta']['next']
+
+        resp = rest_api.get('/cards?stack_id=2&__after=' + cursor)
+        assert len(resp.json) == 2
+        assert all(c['stack_id'] == 2 for c in resp.json)
+        assert resp.json[0]['owner_facing'] in Facing.__members__
+
+    def test_get_pages_invalid_cursor(self, rest_api, with_fixtures):
+        resp = rest_api.get('/cards?__after=bogus')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_get_pages_invalid_page_size(self, rest_api, with_fixtures):
+        resp = rest_api.get('/cards?__page_size=0')
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+
+    def test_get_stream(self, rest_api, with_fixtures):
+        resp = rest_api.get('/cards?__stream=ndjson')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.headers['content-type'] == 'application/x-ndjson'
+        assert [c['id'] for c in resp.json] == list(
+            range(1, len(fixtures.cards) + 1))
+
+    def test_get_stream_accepted(self, rest_api, with_fixtures):
+        resp = rest_api.get('/cards?stack_id=2',
+                            headers={'Accept': 'application/x-ndjson'})
+
+        assert resp.status == falcon.HTTP_OK
+        assert len(resp.json) == 5
+        assert all(c['stack_id'] == 2 for c in resp.json)
+
+    def test_get_if_none_match(self, rest_api, with_fixtures):
+        etag = rest_api.get('/cards/3').headers['etag']
+
+        resp = rest_api.get('/cards/3', headers={'If-None-Match': etag})
+
+        assert resp.status == falcon.HTTP_NOT_MODIFIED
+
+    def test_get_if_none_match_moved(self, rest_api, with_fixtures):
+        etag = rest_api.get('/cards/3').headers['etag']
+        rest_api.post('/commands', {
+            'operation': MOVE_CARDS, 'game_id': 2, 'actor_id': 600,
+            'changes': {'cards': [{'id': 3, 'position': 9}]}})
+
+        resp = rest_api.get('/cards/3', headers={'If-None-Match': etag})
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['position'] == 9
+
     def test_get_missing_by_id(self, rest_api, with_fixtures):
         resp = rest_api.get('/cards/80')
 
@@ -301,6 +858,39 @@ class TestApiCards(object):
         assert resp.json['id'] == 1
         assert resp.json['owner_facing'] == 'peeking'
 
+    def test_patch_if_match(self, rest_api, with_fixtures):
+        etag = rest_api.get('/cards/1').headers['etag']
+
+        resp = rest_api.patch('/cards/1', {'owner_facing': 'peeking'},
+                              headers={'If-Match': etag})
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['version'] == 2
+        assert resp.headers['etag'] == '"1-2"'
+        assert resp.headers['etag'] != etag
+
+    def test_patch_if_match_stale(self, rest_api, with_fixtures):
+        etag = rest_api.get('/cards/1').headers['etag']
+        rest_api.patch('/cards/1', {'owner_facing': 'up'})
+
+        resp = rest_api.patch('/cards/1', {'owner_facing': 'peeking'},
+                              headers={'If-Match': etag})
+
+        assert resp.status == falcon.HTTP_CONFLICT
+        assert rest_api.get('/cards/1').json['owner_facing'] == 'up'
+
+    def test_patch_if_match_any(self, rest_api, with_fixtures):
+        resp = rest_api.patch('/cards/1', {'owner_facing': 'peeking'},
+                              headers={'If-Match': '*'})
+
+        assert resp.status == falcon.HTTP_OK
+
+    def test_patch_version_forbidden(self, rest_api, with_fixtures):
+        resp = rest_api.patch('/cards/1', {'version': 7})
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'not modifiable' in resp.body
+
     def test_delete(self, rest_api, with_fixtures):
         resp = rest_api.delete('/cards/1')
 
@@ -384,13 +974,32 @@ class TestApiCommands(object):
         assert resp.json[2]['game_id'] == 2
         assert resp.json[2]['operation'] == NOOP
 
+    def test_get_pages(self, rest_api, with_fixtures):
+        resp = rest_api.get('/commands?__page_size=2')
+
+        assert resp.status == falcon.HTTP_OK
+        assert [c['id'] for c in resp.json] == [1, 2]
+        assert resp.json[0]['changes']['cards'][0]['id'] == 9
+        cursor = json.loads(resp.body)['meta']['next']
+
+        resp = rest_api.get('/commands?__page_size=2&__after=' + cursor)
+        assert [c['id'] for c in resp.json] == [3]
+        assert 'effects' not in resp.json[0]
+
+    def test_get_stream(self, rest_api, with_fixtures):
+        resp = rest_api.get('/commands?game_id=2&__stream=ndjson')
+
+        assert resp.status == falcon.HTTP_OK
+        assert len(resp.json) == 3
+        assert resp.json[2]['changes'] == {}
+
     def test_get_missing_by_id(self, rest_api, with_fixtures):
         resp = rest_api.get('/commands/80')
 
         assert resp.status == falcon.HTTP_NOT_FOUND
 
-    @patch('card_table.commands.Operations')
-    def test_post_noop(self, operations, rest_api):
+    @patch.object(commands.REGISTRY[NOOP], 'handler')
+    def test_post_noop(self, handler, rest_api):
         data = {'operation': 'noop', 'game_id': 1, 'actor_id': 600,
                 'changes': '{"foo": "bar"}', 'memo': 'nothing to see here'}
         resp = rest_api.post('/commands', data)
@@ -402,10 +1011,11 @@ class TestApiCommands(object):
         assert resp.json['actor_id'] == 600
         assert resp.json['changes'] == {'foo': 'bar'}
         assert resp.json['memo'] == 'nothing to see here'
-        assert operations.do_noop.called
+        assert 'effects' not in resp.json
+        assert handler.called
 
-    @patch('card_table.commands.Operations')
-    def test_post_create_deck(self, operations, rest_api):
+    @patch.object(commands.REGISTRY[CREATE_DECK], 'handler')
+    def test_post_create_deck(self, handler, rest_api):
         data = {'operation': 'create deck', 'game_id': 1, 'actor_id': 600,
                 'changes': '{"stack_id": 10}', 'memo': 'new deck'}
         resp = rest_api.post('/commands', data)
@@ -418,11 +1028,56 @@ class TestApiCommands(object):
         assert resp.json['changes'] == {'stack_id': 10}
         assert resp.json['memo'] == 'new deck'
 
-        expected_dict = {'stack_id': 10}
-        assert operations.do_create_deck.called_once_with(expected_dict)
+        handler.assert_called_once_with(mock.ANY, stack_id=10, ace='low',
+                                        decks=1)
 
-    @patch('card_table.commands.Operations')
-    def test_post_missing_changes(self, operations, rest_api):
+    @patch.object(commands.REGISTRY[NOOP], 'handler')
+    def test_post_changes_object(self, handler, rest_api):
+        data = {'operation': 'noop', 'game_id': 1, 'actor_id': 600,
+                'changes': {'foo': 'bar'}}
+        resp = rest_api.post('/commands', data)
+
+        assert resp.status == falcon.HTTP_CREATED
+        assert resp.json['changes'] == {'foo': 'bar'}
+        assert rest_api.get('/commands/1').json['changes'] == {'foo': 'bar'}
+
+    @patch.object(commands.REGISTRY[NOOP], 'handler')
+    def test_post_changes_not_object(self, handler, rest_api):
+        data = {'operation': 'noop', 'game_id': 1, 'actor_id': 600,
+                'changes': '["foo"]'}
+        resp = rest_api.post('/commands', data)
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'Invalid' in resp.body
+
+    def test_post_seed_refused(self, rest_api, with_fixtures):
+        data = {'operation': 'shuffle stack', 'game_id': 2, 'actor_id': 700,
+                'changes': {'stack_id': 8, 'seed': 42}}
+        resp = rest_api.post('/commands', data)
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'seed' in resp.body
+
+    def test_seed_hidden(self, middleware, engine, with_fixtures):
+        client = FakeClient(api.create_api(middleware, engine,
+                                           allow_seeds=True))
+        data = {'operation': 'shuffle stack', 'game_id': 2, 'actor_id': 700,
+                'changes': {'stack_id': 8, 'seed': 42}}
+        resp = client.post('/commands', data)
+
+        assert resp.status == falcon.HTTP_CREATED
+        assert resp.json['changes'] == {'stack_id': 8}
+        command_id = resp.json['id']
+        assert client.get('/commands/{}'.format(command_id)).json[
+            'changes'] == {'stack_id': 8}
+        assert client.get('/commands').json[-1]['changes'] == {'stack_id': 8}
+        page = client.get('/commands?__page_size=10').json
+        assert page[-1]['changes'] == {'stack_id': 8}
+        streamed = client.get('/commands?__stream=ndjson').body
+        assert 'seed' not in streamed
+
+    @patch.object(commands.REGISTRY[NOOP], 'handler')
+    def test_post_missing_changes(self, handler, rest_api):
         data = {'operation': 'noop', 'game_id': 1, 'actor_id': 600,
                 'memo': 'new deck'}
 
@@ -430,8 +1085,8 @@ class TestApiCommands(object):
         assert resp.status == falcon.HTTP_BAD_REQUEST
         assert 'Missing' in resp.body
 
-    @patch('card_table.commands.Operations')
-    def test_post_invalid_embedded_json(self, operations, rest_api):
+    @patch.object(commands.REGISTRY[NOOP], 'handler')
+    def test_post_invalid_embedded_json(self, handler, rest_api):
         data = {'operation': 'noop', 'game_id': 1, 'actor_id': 600,
                 'changes': '{invalid json', 'memo': 'new deck'}
 
@@ -447,6 +1102,32 @@ class TestApiCommands(object):
         assert resp.json['id'] == 1
         assert resp.json['changes'] == {'foo': 'bar'}
 
+    def test_patch_text_by_id(self, rest_api, with_fixtures):
+        data = {'changes': '{"foo": "bar"}'}
+        resp = rest_api.patch('/commands/1', data)
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['changes'] == {'foo': 'bar'}
+        assert rest_api.get('/commands/1').json['changes'] == {'foo': 'bar'}
+
+    def test_patch_string(self, rest_api, with_fixtures):
+        data = {'changes': '"hello"'}
+        resp = rest_api.patch('/commands/2', data)
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['changes'] == 'hello'
+        assert rest_api.get('/commands/2').json['changes'] == 'hello'
+        assert rest_api.get('/commands').json[1]['changes'] == 'hello'
+        events = rest_api.get('/games/2/events?after=1&wait=0')
+        assert events.json[0]['changes'] == 'hello'
+
+    def test_patch_invalid_text(self, rest_api, with_fixtures):
+        data = {'changes': '{invalid json'}
+        resp = rest_api.patch('/commands/1', data)
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'Invalid' in resp.body
+
     def test_delete(self, rest_api, with_fixtures):
         resp = rest_api.delete('/commands/3')
 
@@ -470,6 +1151,13 @@ class TestApiCommands(object):
         assert resp.status == falcon.HTTP_BAD_REQUEST
         assert 'not modifiable' in resp.body
 
+    def test_patch_effects_forbidden(self, rest_api, with_fixtures):
+        data = {"effects": '{}'}
+        resp = rest_api.patch('/commands/3', data)
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'not modifiable' in resp.body
+
     def test_patch_actor_id_forbidden(self, rest_api, with_fixtures):
         data = {"actor_id": 503}
         resp = rest_api.patch('/commands/3', data)
@@ -490,3 +1178,242 @@ class TestApiCommands(object):
 
         assert resp.status == falcon.HTTP_BAD_REQUEST
         assert 'not modifiable' in resp.body
+
+
+class TestApiCommandBatch(object):
+    def test_post(self, rest_api, with_fixtures):
+        data = {'commands': [
+            {'operation': 'create deck', 'game_id': 1, 'actor_id': 600,
+             'changes': '{"stack_id": 10}'},
+            {'operation': 'shuffle stack', 'game_id': 1, 'actor_id': 600,
+             'changes': '{"stack_id": 10}'},
+            {'operation': 'noop', 'game_id': 1, 'actor_id': 600,
+             'changes': '{}', 'memo': 'nothing to see here'}]}
+
+        resp = rest_api.post('/commands/batch', data)
+
+        assert resp.status == falcon.HTTP_OK
+        assert [r['status'] for r in resp.json] == [falcon.HTTP_CREATED] * 3
+        assert resp.json[0]['data']['operation'] == 'create deck'
+        assert resp.json[2]['data']['changes'] == {}
+        assert resp.json[2]['data']['memo'] == 'nothing to see here'
+        cards = rest_api.get('/cards?stack_id=10')
+        assert len(cards.json) == 52
+        commands = rest_api.get('/commands')
+        assert len(commands.json) == len(fixtures.commands) + 3
+
+    def test_post_failure_rolled_back_alone(self, rest_api, with_fixtures):
+        data = {'commands': [
+            {'operation': 'move cards', 'game_id': 4, 'actor_id': 100,
+             'changes': '{"cards": [{"id": 1, "position": 5}]}'},
+            {'operation': 'move cards', 'game_id': 4, 'actor_id': 100,
+             'changes': '{"cards": [{"id": 2, "position": 6}, '
+                        '{"id": 80, "position": 7}]}'},
+            {'operation': 'invalid', 'game_id': 4, 'actor_id': 100,
+             'changes': '{}'},
+            {'operation': 'move cards', 'game_id': 4, 'actor_id': 100,
+             'changes': '{"cards": [{"id": 3, "position": 8}]}'}]}
+
+        resp = rest_api.post('/commands/batch', data)
+
+        assert resp.status == falcon.HTTP_OK
+        assert [r['status'] for r in resp.json] == [
+            falcon.HTTP_CREATED, falcon.HTTP_BAD_REQUEST,
+            falcon.HTTP_BAD_REQUEST, falcon.HTTP_CREATED]
+        assert 'Invalid' in resp.json[1]['title']
+        assert rest_api.get('/cards/1').json['position'] == 5
+        assert rest_api.get('/cards/2').json['position'] == 1
+        assert rest_api.get('/cards/3').json['position'] == 8
+        commands = rest_api.get('/commands')
+        assert len(commands.json) == len(fixtures.commands) + 2
+
+    def test_post_version_conflict(self, rest_api, with_fixtures):
+        data = {'commands': [
+            {'operation': 'move cards', 'game_id': 2, 'actor_id': 600,
+             'changes': '{"cards": [{"id": 3, "position": 8, '
+                        '"version": 1}]}'},
+            {'operation': 'move cards', 'game_id': 2, 'actor_id': 600,
+             'changes': '{"cards": [{"id": 3, "position": 9, '
+                        '"version": 1}]}'}]}
+
+        resp = rest_api.post('/commands/batch', data)
+
+        assert resp.status == falcon.HTTP_OK
+        assert [r['status'] for r in resp.json] == [
+            falcon.HTTP_CREATED, falcon.HTTP_CONFLICT]
+        card = rest_api.get('/cards/3').json
+        assert card['position'] == 8
+        assert card['version'] == 2
+
+    def test_post_protected_property(self, rest_api, with_fixtures):
+        data = {'commands': [{'operation': 'noop', 'id': 80,
+                              'changes': '{}'}]}
+
+        resp = rest_api.post('/commands/batch', data)
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json[0]['status'] == falcon.HTTP_BAD_REQUEST
+        assert 'not modifiable' in resp.json[0]['description']
+
+    def test_post_missing_commands(self, rest_api):
+        resp = rest_api.post('/commands/batch', {})
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'Missing' in resp.body
+
+    def test_post_invalid_commands(self, rest_api):
+        resp = rest_api.post('/commands/batch', {'commands': 'noop'})
+
+        assert resp.status == falcon.HTTP_BAD_REQUEST
+        assert 'Invalid' in resp.body
+
+
+class TestApiShards(object):
+    def test_games_dealt_to_shards(self, sharded_api):
+        assert seat(sharded_api, 'first') == (1, 1)
+        assert seat(sharded_api, 'second') == (shards.BLOCK + 1,
+                                               shards.BLOCK + 1)
+        assert seat(sharded_api, 'third') == (2, 2)
+
+    def test_get_games_across_shards(self, sharded_api):
+        for name in ['a', 'b', 'c']:
+            sharded_api.post('/games', {'name': name})
+
+        resp = sharded_api.get('/games')
+        assert [g['name'] for g in resp.json] == ['a', 'c', 'b']
+
+        resp = sharded_api.get('/games?__sort=-name&__limit=2')
+        assert [g['name'] for g in resp.json] == ['c', 'b']
+        assert json.loads(resp.body)['meta']['total'] == 3
+
+    def test_records_of_second_shard(self, sharded_api):
+        seat(sharded_api, 'first')
+        game_id, stack_id = seat(sharded_api, 'second')
+
+        cards = sharded_api.get('/cards?stack_id={}'.format(stack_id))
+        assert len(cards.json) == 52
+        card_id = cards.json[0]['id']
+        assert card_id > shards.BLOCK
+
+        resp = sharded_api.post('/commands', {
+            'operation': MOVE_CARDS, 'game_id': game_id, 'actor_id': 600,
+            'changes': {'cards': [{'id': card_id, 'position': 60}]}})
+        assert resp.status == falcon.HTTP_CREATED
+
+        card = sharded_api.get('/cards/{}'.format(card_id))
+        assert card.json['position'] == 60
+        assert card.json['version'] == 2
+        resp = sharded_api.get('/cards/{}'.format(card_id),
+                               headers={'If-None-Match': card.headers['etag']})
+        assert resp.status == falcon.HTTP_NOT_MODIFIED
+
+        state = sharded_api.get('/games/{}/state'.format(game_id))
+        assert len(state.json['stacks'][0]['cards']) == 52
+        assert sharded_api.get('/games/1/state').json['id'] == 1
+
+    def test_card_pages_merged(self, sharded_api):
+        seat(sharded_api, 'first')
+        seat(sharded_api, 'second')
+
+        ids = []
+        resp = sharded_api.get('/cards?__page_size=40')
+        while True:
+            ids.extend(c['id'] for c in resp.json)
+            cursor = json.loads(resp.body)['meta']['next']
+            if cursor is None:
+                break
+            resp = sharded_api.get('/cards?__page_size=40&__after=' + cursor)
+        streamed = sharded_api.get('/cards?__stream=ndjson')
+
+        assert len(ids) == len(set(ids)) == 104
+        assert [c['id'] for c in streamed.json] == ids
+
+    def test_batch_across_shards(self, sharded_api):
+        first, _ = seat(sharded_api, 'first')
+        second, _ = seat(sharded_api, 'second')
+        data = {'commands': [
+            {'operation': NOOP, 'game_id': first, 'actor_id': 600,
+             'changes': '{}'},
+            {'operation': NOOP, 'game_id': second, 'actor_id': 600,
+             'changes': '{}'}]}
+
+        resp = sharded_api.post('/commands/batch', data)
+
+        assert [r['status'] for r in resp.json] == [falcon.HTTP_CREATED] * 2
+        assert resp.json[1]['data']['id'] > shards.BLOCK
+        commands = sharded_api.get('/commands?game_id={}'.format(second))
+        assert [c['operation'] for c in commands.json] == [CREATE_DECK, NOOP]
+
+    def test_get_missing_beyond_shards(self, sharded_api):
+        resp = sharded_api.get('/cards/{}'.format(2 * shards.BLOCK + 1))
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+
+
+class TestApiReadWriteSplit(object):
+    @pytest.fixture()
+    def client(self, middleware, split_engines):
+        writer, reader = split_engines
+        return FakeClient(api.create_api(
+            middleware, writer, {'background': False}, read_engine=reader))
+
+    def test_reads_while_writing(self, client, split_engines):
+        writer, _ = split_engines
+        seat(client, 'first')
+
+        # the writer's only connection, in a long write transaction
+        with writer.connect() as conn:
+            with conn.begin():
+                conn.execute(Game.__table__.insert(), name='uncommitted')
+
+                responses = [client.get(path) for path in [
+                    '/games', '/games/1', '/games/1/state',
+                    '/games/1/view?player=1', '/games/1/replay',
+                    '/cards?__page_size=10', '/stacks/1', '/health/ready']]
+
+        assert [r.status for r in responses] == [falcon.HTTP_OK] * 8
+        assert [g['name'] for g in responses[0].json] == ['first']
+
+    def test_reads_own_writes(self, client):
+        created = client.post('/games', {'name': 'first'})
+        client.patch('/games/1', {'name': 'renamed'})
+
+        resp = client.get('/games/1')
+
+        assert created.status == falcon.HTTP_CREATED
+        assert resp.json['name'] == 'renamed'
+        assert resp.headers['etag'] == '"1-2"'
+
+    def test_snapshot_written(self, client, split_engines):
+        writer, _ = split_engines
+        game_id, _ = seat(client, 'first')
+        client.post('/commands/batch', {'commands': [
+            {'operation': NOOP, 'game_id': game_id, 'actor_id': 600,
+             'changes': '{}'}] * 98})
+        snapshots = storage.Snapshot.__table__.select()
+        assert writer.execute(snapshots).fetchall() == []
+
+        client.post('/commands', {'operation': NOOP, 'game_id': game_id,
+                                  'actor_id': 600, 'changes': '{}'})
+        resp = client.get('/games/1/replay')
+
+        assert resp.status == falcon.HTTP_OK
+        assert resp.json['command_id'] == 100
+        assert [s.command_id for s in writer.execute(snapshots)] == [100]
+
+        client.post('/commands/batch', {'commands': [
+            {'operation': NOOP, 'game_id': game_id, 'actor_id': 600,
+             'changes': '{}'}] * 100})
+
+        assert [s.command_id for s in writer.execute(snapshots)] == [
+            100, 200]
+
+    def test_health_of_reader(self, client):
+        resp = client.get('/health')
+
+        assert resp.json['details']['pool']['size'] == 3
+
+    def test_router_with_read_engine(self, middleware, engine):
+        with pytest.raises(ValueError):
+            api.create_api(middleware, shards.ShardRouter([engine]),
+                           read_engine=engine)
@@ -1,9 +1,13 @@
 import pytest
-from falcon import HTTPBadRequest
+from falcon import HTTPBadRequest, HTTPConflict
 from mock import patch
+from tests.unit.card_table import recorded_statements
 
-from card_table.commands import execute, Operations
-from card_table.storage import Command, Card
+from card_table.cards import ACE_LOW, DECK_ACE_LOW
+from card_table.commands import (execute, get_random, MAX_DECKS, Operations,
+                                 RANDOM, register, shoe_order, shuffle)
+from card_table.schema import integer
+from card_table.storage import Command, Card, Facing, Stack
 
 
 class TestExecute(object):
@@ -16,19 +20,22 @@ class TestExecute(object):
 
     def test_noop(self):
         session = None
-        command = Command(operation='noop', changes='{}')
+        command = Command(operation='noop', changes={})
 
         execute(session, command)
 
     @patch('card_table.storage.Stack.get')
     def test_create_deck(self, stack, session):
-        command = Command(operation='create deck', changes='{"stack_id": 1}')
+        command = Command(operation='create deck', changes={'stack_id': 1})
+        stack.return_value.id = 1
 
         execute(session, command)
 
     @patch('card_table.storage.Stack.get')
     def test_shuffle_stack(self, stack, session):
-        command = Command(operation='shuffle stack', changes='{"stack_id": 1}')
+        command = Command(operation='shuffle stack', changes={'stack_id': 1})
+        stack.return_value.id = 1
+        stack.return_value.is_shoe.return_value = False
 
         execute(session, command)
 
@@ -39,6 +46,44 @@ class TestExecute(object):
         with pytest.raises(HTTPBadRequest):
             execute(session, command)
 
+    def test_invalid_changes(self):
+        session = None
+        command = Command(operation='create deck',
+                          changes={'stack_id': 1, 'decks': 'two'})
+
+        with pytest.raises(HTTPBadRequest):
+            execute(session, command)
+
+    @patch('card_table.storage.Stack.get')
+    def test_seed_refused(self, stack, session):
+        command = Command(operation='shuffle stack',
+                          changes={'stack_id': 1, 'seed': 42})
+        stack.return_value.id = 1
+        stack.return_value.is_shoe.return_value = False
+
+        with pytest.raises(HTTPBadRequest):
+            execute(session, command)
+        execute(session, command, allow_secrets=True)
+        # the seed is not stored
+        assert command.changes == {'stack_id': 1}
+
+    @patch.dict('card_table.commands.REGISTRY')
+    def test_registered(self, session):
+        @register('deal hands', players=integer(required=True, minimum=1),
+                  cards=integer(default=5))
+        def deal_hands(db_session, **kwargs):
+            return db_session, kwargs
+
+        command = Command(operation='deal hands', changes={'players': 2})
+
+        assert execute(session, command) == (session, {'players': 2,
+                                                       'cards': 5})
+        assert deal_hands(session, players=3) == (session, {'players': 3,
+                                                            'cards': 5})
+        with pytest.raises(HTTPBadRequest):
+            execute(session, Command(operation='deal hands',
+                                     changes={'players': 0}))
+
 
 class TestCreateDeck(object):
 
@@ -51,12 +96,12 @@ class TestCreateDeck(object):
         assert session.query.get.called_once_with(1)
         assert len(deck) == 52
         assert session.addall.called_with(deck)
-        aces = [c for c in deck if c.rank == 'ace']
+        aces = [c for c in deck if c['rank'] == 'ace']
         assert len(aces) == 4
-        assert aces[0].rank_value == 1
-        kings = [c for c in deck if c.rank == 'king']
+        assert aces[0]['rank_value'] == 1
+        kings = [c for c in deck if c['rank'] == 'king']
         assert len(kings) == 4
-        assert kings[0].rank_value == 13
+        assert kings[0]['rank_value'] == 13
 
     @patch('sqlalchemy.orm.Session')
     def test_two_decks(self, session):
@@ -67,12 +112,12 @@ class TestCreateDeck(object):
         assert session.query.get.called_once_with(1)
         assert len(deck) == 104
         assert session.addall.called_with(deck)
-        aces = [c for c in deck if c.rank == 'ace']
+        aces = [c for c in deck if c['rank'] == 'ace']
         assert len(aces) == 8
-        assert aces[0].rank_value == 1
-        kings = [c for c in deck if c.rank == 'king']
+        assert aces[0]['rank_value'] == 1
+        kings = [c for c in deck if c['rank'] == 'king']
         assert len(kings) == 8
-        assert kings[0].rank_value == 13
+        assert kings[0]['rank_value'] == 13
 
     @patch('sqlalchemy.orm.Session')
     def test_deck_ace_high(self, session):
@@ -83,12 +128,12 @@ class TestCreateDeck(object):
         assert session.query.get.called_once_with(1)
         assert len(deck) == 52
         assert session.addall.called_with(deck)
-        twos = [c for c in deck if c.rank == '2']
+        twos = [c for c in deck if c['rank'] == '2']
         assert len(twos) == 4
-        assert twos[0].rank_value == 2
-        aces = [c for c in deck if c.rank == 'ace']
+        assert twos[0]['rank_value'] == 2
+        aces = [c for c in deck if c['rank'] == 'ace']
         assert len(aces) == 4
-        assert aces[0].rank_value == 14
+        assert aces[0]['rank_value'] == 14
 
     @patch('sqlalchemy.orm.Session')
     @patch('card_table.storage.Stack.get')
@@ -99,6 +144,55 @@ class TestCreateDeck(object):
         with pytest.raises(HTTPBadRequest):
             Operations.do_create_deck(session, **kwargs)
 
+    @patch('card_table.storage.Stack.get')
+    def test_deck_inserted(self, get, session):
+        kwargs = {'stack_id': 1, 'decks': 8}
+        get.return_value.id = 1
+
+        deck = Operations.do_create_deck(session, **kwargs)
+
+        inserted = Card.find_by_stack(1, session)
+        assert len(inserted) == len(deck) == 416
+        assert sorted(c.position for c in inserted) == list(range(416))
+        first = Card.get(1, session)
+        assert first.suit == deck[0]['suit']
+        assert first.rank == deck[0]['rank']
+        assert first.owner_facing == Facing.down
+        assert first.other_facing == Facing.down
+        assert first.version == 1
+        assert first.created_at == first.updated_at
+        assert Card.get(416, session).created_at == first.created_at
+
+    def test_virtual_deck(self, session, with_fixtures):
+        kwargs = {'stack_id': 10, 'decks': 8, 'virtual': True, 'seed': 42}
+
+        stack = Operations.do_create_deck(session, **kwargs)
+
+        assert stack.id == 10
+        assert stack.is_shoe()
+        assert stack.shoe_template == ACE_LOW
+        assert stack.shoe_size == 416
+        assert stack.shoe_remaining() == 416
+        assert len(Card.find_by_stack(10, session)) == 0
+
+    def test_virtual_deck_secret_seed(self, session, with_fixtures):
+        command = Command(operation='create deck',
+                          changes={'stack_id': 10, 'virtual': True})
+
+        stack = execute(session, command)
+
+        # 128 bits of system randomness, only in the stack and the effects
+        assert len(stack.shoe_seed) == 32
+        assert command.effects == {'shoe_seed': stack.shoe_seed}
+        assert command.changes == {'stack_id': 10, 'virtual': True}
+
+    def test_virtual_deck_twice(self, session, with_fixtures):
+        kwargs = {'stack_id': 10, 'virtual': True}
+        Operations.do_create_deck(session, **kwargs)
+
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_create_deck(session, **kwargs)
+
     def test_deck_missing_stack_id(self):
         session = None
         kwargs = {}
@@ -113,40 +207,75 @@ class TestCreateDeck(object):
         with pytest.raises(HTTPBadRequest):
             Operations.do_create_deck(session, **kwargs)
 
+    def test_too_many_decks(self):
+        session = None
+        kwargs = {'stack_id': 10, 'decks': MAX_DECKS + 1, 'virtual': True}
+
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_create_deck(session, **kwargs)
+
 
 class TestShuffleStack(object):
 
-    @patch('card_table.storage.Card.find_by_stack')
-    @patch('card_table.storage.Stack.get')
     @patch('card_table.commands.RANDOM')
-    def test_shuffle(self, random, get, find_by_stack, session):
-        cards = stub_cards()
-        find_by_stack.return_value = cards
-        kwargs = {'stack_id': 1}
-        random.randrange.side_effect = [2, 1, 0, 0]
+    def test_shuffle(self, random, session, with_fixtures):
+        kwargs = {'stack_id': 2}
+        random.randrange.side_effect = [0, 0, 0, 0]
 
         Operations.do_shuffle_stack(session, **kwargs)
 
-        assert find_by_stack.called_once_with(1, session)
-        assert random.randrange.call_count == len(cards)
-        assert cards[2].position == 0
-        assert cards[1].position == 1
-        assert cards[0].position == 2
-        assert cards[3].position == 3
+        assert random.randrange.call_count == 4
+        assert Card.get(3, session).position == 1
+        assert Card.get(4, session).position == 2
+        assert Card.get(5, session).position == 3
+        assert Card.get(6, session).position == 4
+        assert Card.get(7, session).position == 0
 
-    @patch('card_table.storage.Card.find_by_stack')
-    @patch('card_table.storage.Stack.get')
     @patch('card_table.commands.RANDOM')
-    def test_shuffle_empty(self, random, get, find_by_stack, session):
-        find_by_stack.return_value = []
-        kwargs = {'stack_id': 1}
-        random.randrange.side_effect = [2, 1, 0, 0]
+    def test_shuffle_empty(self, random, session, with_fixtures):
+        kwargs = {'stack_id': 3}
 
         Operations.do_shuffle_stack(session, **kwargs)
 
-        assert find_by_stack.called_once_with(1, session)
         assert random.randrange.call_count == 0
 
+    def test_shuffle_shoe(self, session, with_fixtures):
+        Operations.do_create_deck(session, **{'stack_id': 10,
+                                              'virtual': True})
+
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_shuffle_stack(session, **{'stack_id': 10})
+
+    def test_shuffle_seeded(self, session, with_fixtures):
+        kwargs = {'stack_id': 2, 'seed': 1234}
+
+        expected = shuffle(list(range(5)), get_random(1234))
+
+        Operations.do_shuffle_stack(session, **kwargs)
+
+        assert [Card.get(i, session).position for i in range(3, 8)] == \
+            expected
+
+    def test_shuffle_query_count(self, engine, session, with_fixtures):
+        with recorded_statements(engine) as statements:
+            Operations.do_shuffle_stack(session, **{'stack_id': 2})
+
+        # the stack, the card ids, one executemany UPDATE
+        assert len(statements) == 3
+
+    def test_shuffle_advances_versions(self, session, with_fixtures):
+        Operations.do_shuffle_stack(session, **{'stack_id': 2})
+
+        assert [Card.get(i, session).version for i in range(3, 8)] == [2] * 5
+
+    @patch('card_table.storage.Card.find_versions_by_stack')
+    def test_shuffle_lost_race(self, find_versions, session, with_fixtures):
+        # card 7 was changed after its version was read
+        find_versions.return_value = [(3, 1), (4, 1), (5, 1), (6, 1), (7, 0)]
+
+        with pytest.raises(HTTPConflict):
+            Operations.do_shuffle_stack(session, **{'stack_id': 2})
+
     @patch('card_table.storage.Stack.get')
     def test_shuffle_missing_stack(self, get):
         session = None
@@ -164,6 +293,28 @@ class TestShuffleStack(object):
             Operations.do_shuffle_stack(session, **kwargs)
 
 
+class TestShuffle(object):
+
+    def test_permutation(self):
+        items = shuffle(list(range(52)))
+
+        assert sorted(items) == list(range(52))
+
+    def test_in_place(self):
+        items = list(range(10))
+
+        assert shuffle(items) is items
+
+    def test_seeded_reproducible(self):
+        first = shuffle(list(range(52)), get_random(7))
+        second = shuffle(list(range(52)), get_random(7))
+
+        assert first == second
+
+    def test_default_random(self):
+        assert get_random() is RANDOM
+
+
 class TestMoveCards(object):
 
     def test_card_reorder(self, session, with_fixtures):
@@ -199,11 +350,11 @@ class TestMoveCards(object):
         with pytest.raises(HTTPBadRequest):
             Operations.do_move_cards(session, **kwargs)
 
-    @patch('card_table.storage.Card.get')
-    def test_card_invalid_id(self, get):
+    @patch('card_table.storage.Card.find_by_ids')
+    def test_card_invalid_id(self, find_by_ids):
         session = None
         kwargs = {"cards": [{"id": 80}]}
-        get.return_value = None
+        find_by_ids.return_value = []
 
         with pytest.raises(HTTPBadRequest):
             Operations.do_move_cards(session, **kwargs)
@@ -214,20 +365,132 @@ class TestMoveCards(object):
         with pytest.raises(HTTPBadRequest):
             Operations.do_move_cards(session, **kwargs)
 
+    def test_first_invalid_reported(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 80, "position": 0},
+                            {"id": 4, "updated_at": "2016-09-14T14:25:47Z"}]}
+
+        with pytest.raises(HTTPBadRequest) as error:
+            Operations.do_move_cards(session, **kwargs)
+        assert error.value.title == 'Invalid parameter'
+        assert 'updated_at' not in error.value.description
+
     def test_card_changes_stack_invalid(self, session, with_fixtures):
         kwargs = {"cards": [{"id": 4, "stack_id": 80}]}
 
         with pytest.raises(HTTPBadRequest):
             Operations.do_move_cards(session, **kwargs)
 
+    def test_many_cards(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 3, "stack_id": 3, "position": 0},
+                            {"id": 4, "stack_id": 3, "position": 1},
+                            {"id": 5, "position": 0},
+                            {"id": 6, "owner_facing": "down"}]}
+
+        Operations.do_move_cards(session, **kwargs)
+        assert Card.get(3, session).stack_id == 3
+        assert Card.get(4, session).stack_id == 3
+        assert Card.get(4, session).position == 1
+        assert Card.get(5, session).position == 0
+        assert Card.get(6, session).owner_facing == Facing.down
+
+    def test_card_moved_twice(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 3, "position": 4},
+                            {"id": 4, "position": 0},
+                            {"id": 3, "position": 2}]}
+
+        with pytest.raises(HTTPBadRequest) as error:
+            Operations.do_move_cards(session, **kwargs)
+        assert error.value.title == 'Invalid parameter'
+        assert Card.get(3, session).position == 0
+        assert Card.get(4, session).position == 1
+
+    def test_invalid_card_in_batch(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 3, "position": 4},
+                            {"id": 80, "position": 0}]}
+
+        with pytest.raises(HTTPBadRequest) as error:
+            Operations.do_move_cards(session, **kwargs)
+        assert error.value.title == 'Invalid parameter'
+        # nothing is written when any part of the batch is invalid
+        assert Card.get(3, session).position == 0
+
+    def test_draw_from_shoe(self, session, with_fixtures):
+        Operations.do_create_deck(session, **{'stack_id': 10, 'decks': 2,
+                                              'virtual': True, 'seed': 42})
+        kwargs = {"cards": [{"draw_from": 10, "stack_id": 9, "position": 1},
+                            {"draw_from": 10, "stack_id": 9, "position": 2}]}
+        order = shoe_order('42', 104)
+
+        Operations.do_move_cards(session, **kwargs)
+
+        drawn = sorted(Card.find_by_stack(9, session),
+                       key=lambda c: c.position)
+        assert len(drawn) == 3
+        for card, index in zip(drawn[1:], order):
+            assert card.rank == DECK_ACE_LOW[index % 52].rank
+            assert card.suit == DECK_ACE_LOW[index % 52].suit
+        assert Stack.get(10, session).shoe_remaining() == 102
+
+    def test_draw_from_ordinary_stack(self, session, with_fixtures):
+        kwargs = {"cards": [{"draw_from": 1, "stack_id": 9}]}
+
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_move_cards(session, **kwargs)
 
-def stub_cards():
-    from card_table.cards import CLUB, DIAMOND, HEART, KING, SPADE
-    from card_table.storage import Card
+    def test_draw_from_empty_shoe(self, session, with_fixtures):
+        Operations.do_create_deck(session, **{'stack_id': 10,
+                                              'virtual': True})
+        kwargs = {"cards": [{"draw_from": 10, "stack_id": 9}] * 53}
 
-    result_set = [Card(stack_id=1, position=0, suit=CLUB, rank=KING),
-                  Card(stack_id=1, position=0, suit=DIAMOND, rank=KING),
-                  Card(stack_id=1, position=0, suit=HEART, rank=KING),
-                  Card(stack_id=1, position=0, suit=SPADE, rank=KING)]
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_move_cards(session, **kwargs)
+        assert len(Card.find_by_stack(9, session)) == 1
+
+    def test_draw_missing_stack_id(self, session, with_fixtures):
+        Operations.do_create_deck(session, **{'stack_id': 10,
+                                              'virtual': True})
+        kwargs = {"cards": [{"draw_from": 10}]}
+
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_move_cards(session, **kwargs)
+
+    def test_version_expected(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 4, "position": 4, "version": 1}]}
+
+        Operations.do_move_cards(session, **kwargs)
+        assert Card.get(4, session).position == 4
+        assert Card.get(4, session).version == 2
+
+    def test_version_stale(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 4, "position": 4, "version": 3}]}
+
+        with pytest.raises(HTTPConflict):
+            Operations.do_move_cards(session, **kwargs)
+        assert Card.get(4, session).position == 1
+
+    def test_version_invalid(self, session, with_fixtures):
+        kwargs = {"cards": [{"id": 4, "position": 4, "version": "1"}]}
+
+        with pytest.raises(HTTPBadRequest):
+            Operations.do_move_cards(session, **kwargs)
+
+    def test_lost_race(self, session, with_fixtures):
+        # the card is read at version 1, then moved by another request
+        card = Card.get(4, session)
+        cards_table = Card.__table__
+        session.execute(cards_table.update().where(
+            cards_table.c.id == 4).values(version=2))
+
+        with pytest.raises(HTTPConflict):
+            Operations.do_move_cards(session, **{"cards": [
+                {"id": 4, "position": 4}]})
+        assert card.version == 1
+
+    def test_query_count_constant(self, engine, session, with_fixtures):
+        kwargs = {"cards": [{"id": i, "position": i} for i in range(1, 11)]}
+
+        with recorded_statements(engine) as statements:
+            Operations.do_move_cards(session, **kwargs)
 
-    return result_set
+        # one SELECT for the cards, one executemany UPDATE
+        assert len(statements) == 2
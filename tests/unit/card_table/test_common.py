@@ -0,0 +1,71 @@
+import pytest
+from falcon import HTTPBadRequest
+
+from card_table.common import (all_modifiable, ensure_all_modifiable,
+                               ensure_modifiable, unmodifiable_keys)
+from card_table.storage import Card, Stack
+
+
+class TestEnsureModifiable(object):
+
+    def test_modifiable(self):
+        assert not ensure_modifiable(Stack, {'label': 'hand'})
+
+    def test_protected(self):
+        with pytest.raises(HTTPBadRequest):
+            ensure_modifiable(Stack, {'label': 'hand', 'shoe_seed': 1})
+
+    def test_immutable(self):
+        with pytest.raises(HTTPBadRequest):
+            ensure_modifiable(Stack, {'game_id': 1})
+
+    def test_allow_immutables(self):
+        assert not ensure_modifiable(Stack, {'game_id': 1},
+                                     allow_immutables=True)
+
+    def test_exceptions(self):
+        assert not ensure_modifiable(Card, {'id': 1, 'position': 0},
+                                     exceptions=['id'])
+
+
+class TestEnsureAllModifiable(object):
+
+    def test_modifiable(self):
+        ensure_all_modifiable(Card, [{'id': 1, 'position': 0},
+                                     {'id': 2, 'stack_id': 3}],
+                              exceptions=['id'])
+
+    def test_refused(self):
+        with pytest.raises(HTTPBadRequest) as error:
+            ensure_all_modifiable(Card, [{'id': 1, 'position': 0},
+                                         {'id': 2, 'created_at': 'now'}],
+                                  exceptions=['id'])
+
+        assert 'created_at' in error.value.description
+
+
+class TestAllModifiable(object):
+
+    def test_modifiable(self):
+        assert all_modifiable(Card, [{'id': 1, 'position': 0},
+                                     {'id': 2, 'stack_id': 3}],
+                              exceptions=['id'])
+
+    def test_refused(self):
+        assert not all_modifiable(Card, [{'id': 1, 'position': 0},
+                                         {'id': 2, 'created_at': 'now'}],
+                                  exceptions=['id'])
+
+
+class TestUnmodifiableKeys(object):
+
+    def test_keys(self):
+        assert unmodifiable_keys(Stack) == frozenset([
+            'id', 'version', 'created_at', 'updated_at', 'shoe_template',
+            'shoe_size', 'shoe_seed', 'shoe_cursor', 'game_id'])
+        assert 'game_id' not in unmodifiable_keys(Stack, True)
+        assert 'id' not in unmodifiable_keys(Card,
+                                             exceptions=frozenset(['id']))
+
+    def test_computed_once(self):
+        assert unmodifiable_keys(Card) is unmodifiable_keys(Card)
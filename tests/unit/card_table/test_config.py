@@ -0,0 +1,59 @@
+import pytest
+
+from card_table import config
+
+DEFAULTS = {'url': 'sqlite:///:memory:', 'pool_size': 5,
+            'shared_cache': False, 'ratio': 0.5}
+
+
+@pytest.fixture()
+def config_file(tmpdir, monkeypatch):
+    path = tmpdir.join('card_table.ini')
+    path.write('[database]\nurl = sqlite:///from_file.db\npool_size = 7\n')
+    monkeypatch.setenv(config.CONFIG_FILE_ENV, str(path))
+    return path
+
+
+class TestSettings(object):
+
+    def test_defaults(self, monkeypatch):
+        monkeypatch.delenv(config.CONFIG_FILE_ENV, raising=False)
+
+        assert config.settings('database', DEFAULTS) == DEFAULTS
+
+    def test_environment(self, monkeypatch):
+        monkeypatch.setenv('CARD_TABLE_DATABASE_POOL_SIZE', '20')
+        monkeypatch.setenv('CARD_TABLE_DATABASE_SHARED_CACHE', 'true')
+        monkeypatch.setenv('CARD_TABLE_DATABASE_RATIO', '0.25')
+
+        result = config.settings('database', DEFAULTS)
+
+        assert result['pool_size'] == 20
+        assert result['shared_cache'] is True
+        assert result['ratio'] == 0.25
+        assert result['url'] == DEFAULTS['url']
+
+    def test_file(self, config_file):
+        result = config.settings('database', DEFAULTS)
+
+        assert result['url'] == 'sqlite:///from_file.db'
+        assert result['pool_size'] == 7
+
+    def test_environment_overrides_file(self, config_file, monkeypatch):
+        monkeypatch.setenv('CARD_TABLE_DATABASE_POOL_SIZE', '20')
+
+        result = config.settings('database', DEFAULTS)
+
+        assert result['url'] == 'sqlite:///from_file.db'
+        assert result['pool_size'] == 20
+
+    def test_missing_section(self, config_file):
+        assert config.settings('logging', {'level': 'INFO'}) == {
+            'level': 'INFO'}
+
+    def test_missing_file(self, tmpdir, monkeypatch):
+        monkeypatch.setenv(config.CONFIG_FILE_ENV,
+                           str(tmpdir.join('missing.ini')))
+
+        with pytest.raises(ValueError):
+            config.settings('database', DEFAULTS)
@@ -0,0 +1,102 @@
+import threading
+
+from sqlalchemy.orm import sessionmaker
+
+from card_table import events
+from card_table.commands import CREATE_DECK, MOVE_CARDS, NOOP, SHUFFLE_STACK
+from card_table.storage import Command
+
+
+class TestChangeNotifier(object):
+
+    def test_notify(self):
+        notifier = events.ChangeNotifier()
+        notifier.notify(2, 5)
+        notifier.notify(2, 4)
+
+        assert notifier.latest == {2: 5}
+        assert notifier.wait(2, 4, 0)
+        assert not notifier.wait(2, 5, 0)
+        assert not notifier.wait(3, 0, 0)
+
+    def test_wait_woken(self):
+        notifier = events.ChangeNotifier()
+        timer = threading.Timer(0.01, notifier.notify, [2, 6])
+        timer.start()
+
+        assert notifier.wait(2, 5, 5)
+        timer.join()
+
+    def test_committed(self, engine, with_fixtures):
+        notifier = events.ChangeNotifier()
+        sessions = sessionmaker(bind=engine)
+        notifier.listen(sessions)
+        session = sessions()
+        session.add(Command(operation=NOOP, game_id=4, actor_id=100,
+                            changes={}))
+        session.commit()
+
+        assert notifier.latest == {4: 4}
+
+    def test_rolled_back(self, engine, with_fixtures):
+        notifier = events.ChangeNotifier()
+        sessions = sessionmaker(bind=engine)
+        notifier.listen(sessions)
+        session = sessions()
+        session.add(Command(operation=NOOP, game_id=4, actor_id=100,
+                            changes={}))
+        session.flush()
+        session.rollback()
+
+        assert notifier.latest == {}
+
+
+class TestCommandEvents(object):
+
+    def test_events(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            found = events.command_events(conn, 2, 1)
+
+        assert [e['id'] for e in found] == [2, 3]
+        assert found[0]['changes']['cards'][0]['stack_id'] == [8, 9]
+        assert found[1]['operation'] == NOOP
+        assert found[1]['actor_id'] == 700
+        assert found[1]['created_at'].endswith('Z')
+        assert 'memo' not in found[1]
+
+    def test_events_hide_moved_ids(self, engine, session, with_fixtures):
+        session.add(Command(operation=MOVE_CARDS, game_id=4, actor_id=100,
+                            changes={'cards': [
+                                {'id': 1, 'stack_id': 2, 'position': 5,
+                                 'version': 1},
+                                {'draw_from': 3, 'stack_id': 2,
+                                 'position': 6, 'owner_facing': 'up'}]}))
+        session.commit()
+
+        with engine.connect() as conn:
+            found = events.command_events(conn, 4, 0)
+
+        assert found[-1]['changes'] == {'cards': [
+            {'stack_id': 2, 'position': 5},
+            {'draw_from': 3, 'stack_id': 2, 'position': 6,
+             'owner_facing': 'up'}]}
+
+    def test_events_limit(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            found = events.command_events(conn, 2, 0, limit=1)
+
+        assert [e['id'] for e in found] == [1]
+
+    def test_events_hide_seeds(self, engine, session, with_fixtures):
+        session.add(Command(operation=SHUFFLE_STACK, game_id=4, actor_id=100,
+                            changes={'stack_id': 1, 'seed': 1234}))
+        session.add(Command(operation=CREATE_DECK, game_id=4, actor_id=100,
+                            changes={'stack_id': 1, 'virtual': True,
+                                     'seed': 99}))
+        session.commit()
+
+        with engine.connect() as conn:
+            found = events.command_events(conn, 4, 0)
+
+        assert found[0]['changes'] == {'stack_id': 1}
+        assert found[1]['changes'] == {'stack_id': 1, 'virtual': True}
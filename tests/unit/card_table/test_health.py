@@ -0,0 +1,114 @@
+import time
+
+import pytest
+from mock import patch
+
+from card_table import health, storage
+
+
+@pytest.fixture()
+def shared_engine():
+    db_engine = storage.build_engine('sqlite:///:memory:', shared_cache=True,
+                                     pool_size=2, max_overflow=2)
+    storage.sync(db_engine)
+    return db_engine
+
+
+class TestHealthMonitor(object):
+
+    def test_thread_local_probes_on_read(self, engine):
+        monitor = health.HealthMonitor(engine, ttl=60)
+
+        first = monitor.current()
+
+        assert not monitor.background
+        assert first.available
+        assert monitor.current() is first
+        assert monitor.thread is None
+
+    def test_thread_local_expires(self, engine):
+        monitor = health.HealthMonitor(engine, ttl=0)
+
+        first = monitor.current()
+        storage.Base.metadata.drop_all(engine)
+
+        assert not monitor.current().available
+        assert monitor.current() is not first
+
+    def test_background_refresh(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, ttl=0.01)
+        try:
+            first = monitor.current()
+            assert monitor.background
+            assert monitor.thread.is_alive()
+
+            storage.Base.metadata.drop_all(shared_engine)
+            deadline = time.monotonic() + 5
+            while monitor.current().available and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+            assert first.available
+            assert not monitor.current().available
+        finally:
+            monitor.stop()
+        assert not monitor.thread.is_alive()
+
+    def test_background_survives_failure(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, ttl=0.01)
+        monitor.current()
+        try:
+            with patch.object(monitor, 'is_db_available',
+                              side_effect=RuntimeError):
+                time.sleep(0.05)
+            assert monitor.thread.is_alive()
+        finally:
+            monitor.stop()
+
+    def test_ready(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, background=False)
+        assert monitor.ready(monitor.current()) is None
+
+    def test_ready_unavailable(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, background=False)
+        verdict = monitor.current()._replace(available=False)
+        assert monitor.ready(verdict) == 'Database unavailable'
+
+    def test_ready_overdue(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, ttl=1, stale_after=3,
+                                       background=False)
+        verdict = monitor.current()
+        verdict = verdict._replace(checked_at=verdict.checked_at - 3)
+        assert monitor.ready(verdict) == 'Database probe overdue'
+
+    def test_ready_slow(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, max_latency_ms=10,
+                                       background=False)
+        verdict = monitor.current()._replace(latency_ms=10.5)
+        assert monitor.ready(verdict) == 'Database responding slowly'
+
+    def test_ready_saturated(self, shared_engine):
+        monitor = health.HealthMonitor(shared_engine, max_saturation=0.75,
+                                       background=False)
+        connections = [shared_engine.connect() for _ in range(3)]
+        try:
+            verdict = monitor.probe()
+        finally:
+            for conn in connections:
+                conn.close()
+
+        assert verdict.pool['checked_out'] == 3
+        assert verdict.pool['saturation'] == 0.75
+        assert monitor.ready(verdict) == 'Database connections exhausted'
+
+
+class TestPoolStatus(object):
+
+    def test_queue_pool(self, shared_engine):
+        with shared_engine.connect():
+            status = health.pool_status(shared_engine)
+
+        assert status == {'size': 2, 'checked_out': 1, 'overflow': 0,
+                          'saturation': 0.25}
+
+    def test_uncounted_pool(self, engine):
+        assert health.pool_status(engine) == {}
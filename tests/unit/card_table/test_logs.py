@@ -0,0 +1,178 @@
+import io
+import json
+import logging
+import queue
+import random
+
+import pytest
+
+from card_table import config, logs
+
+
+@pytest.fixture()
+def root():
+    """ The root logger, restored to its pipeline and level afterwards """
+    root = logging.getLogger()
+    level = root.level
+    pipeline = logs._pipeline
+    if pipeline is not None:
+        root.removeHandler(pipeline[0])
+    logs._pipeline = None
+    yield root
+    logs.unconfigure()
+    logs._pipeline = pipeline
+    if pipeline is not None:
+        root.addHandler(pipeline[0])
+    root.setLevel(level)
+
+
+def record(name='card_table.api', level=logging.INFO, msg='moved %d cards',
+           args=(3,), exc_info=None):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, exc_info)
+
+
+class TestConfigure(object):
+
+    def test_text(self, root):
+        out = io.StringIO()
+        logs.configure(level='DEBUG', stream=out)
+
+        logging.getLogger('card_table.test').debug('moved %d cards', 3)
+        logs.unconfigure()
+
+        assert root.level == logging.DEBUG
+        assert '[card_table.test] [DEBUG] moved 3 cards' in out.getvalue()
+
+    def test_json(self, root):
+        out = io.StringIO()
+        logs.configure(format='json', stream=out)
+
+        logging.getLogger('card_table.test').info('moved %d cards', 3)
+        logs.unconfigure()
+
+        entry = json.loads(out.getvalue())
+        assert entry['level'] == 'INFO'
+        assert entry['logger'] == 'card_table.test'
+        assert entry['message'] == 'moved 3 cards'
+
+    def test_exception_formatted_by_listener(self, root):
+        out = io.StringIO()
+        logs.configure(format='json', stream=out)
+
+        try:
+            raise RuntimeError('boom')
+        except RuntimeError:
+            logging.getLogger('card_table.test').exception('failed')
+        logs.unconfigure()
+
+        entry = json.loads(out.getvalue())
+        assert 'RuntimeError: boom' in entry['exc_info']
+
+    def test_sampled(self, root):
+        out = io.StringIO()
+        logs.configure(sampled='sqlalchemy.engine', sample_rate=0.0,
+                       stream=out)
+
+        logging.getLogger('sqlalchemy.engine.base.Engine').info('SELECT 1')
+        logging.getLogger('sqlalchemy.engine.base.Engine').warning('slow')
+        logging.getLogger('card_table.test').info('kept')
+        logs.unconfigure()
+
+        lines = out.getvalue().splitlines()
+        assert len(lines) == 2
+        assert 'slow' in lines[0]
+        assert 'kept' in lines[1]
+
+    def test_replaces_pipeline(self, root):
+        first = io.StringIO()
+        logs.configure(stream=first)
+        second = io.StringIO()
+        handler = logs.configure(stream=second)
+
+        logging.getLogger('card_table.test').info('once')
+        handlers = list(root.handlers)
+        logs.unconfigure()
+
+        assert handlers == [handler]
+        assert first.getvalue() == ''
+        assert 'once' in second.getvalue()
+
+    def test_unknown_format(self, root):
+        with pytest.raises(ValueError):
+            logs.configure(format='xml')
+
+
+class TestDroppingQueueHandler(object):
+
+    def test_drops_when_full(self):
+        handler = logs.DroppingQueueHandler(queue.Queue(1))
+
+        handler.handle(record())
+        handler.handle(record())
+
+        assert handler.queue.qsize() == 1
+        assert handler.dropped == 1
+
+    def test_renders_message_only(self):
+        handler = logs.DroppingQueueHandler(queue.Queue())
+
+        handler.handle(record())
+        queued = handler.queue.get_nowait()
+
+        assert queued.msg == 'moved 3 cards'
+        assert queued.args is None
+
+
+class TestSamplingFilter(object):
+
+    def test_rate(self):
+        sampler = logs.SamplingFilter(['sqlalchemy.engine'], 0.25,
+                                      random.Random(1234))
+
+        passed = sum(sampler.filter(record('sqlalchemy.engine.base.Engine'))
+                     for _ in range(1000))
+
+        assert 200 < passed < 300
+
+    def test_other_loggers(self):
+        sampler = logs.SamplingFilter(['sqlalchemy.engine'], 0.0)
+
+        assert sampler.filter(record('card_table.api'))
+        assert sampler.filter(record('sqlalchemy.engineering'))
+        assert not sampler.filter(record('sqlalchemy.engine'))
+
+    def test_warnings_pass(self):
+        sampler = logs.SamplingFilter(['sqlalchemy.engine'], 0.0)
+
+        assert sampler.filter(record('sqlalchemy.engine',
+                                     level=logging.WARNING))
+
+
+class TestLevel(object):
+
+    def test_set_level(self, root):
+        logs.set_level('warning')
+        assert root.level == logging.WARNING
+
+    def test_set_level_unknown(self, root):
+        with pytest.raises(ValueError):
+            logs.set_level('CHATTY')
+
+    def test_reload_level(self, root, tmpdir, monkeypatch):
+        path = tmpdir.join('card_table.ini')
+        path.write('[logging]\nlevel = ERROR\n')
+        monkeypatch.setenv(config.CONFIG_FILE_ENV, str(path))
+        monkeypatch.delenv('CARD_TABLE_LOGGING_LEVEL', raising=False)
+
+        logs.reload_level()
+
+        assert root.level == logging.ERROR
+
+    def test_reload_level_unset(self, root, monkeypatch):
+        monkeypatch.delenv(config.CONFIG_FILE_ENV, raising=False)
+        monkeypatch.delenv('CARD_TABLE_LOGGING_LEVEL', raising=False)
+        root.setLevel(logging.INFO)
+
+        logs.reload_level()
+
+        assert root.level == logging.INFO
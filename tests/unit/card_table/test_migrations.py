@@ -0,0 +1,158 @@
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.orm import sessionmaker
+
+from card_table import migrations, storage
+
+
+def index_names(db_engine, table):
+    return {index['name'] for index in inspect(db_engine).get_indexes(table)}
+
+
+""" The schema of the first release, before any migration """
+BASELINE = [
+    """CREATE TABLE games (
+        id INTEGER NOT NULL,
+        name VARCHAR,
+        state VARCHAR(9),
+        created_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (id),
+        CONSTRAINT gamestate CHECK (state IN ('forming', 'starting',
+            'cancelled', 'playing', 'paused', 'abandoned', 'finished')))""",
+    'CREATE INDEX ix_games_updated_at ON games (updated_at)',
+    """CREATE TABLE commands (
+        id INTEGER NOT NULL,
+        game_id INTEGER,
+        actor_id INTEGER,
+        operation VARCHAR,
+        changes TEXT,
+        memo VARCHAR,
+        created_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(game_id) REFERENCES games (id))""",
+    'CREATE INDEX ix_commands_updated_at ON commands (updated_at)',
+    'CREATE INDEX ix_commands_operation ON commands (operation)',
+    """CREATE TABLE stacks (
+        id INTEGER NOT NULL,
+        game_id INTEGER,
+        owner_id INTEGER,
+        label VARCHAR,
+        created_at DATETIME,
+        updated_at DATETIME,
+        size_visibility INTEGER,
+        size_limit INTEGER,
+        PRIMARY KEY (id),
+        FOREIGN KEY(game_id) REFERENCES games (id))""",
+    'CREATE INDEX ix_stacks_label ON stacks (label)',
+    'CREATE INDEX ix_stacks_updated_at ON stacks (updated_at)',
+    'CREATE INDEX ix_stacks_owner_id ON stacks (owner_id)',
+    """CREATE TABLE cards (
+        id INTEGER NOT NULL,
+        stack_id INTEGER,
+        position INTEGER,
+        owner_facing VARCHAR(8),
+        other_facing VARCHAR(8),
+        suit VARCHAR,
+        suit_value VARCHAR,
+        rank VARCHAR,
+        rank_value INTEGER,
+        created_at DATETIME,
+        updated_at DATETIME,
+        PRIMARY KEY (id),
+        FOREIGN KEY(stack_id) REFERENCES stacks (id),
+        CONSTRAINT facing CHECK (owner_facing IN ('down', 'revealed',
+            'peeking', 'up')),
+        CONSTRAINT facing CHECK (other_facing IN ('down', 'revealed',
+            'peeking', 'up')))""",
+    'CREATE INDEX ix_cards_updated_at ON cards (updated_at)']
+
+
+@pytest.fixture()
+def old_engine():
+    """ A database as created by the first release, with a game in play """
+    db_engine = storage.build_engine('sqlite:///:memory:')
+    for statement in BASELINE + [
+            "INSERT INTO games (name, state) VALUES ('before', 'playing')",
+            "INSERT INTO stacks (game_id, owner_id, label) "
+            "VALUES (1, 0, 'draw pile')",
+            "INSERT INTO commands (game_id, actor_id, operation, changes) "
+            "VALUES (1, 100, 'noop', '{}')"]:
+        db_engine.execute(statement)
+    return db_engine
+
+
+class TestMigrate(object):
+
+    def test_upgrades_existing(self, old_engine):
+        applied = migrations.migrate(old_engine)
+
+        assert [m.version for m in applied] == [1, 2, 3]
+        assert 'ix_cards_stack_id_position' in index_names(old_engine,
+                                                           'cards')
+        assert index_names(old_engine, 'stacks') == {
+            'ix_stacks_game_id_owner_id_label', 'ix_stacks_owner_id',
+            'ix_stacks_label', 'ix_stacks_updated_at'}
+        assert index_names(old_engine, 'snapshots') == {
+            'ix_snapshots_game_id_command_id'}
+
+    def test_adds_columns(self, old_engine):
+        migrations.migrate(old_engine)
+
+        session = sessionmaker(bind=old_engine)()
+        stack = storage.Stack.get(1, session)
+        assert stack.label == 'draw pile'
+        assert stack.shoe_template is None
+        assert not stack.is_shoe()
+        command = session.query(storage.Command).get(1)
+        assert command.changes == {}
+        assert command.effects is None
+
+    def test_adds_versions(self, old_engine):
+        migrations.migrate(old_engine)
+
+        games = storage.Game.__table__
+        assert old_engine.execute(games.select()).first().version == 1
+        old_engine.execute('INSERT INTO cards (stack_id) VALUES (1)')
+        assert old_engine.execute('SELECT version FROM cards').scalar() == 1
+
+    def test_once(self, old_engine):
+        migrations.migrate(old_engine)
+
+        assert migrations.migrate(old_engine) == []
+        with old_engine.connect() as conn:
+            assert migrations.applied(conn) == {1, 2, 3}
+
+    def test_new_database(self):
+        db_engine = storage.build_engine('sqlite:///:memory:')
+
+        migrations.migrate(db_engine)
+
+        assert db_engine.has_table('cards')
+        assert 'ix_commands_game_id_id' in index_names(db_engine, 'commands')
+        with db_engine.connect() as conn:
+            assert migrations.pending(conn) == []
+
+    def test_pending(self, old_engine):
+        with old_engine.connect() as conn:
+            assert [m.version for m in migrations.pending(conn)] == [1, 2, 3]
+        assert not old_engine.has_table('schema_migrations')
+
+    def test_out_of_order(self):
+        with pytest.raises(ValueError):
+            migrations.migration(1, 'again')(lambda conn: None)
+        assert migrations.MIGRATIONS[1].name != 'again'
+
+    def test_main_list(self, tmpdir, capsys):
+        url = 'sqlite:///' + str(tmpdir.join('cards.db'))
+
+        assert migrations.main([url, '--list']) == 0
+        assert migrations.main([url]) == 0
+        assert migrations.main([url, '--list']) == 0
+
+        out, _ = capsys.readouterr()
+        assert out.splitlines() == [
+            '1 composite indexes for the stacks and cards of a game',
+            '2 version columns for optimistic concurrency',
+            '3 virtual shoes of stacks, and the effects of commands'] * 2
@@ -0,0 +1,159 @@
+import random
+
+import pytest
+
+from card_table import commands, packed
+from card_table.cards import (ACE, ACE_HIGH, CLUB, DECK_ACE_HIGH,
+                              DECK_ACE_LOW, JOKER, KING, SPADE, TWO)
+from card_table.packed import PackedStack
+from card_table.storage import Facing
+
+
+class TestCodec(object):
+
+    @pytest.mark.parametrize('face', DECK_ACE_LOW + DECK_ACE_HIGH)
+    def test_roundtrip(self, face):
+        code = packed.pack(face, deck=7, owner_facing=Facing.up,
+                           other_facing=Facing.peeking)
+
+        assert packed.unpack(code) == (face, 7, Facing.up, Facing.peeking)
+        assert 0 <= code < 1 << 16
+
+    def test_defaults(self):
+        code = packed.pack(DECK_ACE_LOW[0])
+
+        assert packed.unpack(code) == (DECK_ACE_LOW[0], 0, Facing.down,
+                                       Facing.down)
+
+    def test_ace_high(self):
+        low = packed.face_of(packed.pack(DECK_ACE_LOW[0]))
+        high = packed.face_of(packed.pack(DECK_ACE_HIGH[12]))
+
+        assert (low.rank, low.suit, low.rank_value) == (ACE, CLUB, 1)
+        assert (high.rank, high.suit, high.rank_value) == (ACE, CLUB, 14)
+
+    def test_joker(self):
+        assert packed.face_of(packed.pack(packed.JOKER)).rank == JOKER
+
+    def test_unknown_face(self):
+        with pytest.raises(ValueError):
+            packed.pack(DECK_ACE_LOW[0]._replace(rank_value=99))
+
+    def test_deck_out_of_range(self):
+        with pytest.raises(ValueError):
+            packed.pack(DECK_ACE_LOW[0], deck=packed.MAX_DECKS)
+
+    def test_every_deck(self):
+        last = commands.MAX_DECKS - 1
+        assert packed.MAX_DECKS == commands.MAX_DECKS <= 1 << packed.DECK_BITS
+
+        code = packed.pack(DECK_ACE_HIGH[51], deck=last,
+                           owner_facing=Facing.up)
+
+        assert packed.unpack(code) == (DECK_ACE_HIGH[51], last, Facing.up,
+                                       Facing.down)
+        assert PackedStack([code]).codes[0] == code
+
+    def test_turned(self):
+        code = packed.pack(DECK_ACE_LOW[5], deck=3)
+
+        code = packed.turned(code, owner_facing=Facing.up)
+        assert packed.unpack(code) == (DECK_ACE_LOW[5], 3, Facing.up,
+                                       Facing.down)
+
+        code = packed.turned(code, other_facing=Facing.revealed)
+        assert packed.unpack(code) == (DECK_ACE_LOW[5], 3, Facing.up,
+                                       Facing.revealed)
+
+
+class TestPackedStack(object):
+
+    def test_deck(self):
+        stack = PackedStack.deck(ACE_HIGH, decks=2)
+
+        assert len(stack) == 104
+        assert stack.faces() == list(DECK_ACE_HIGH * 2)
+        assert packed.unpack(stack[52]).deck == 1
+        assert stack.codes.itemsize == 4
+
+    def test_move(self):
+        stack = PackedStack.deck()
+        hand = PackedStack()
+
+        stack.move(hand, count=3, start=1)
+
+        assert hand.faces() == list(DECK_ACE_LOW[1:4])
+        assert len(stack) == 49
+        assert stack.faces()[:2] == [DECK_ACE_LOW[0], DECK_ACE_LOW[4]]
+
+    def test_move_to_position(self):
+        stack = PackedStack.deck()
+        pile = PackedStack([packed.pack(DECK_ACE_LOW[51])] * 2)
+
+        stack.move(pile, position=1)
+
+        assert pile.faces() == [DECK_ACE_LOW[51], DECK_ACE_LOW[0],
+                                DECK_ACE_LOW[51]]
+
+    def test_move_too_many(self):
+        with pytest.raises(IndexError):
+            PackedStack.deck().move(PackedStack(), count=53)
+
+    def test_shuffle(self):
+        stack = PackedStack.deck()
+        other = PackedStack.deck()
+
+        stack.shuffle(random.Random(1234))
+        other.shuffle(random.Random(1234))
+
+        assert stack == other
+        assert stack != PackedStack.deck()
+        assert sorted(stack) == sorted(PackedStack.deck())
+
+    def test_cut(self):
+        stack = PackedStack.deck()
+
+        stack.cut(10)
+
+        assert stack.faces()[0] == DECK_ACE_LOW[10]
+        assert stack.faces()[-1] == DECK_ACE_LOW[9]
+        assert len(stack) == 52
+
+    def test_deal(self):
+        stack = PackedStack.deck()
+        hands = [PackedStack(), PackedStack()]
+
+        stack.deal(hands, count=2)
+
+        assert hands[0].faces() == [DECK_ACE_LOW[2], DECK_ACE_LOW[0]]
+        assert hands[1].faces() == [DECK_ACE_LOW[3], DECK_ACE_LOW[1]]
+        assert len(stack) == 48
+
+    def test_deal_too_many(self):
+        stack = PackedStack.deck()
+
+        with pytest.raises(IndexError):
+            stack.deal([PackedStack()] * 4, count=14)
+        assert len(stack) == 52
+
+    def test_turn(self):
+        stack = PackedStack.deck()
+
+        stack.turn(0, owner_facing=Facing.up)
+
+        assert packed.unpack(stack[0]).owner_facing == Facing.up
+        assert packed.unpack(stack[1]).owner_facing == Facing.down
+
+    def test_bytes(self):
+        stack = PackedStack.deck()
+
+        data = stack.tobytes()
+
+        assert len(data) == 208
+        assert PackedStack.frombytes(data) == stack
+
+    def test_faces_by_rank(self):
+        faces = PackedStack.deck().faces()
+
+        assert (faces[0].rank, faces[12].rank) == (ACE, KING)
+        assert (faces[14].rank, faces[51].suit) == (TWO, SPADE)
@@ -0,0 +1,50 @@
+import pytest
+from tests.unit.card_table import window_functions
+
+from card_table import plans, storage
+
+
+@pytest.fixture()
+def report():
+    db_engine = storage.build_engine('sqlite:///:memory:')
+    storage.sync(db_engine)
+    return plans.report(db_engine)
+
+
+class TestPlans(object):
+
+    @window_functions
+    def test_every_hot_query(self, report):
+        assert list(report) == list(plans.HOT_QUERIES)
+
+    @window_functions
+    @pytest.mark.parametrize('name', list(plans.HOT_QUERIES))
+    def test_no_full_scans(self, report, name):
+        assert report[name]
+        assert plans.full_scans(report[name]) == []
+
+    @window_functions
+    def test_cards_of_stack_covered(self, report):
+        steps = report['cards of a stack by position']
+        assert all('ix_cards_stack_id_position' in step for step in steps)
+        assert not any('TEMP B-TREE' in step for step in steps)
+
+    def test_full_scans(self):
+        assert plans.full_scans([
+            'SCAN TABLE cards',
+            'SCAN cards',
+            'SCAN stacks USING INDEX ix_stacks_game_id_owner_id_label',
+            'SCAN (subquery-3)',
+            'SCAN ranked',
+            'SEARCH cards USING INDEX ix_cards_stack_id_position (stack_id=?)',
+        ]) == ['SCAN TABLE cards', 'SCAN cards']
+
+    @window_functions
+    def test_regression_found(self):
+        db_engine = storage.build_engine('sqlite:///:memory:')
+        storage.sync(db_engine)
+        db_engine.execute('DROP INDEX ix_cards_stack_id_position')
+
+        steps = plans.report(db_engine)['cards of a stack by position']
+
+        assert plans.full_scans(steps)
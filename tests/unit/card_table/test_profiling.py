@@ -0,0 +1,87 @@
+import falcon
+from mock import patch
+from tests.unit.card_table import FakeClient
+
+from card_table import api, profiling, server
+from card_table.commands import NOOP
+
+
+def client_for(engine, **settings):
+    middleware = profiling.ProfilingMiddleware(**settings).around(
+        server.middleware())
+    return FakeClient(api.create_api(middleware, engine))
+
+
+def metrics(resp):
+    return [metric.split(';')[0]
+            for metric in resp.headers['server-timing'].split(', ')]
+
+
+class TestProfilingMiddleware(object):
+
+    def test_server_timing(self, engine, with_fixtures):
+        client = client_for(engine)
+
+        resp = client.post('/commands', {'operation': NOOP, 'game_id': 1,
+                                         'actor_id': 600, 'changes': '{}'})
+
+        assert resp.status == falcon.HTTP_CREATED
+        assert metrics(resp) == ['parse', 'validate', 'execute', 'commit',
+                                 'serialize', 'db', 'total']
+        assert 'queries"' in resp.headers['server-timing']
+
+    def test_server_timing_get(self, engine, with_fixtures):
+        resp = client_for(engine).get('/games/1')
+
+        assert resp.status == falcon.HTTP_OK
+        assert metrics(resp) == ['parse', 'serialize', 'db', 'total']
+
+    def test_server_timing_error(self, engine, with_fixtures):
+        resp = client_for(engine).get('/games/80')
+
+        assert resp.status == falcon.HTTP_NOT_FOUND
+        assert 'total' in metrics(resp)
+
+    def test_server_timing_disabled(self, engine, with_fixtures):
+        resp = client_for(engine, server_timing=False).get('/games/1')
+
+        assert 'server-timing' not in resp.headers
+
+    @patch.object(profiling.LOG, 'warning')
+    def test_slow_request(self, warning, engine, with_fixtures):
+        client_for(engine, slow_ms=0).get('/games/1')
+
+        assert warning.call_args[0][1:4] == ('GET', '/games/1', '200 OK')
+
+    @patch.object(profiling.LOG, 'warning')
+    def test_fast_request(self, warning, engine, with_fixtures):
+        client_for(engine, slow_ms=60000).get('/games/1')
+
+        assert not warning.called
+
+    @patch.object(profiling.LOG, 'info')
+    def test_profile_sample(self, info, engine, with_fixtures):
+        client_for(engine, profile_sample=1.0, profile_limit=5).get(
+            '/games/1')
+
+        assert 'function calls' in info.call_args[0][3]
+
+    def test_phase_outside_request(self):
+        with profiling.phase('anything'):
+            assert profiling.current() is None
+
+
+class TestServerMiddleware(object):
+
+    def test_disabled(self):
+        assert len(server.middleware()) == 1
+
+    def test_enabled(self, monkeypatch):
+        monkeypatch.setenv('CARD_TABLE_PROFILING_ENABLED', 'true')
+        monkeypatch.setenv('CARD_TABLE_PROFILING_SLOW_MS', '250')
+
+        components = server.middleware()
+
+        assert len(components) == 3
+        assert isinstance(components[0], profiling.ProfilingMiddleware)
+        assert components[0].slow_ms == 250
@@ -0,0 +1,171 @@
+import datetime as dt
+
+import pytest
+from tests.unit.card_table import recorded_statements, window_functions
+from tests.unit.card_table.fixtures import run
+
+from card_table import queries
+from card_table.commands import MOVE_CARDS, NOOP
+from card_table.storage import Card, Facing, Game
+
+
+class TestGameState(object):
+
+    def test_state(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            state = queries.game_state(conn, 2)
+
+        assert state['name'] == 'starting'
+        assert [s['id'] for s in state['stacks']] == [8, 9]
+        assert [c['id'] for c in state['stacks'][0]['cards']] == [9]
+        assert state['stacks'][0]['cards'][0]['other_facing'] == 'down'
+
+    def test_state_missing(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            assert queries.game_state(conn, 80) is None
+
+    def test_query_count(self, engine, with_fixtures):
+        with engine.connect() as conn, \
+                recorded_statements(engine) as statements:
+            queries.game_state(conn, 4)
+
+        assert len(statements) == 2
+
+
+@window_functions
+class TestPlayerView(object):
+
+    def test_other_facing(self, engine, session, with_fixtures):
+        session.query(Card).filter(Card.id == 9).update(
+            {'other_facing': Facing.up})
+        session.commit()
+
+        with engine.connect() as conn:
+            view = queries.player_view(conn, 2, 800)
+
+        draw_pile, hand = view['stacks']
+        assert draw_pile['cards'][0]['rank'] == 'ace'
+        assert draw_pile['cards'][0]['id'] == 9
+        assert hand['cards'][0]['rank'] is None
+
+    def test_owner_facing_down(self, engine, session, with_fixtures):
+        session.query(Card).filter(Card.id == 3).update(
+            {'owner_facing': Facing.down})
+        session.commit()
+
+        with engine.connect() as conn:
+            view = queries.player_view(conn, 4, 100)
+
+        cards = view['stacks'][1]['cards']
+        assert cards[0]['id'] is None
+        assert cards[0]['position'] == 0
+        assert cards[0]['rank'] is None
+        assert cards[0]['rank_value'] is None
+        assert cards[1]['rank'] == 'ace'
+
+    def test_game_without_stacks(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            view = queries.player_view(conn, 3, 100)
+
+        assert view['name'] == 'cancelled'
+        assert view['stacks'] == []
+
+    def test_missing(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            assert queries.player_view(conn, 80, 100) is None
+
+
+class TestGameChanges(object):
+
+    def test_unchanged(self, engine, session, with_fixtures):
+        since = run(session, 2, NOOP, {}).id
+
+        with engine.connect() as conn:
+            changes = queries.game_changes(conn, 2, since)
+
+        assert changes == {'id': 2, 'since': since, 'command_id': since,
+                           'game': None, 'stacks': [], 'cards': []}
+
+    def test_changed(self, engine, session, with_fixtures):
+        since = run(session, 2, NOOP, {}).id
+        command = run(session, 2, MOVE_CARDS, {'cards': [{'id': 9,
+                                                          'position': 1}]})
+
+        with engine.connect() as conn:
+            changes = queries.game_changes(conn, 2, since)
+
+        assert changes['command_id'] == command.id
+        assert changes['game'] is None
+        assert [c['id'] for c in changes['cards']] == [9]
+        assert changes['cards'][0]['position'] == 1
+
+    def test_changed_by_since(self, engine, session, with_fixtures):
+        command = run(session, 2, MOVE_CARDS, {'cards': [{'id': 9,
+                                                          'position': 1}]})
+
+        with engine.connect() as conn:
+            changes = queries.game_changes(conn, 2, command.id)
+
+        assert changes['command_id'] == command.id
+        assert changes['cards'] == []
+
+    def test_game(self, engine, session, with_fixtures):
+        since = run(session, 2, NOOP, {}).id
+        Game.get(2, session).name = 'renamed'
+        session.commit()
+
+        with engine.connect() as conn:
+            changes = queries.game_changes(conn, 2, since)
+
+        assert changes['game']['name'] == 'renamed'
+        assert changes['game']['state'] == 'starting'
+        assert changes['stacks'] == []
+
+    def test_unknown_command(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            assert queries.game_changes(conn, 2, 80) is None
+            assert queries.game_changes(conn, 4, 1) is None
+
+    def test_too_far_behind(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            assert queries.game_changes(conn, 2, 1, max_commands=1) is None
+            assert queries.game_changes(conn, 2, 2, max_commands=1)
+
+    def test_latest_command_id(self, engine, with_fixtures):
+        with engine.connect() as conn:
+            assert queries.latest_command_id(conn, 2) == 3
+            assert queries.latest_command_id(conn, 4) == 0
+
+
+class TestSerialize(object):
+
+    def test_serialize(self, engine, with_fixtures):
+        games = Game.__table__
+        with engine.connect() as conn:
+            row = conn.execute(games.select().where(games.c.id == 5)).first()
+
+        thing = queries.serialize(Game, games, row)
+
+        assert thing['name'] == 'paused'
+        assert thing['state'] == 'paused'
+        assert thing['created_at'].endswith('Z')
+
+
+class TestCursor(object):
+
+    def test_roundtrip(self):
+        updated_at = dt.datetime(2017, 5, 4, 3, 2, 1, 123456)
+        cursor = queries.encode_cursor(updated_at, 42)
+
+        assert queries.decode_cursor(cursor) == (updated_at, 42)
+
+    def test_roundtrip_whole_seconds(self):
+        updated_at = dt.datetime(2017, 5, 4, 3, 2, 1)
+        cursor = queries.encode_cursor(updated_at, 7)
+
+        assert queries.decode_cursor(cursor) == (updated_at, 7)
+
+    @pytest.mark.parametrize('cursor', ['bogus', 'W10=', 'WzEsIDJd'])
+    def test_invalid(self, cursor):
+        with pytest.raises(ValueError):
+            queries.decode_cursor(cursor)
@@ -0,0 +1,165 @@
+import pytest
+from mock import patch
+from tests.unit.card_table.fixtures import run
+
+from card_table.commands import register, register_fold
+from card_table.replay import state_as_of, TableState, take_snapshot_if_due
+from card_table.schema import integer
+from card_table.storage import Card, Command, Snapshot
+
+
+@pytest.fixture()
+def played(session, with_fixtures):
+    """ A game 1 played on stack 10, with a virtual shoe on stack 9 """
+    return [
+        run(session, 1, 'create deck', {'stack_id': 10, 'ace': 'high'}),
+        run(session, 1, 'shuffle stack', {'stack_id': 10}),
+        run(session, 1, 'create deck', {'stack_id': 9, 'virtual': True,
+                                        'decks': 2}),
+        run(session, 1, 'move cards', {'cards': [
+            {'id': 11, 'stack_id': 1, 'position': 2,
+             'owner_facing': 'up'},
+            {'draw_from': 9, 'stack_id': 1, 'position': 3},
+            {'draw_from': 9, 'stack_id': 1, 'position': 4,
+             'other_facing': 'peeking'}]}),
+        run(session, 1, 'noop', {})]
+
+
+def assert_matches_db(session, state):
+    for card_id, card in state.cards.items():
+        record = Card.get(card_id, session)
+        for key, value in card.items():
+            stored = getattr(record, key)
+            assert getattr(stored, 'name', stored) == value, (card_id, key)
+
+
+class TestStateAsOf(object):
+
+    def test_replay(self, session, played):
+        state = state_as_of(session, 1)
+
+        assert state.command_id == played[-1].id
+        assert len(state.cards) == 54
+        assert state.shoes[9]['cursor'] == 2
+        assert state.shoes[9]['size'] == 104
+        assert_matches_db(session, state)
+
+    def test_replay_as_of(self, session, played):
+        state = state_as_of(session, 1, command_id=played[0].id)
+
+        assert state.command_id == played[0].id
+        assert len(state.cards) == 52
+        assert sorted(c['position'] for c in state.cards.values()) == \
+            list(range(52))
+        assert state.shoes == {}
+
+    def test_replay_other_game(self, session, played):
+        assert state_as_of(session, 3).command_id is None
+
+    def test_writes_nothing(self, session, played):
+        state_as_of(session, 1)
+
+        assert not session.new
+
+    def test_snapshot_due(self, session, played):
+        assert take_snapshot_if_due(session, 1, interval=6) is None
+        snapshot = take_snapshot_if_due(session, 1, interval=5)
+        session.commit()
+
+        assert session.query(Snapshot).one() is snapshot
+        assert snapshot.command_id == played[-1].id
+        assert take_snapshot_if_due(session, 1, interval=1) is None
+        run(session, 1, 'noop', {})
+        assert take_snapshot_if_due(session, 1, interval=2) is None
+        assert take_snapshot_if_due(session, 1, interval=1) is not None
+
+    def test_resume_from_snapshot(self, session, played):
+        take_snapshot_if_due(session, 1, interval=4)
+        session.commit()
+        # tamper with the folded commands, they should not be replayed
+        session.query(Command).filter(Command.id <= played[-1].id).update(
+            {'changes': '{invalid json'}, synchronize_session=False)
+        session.commit()
+
+        state = state_as_of(session, 1)
+
+        assert state.command_id == played[-1].id
+        assert_matches_db(session, state)
+
+    def test_unknown_operation(self, session, with_fixtures):
+        command = Command(id=1, operation='invalid', changes={})
+
+        with pytest.raises(ValueError):
+            TableState().apply(command)
+
+    def test_changes_not_object(self, session, with_fixtures):
+        command = Command(id=1, operation='noop', changes='hello')
+
+        with pytest.raises(ValueError):
+            TableState().apply(command)
+
+    def test_changes_invalid(self, session, with_fixtures):
+        command = Command(id=1, operation='create deck', changes={})
+
+        with pytest.raises(ValueError):
+            TableState().apply(command)
+
+    def test_without_effects(self, session, with_fixtures):
+        # as recorded before the effects of commands were
+        command = Command(id=1, operation='create deck',
+                          changes={'stack_id': 10})
+
+        with pytest.raises(ValueError):
+            TableState().apply(command)
+
+    def test_draw_from_unknown_shoe(self, session, with_fixtures):
+        command = Command(id=1, operation='move cards',
+                          changes={'cards': [{'draw_from': 99,
+                                              'stack_id': 10}]},
+                          effects={'drawn_ids': [40]})
+
+        with pytest.raises(ValueError):
+            TableState().apply(command)
+
+    @patch.dict('card_table.commands.REGISTRY')
+    def test_registered_operation(self, session, with_fixtures):
+        @register('flip', card_id=integer(required=True))
+        def flip(db_session, **kwargs):
+            pass
+        command = Command(id=1, operation='flip', changes={'card_id': 3})
+
+        with pytest.raises(ValueError):
+            TableState().apply(command)
+
+        @register_fold('flip')
+        def fold(state, changes, effects):
+            card = state.cards.setdefault(changes['card_id'], {})
+            card['owner_facing'] = 'up'
+        state = TableState()
+        state.apply(command)
+
+        assert state.command_id == 1
+        assert state.cards == {3: {'owner_facing': 'up'}}
+
+    def test_fold_unregistered(self):
+        with pytest.raises(ValueError):
+            register_fold('invalid')
+
+
+class TestTableState(object):
+
+    def test_dumps_loads(self, session, played):
+        state = state_as_of(session, 1)
+
+        loaded = TableState.loads(state.dumps())
+
+        assert loaded.command_id == state.command_id
+        assert loaded.cards == state.cards
+        assert loaded.shoes == state.shoes
+
+    def test_as_dict_hides_seeds(self, session, played):
+        result = state_as_of(session, 1).as_dict()
+
+        assert result['shoes'][0]['stack_id'] == 9
+        assert 'seed' not in result['shoes'][0]
+        assert result['cards'][0]['id'] == 11
@@ -0,0 +1,49 @@
+import pytest
+from falcon import HTTPBadRequest
+
+from card_table.schema import boolean, choice, compile_schema, integer, objects
+
+VALIDATE = compile_schema({'stack_id': integer(required=True, minimum=1),
+                           'decks': integer(default=1, maximum=8),
+                           'ace': choice(['high', 'low'], default='low'),
+                           'virtual': boolean(),
+                           'cards': objects()})
+
+
+class TestCompileSchema(object):
+
+    def test_defaults(self):
+        assert VALIDATE({'stack_id': 3}) == {'stack_id': 3, 'decks': 1,
+                                             'ace': 'low'}
+
+    def test_given(self):
+        changes = {'stack_id': 3, 'decks': 2, 'ace': 'high', 'virtual': True,
+                   'cards': [{'id': 1}], 'other': 'passed through'}
+
+        assert VALIDATE(changes) == changes
+
+    def test_no_defaults(self):
+        changes = {'foo': 'bar'}
+
+        assert compile_schema({})(changes) is changes
+
+    def test_missing(self):
+        with pytest.raises(HTTPBadRequest) as error:
+            VALIDATE({'decks': 2})
+
+        assert 'stack_id' in error.value.description
+
+    @pytest.mark.parametrize('changes', [
+        {'stack_id': 0},
+        {'stack_id': '3'},
+        {'stack_id': True},
+        {'stack_id': 3, 'decks': 9},
+        {'stack_id': 3, 'decks': 1.5},
+        {'stack_id': 3, 'ace': 'middle'},
+        {'stack_id': 3, 'virtual': 'yes'},
+        {'stack_id': 3, 'cards': []},
+        {'stack_id': 3, 'cards': [1, 2]},
+        {'stack_id': 3, 'cards': {'id': 1}}])
+    def test_invalid(self, changes):
+        with pytest.raises(HTTPBadRequest):
+            VALIDATE(changes)
@@ -0,0 +1,177 @@
+import pytest
+from sqlalchemy import or_
+from sqlalchemy.orm import Query, Session
+from sqlalchemy.schema import CreateTable
+
+from card_table import migrations, shards, storage
+from card_table.shards import BLOCK
+from card_table.storage import Card, Game
+
+
+def shard_engine():
+    db_engine = storage.build_engine('sqlite:///:memory:')
+    migrations.migrate(db_engine)
+    return db_engine
+
+
+@pytest.fixture()
+def router(engine):
+    db_router = shards.ShardRouter([engine, shard_engine()])
+    db_router.prepare()
+    return db_router
+
+
+class TestShardRouter(object):
+
+    def test_no_engines(self):
+        with pytest.raises(ValueError):
+            shards.ShardRouter([])
+
+    def test_shard_of(self, router):
+        assert router.shard_of(1) == 0
+        assert router.shard_of(BLOCK) == 0
+        assert router.shard_of(BLOCK + 1) == 1
+        assert router.shard_of(str(BLOCK + 1)) == 1
+        assert router.shard_of(2 * BLOCK + 1) is None
+        assert router.shard_of(0) is None
+        assert router.shard_of('x') is None
+        assert router.shard_of(None) is None
+
+    def test_engine_for(self, router, engine):
+        assert router.engine_for(BLOCK + 1) is router.engines[1]
+        assert router.engine_for(1) is engine
+        assert router.engine_for('x') is engine
+
+    def test_reader_for(self, engine):
+        readers = [shard_engine(), shard_engine()]
+        router = shards.ShardRouter([engine, shard_engine()], readers)
+
+        assert router.reader_for(1) is readers[0]
+        assert router.reader_for(BLOCK + 1) is readers[1]
+        assert router.readers == readers
+
+    def test_reader_per_shard(self, engine):
+        with pytest.raises(ValueError):
+            shards.ShardRouter([engine, shard_engine()], [engine])
+
+    def test_deal(self, router):
+        assert [router.deal() for _ in range(3)] == [0, 1, 0]
+
+    def test_shards_for_query_by_key(self, router):
+        query = Query(Card).filter(Card.stack_id == BLOCK + 1)
+        assert router.shards_for_query(query) == [1]
+
+    def test_shards_for_query_by_keys(self, router):
+        query = Query(Card).filter(Card.id.in_([1, BLOCK + 2]))
+        assert router.shards_for_query(query) == [0, 1]
+
+    def test_shards_for_query_by_both(self, router):
+        query = Query(Card).filter(Card.id == 1).filter(
+            Card.stack_id == BLOCK + 1)
+        assert router.shards_for_query(query) == []
+
+    def test_shards_for_query_unkeyed(self, router):
+        assert router.shards_for_query(Query(Card)) == [0, 1]
+        query = Query(Card).filter(Card.position == 1)
+        assert router.shards_for_query(query) == [0, 1]
+        query = Query(Card).filter(or_(Card.id == 1, Card.position == 1))
+        assert router.shards_for_query(query) == [0, 1]
+
+    def test_shards_for_query_pinned(self, router):
+        db_session = router.sessionmaker()()
+        router.pin(db_session, 1)
+
+        assert router.shards_for_query(db_session.query(Card)) == [1]
+
+    def test_single_engine(self, engine):
+        router = shards.ShardRouter([engine])
+        router.prepare()
+
+        assert not router.sharded
+        db_session = router.sessionmaker()()
+        assert isinstance(db_session, Session)
+        assert not isinstance(db_session, shards.ShardSession)
+        assert router.shard_of(BLOCK + 1) is None
+
+
+class TestShardSession(object):
+
+    def test_records_follow_their_game(self, router):
+        db_session = router.sessionmaker()()
+        first, second = Game(name='first'), Game(name='second')
+        db_session.add(first)
+        db_session.commit()
+        first_id = first.id
+        db_session.close()
+
+        db_session = router.sessionmaker()()
+        db_session.add(second)
+        db_session.commit()
+        stack = storage.Stack(game_id=second.id, label='deck')
+        db_session.add(stack)
+        db_session.commit()
+
+        assert first_id == 1
+        assert second.id == BLOCK + 1
+        assert stack.id == BLOCK + 1
+        assert db_session.query(Game).count() == 2
+        assert db_session.query(storage.Stack).get(BLOCK + 1) is stack
+
+    def test_order_and_limit_across_shards(self, router):
+        for name in ['a', 'b', 'c', 'd']:
+            db_session = router.sessionmaker()()
+            db_session.add(Game(name=name))
+            db_session.commit()
+            db_session.close()
+
+        db_session = router.sessionmaker()()
+        games = db_session.query(Game)
+
+        assert [g.name for g in games] == ['a', 'c', 'b', 'd']
+        assert [g.name for g in games.order_by(Game.id.desc()).limit(3)] == [
+            'd', 'b', 'c']
+        assert [g.name for g in games.order_by(Game.name).offset(1)] == [
+            'b', 'c', 'd']
+
+    def test_unrouted_statement(self, router):
+        db_session = router.sessionmaker()()
+
+        with pytest.raises(ValueError):
+            db_session.execute(Card.__table__.select())
+
+
+class TestSeedIds(object):
+
+    def test_seeded(self, router):
+        with router.engines[1].connect() as conn:
+            conn.execute(Game.__table__.insert(), name='seeded')
+            game_id = conn.execute(Game.__table__.select()).first().id
+
+        router.prepare()
+
+        assert game_id == BLOCK + 1
+
+    def test_not_autoincrement(self):
+        with pytest.raises(ValueError):
+            shards.seed_ids(storage.build_engine('sqlite:///:memory:'), 1)
+
+    def test_unsharded_database_first(self):
+        # as created before shards, without AUTOINCREMENT
+        old = storage.build_engine('sqlite:///:memory:')
+        for table in storage.Base.metadata.sorted_tables:
+            ddl = str(CreateTable(table).compile(old))
+            old.execute(ddl.replace(' AUTOINCREMENT', ''))
+        migrations.migrate(old)
+        old.execute(Game.__table__.insert(), name='before')
+        router = shards.ShardRouter([old, shard_engine()])
+
+        router.prepare()
+
+        for name in ['first', 'second']:
+            db_session = router.sessionmaker()()
+            db_session.add(Game(name=name))
+            db_session.commit()
+            db_session.close()
+        db_session = router.sessionmaker()()
+        assert sorted((g.id, g.name) for g in db_session.query(Game)) == [
+            (1, 'before'), (2, 'first'), (BLOCK + 1, 'second')]
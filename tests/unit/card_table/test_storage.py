@@ -1,6 +1,10 @@
+import pytest
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
 from card_table import IN_PLAY
 from card_table.cards import DIAMOND, EIGHT
-from card_table.storage import Card, Stack, Game
+from card_table.storage import build_engine, sync, Card, Command, Stack, Game
 
 
 class TestCard(object):
@@ -19,6 +23,45 @@ class TestCard(object):
         assert len(Card.find_by_stack(80, session)) == 0
 
 
+class TestCommand(object):
+
+    def test_changes_decoded(self, session, with_fixtures):
+        command = session.query(Command).get(3)
+
+        assert command.changes == {}
+
+    def test_changes_stored_compactly(self, engine, session):
+        session.add(Command(operation='noop', changes={'a': [1, 2]}))
+        session.commit()
+
+        text = engine.execute('SELECT changes FROM commands').scalar()
+        assert text == '{"a":[1,2]}'
+
+    def test_changes_string_encoded(self, engine, session):
+        session.add(Command(operation='noop', changes='hello'))
+        session.commit()
+
+        text = engine.execute('SELECT changes FROM commands').scalar()
+        assert text == '"hello"'
+        assert session.query(Command).get(1).changes == 'hello'
+
+    def test_serialize_hides_effects(self):
+        item = {'changes': {'a': 1}, 'effects': {'card_ids': [1]}}
+
+        Command.serialize_specials(item)
+
+        assert item == {'changes': {'a': 1}}
+
+    def test_serialize_hides_seeds(self):
+        changes = {'stack_id': 1, 'seed': 42}
+        item = {'changes': changes}
+
+        Command.serialize_specials(item)
+
+        assert item == {'changes': {'stack_id': 1}}
+        assert changes['seed'] == 42
+
+
 class TestStack(object):
 
     def test_get(self, session, with_fixtures):
@@ -27,6 +70,31 @@ class TestStack(object):
     def test_get_missing(self, session):
         assert Stack.get(80, session) is None
 
+    def test_visible_size(self):
+        assert Stack.visible_size(10, None) == 10
+        assert Stack.visible_size(10, 0) == 0
+        assert Stack.visible_size(10, 2) == 2
+        assert Stack.visible_size(1, 2) == 1
+
+    def test_serialize_shoe(self):
+        thing = {'shoe_template': 'ace low', 'shoe_size': 52,
+                 'shoe_seed': 42, 'shoe_cursor': 2, 'size_visibility': None}
+
+        Stack.serialize_specials(thing)
+
+        assert 'shoe_seed' not in thing
+        assert 'shoe_cursor' not in thing
+        assert thing['shoe_remaining'] == 50
+
+    def test_serialize_shoe_size_visibility(self):
+        thing = {'shoe_template': 'ace low', 'shoe_size': 52,
+                 'shoe_seed': 42, 'shoe_cursor': 2, 'size_visibility': 1}
+
+        Stack.serialize_specials(thing)
+
+        assert 'shoe_size' not in thing
+        assert thing['shoe_remaining'] == 1
+
 
 class TestGame(object):
 
@@ -35,3 +103,67 @@ class TestGame(object):
 
     def test_get_missing(self, session):
         assert Game.get(80, session) is None
+
+
+class TestBuildEngine(object):
+
+    def test_memory(self):
+        db_engine = build_engine('sqlite:///:memory:')
+
+        assert not isinstance(db_engine.pool, QueuePool)
+
+    def test_shared_cache(self):
+        db_engine = build_engine('sqlite:///:memory:', shared_cache=True)
+        sync(db_engine)
+
+        with db_engine.connect() as first, db_engine.connect() as second:
+            first.execute(Game.__table__.insert(), name='shared')
+            names = [r.name for r in second.execute(
+                Game.__table__.select())]
+        assert names == ['shared']
+
+    def test_shared_cache_per_engine(self):
+        db_engine = build_engine('sqlite:///:memory:', shared_cache=True)
+        sync(db_engine)
+        other = build_engine('sqlite:///:memory:', shared_cache=True)
+
+        assert not other.has_table(Game.__tablename__)
+
+    def test_file(self, tmpdir):
+        url = 'sqlite:///' + str(tmpdir.join('cards.db'))
+        db_engine = build_engine(url, pool_size=3, mmap_size=1048576,
+                                 synchronous='OFF')
+
+        assert isinstance(db_engine.pool, QueuePool)
+        assert db_engine.pool.size() == 3
+        with db_engine.connect() as conn:
+            assert conn.scalar('PRAGMA journal_mode') == 'wal'
+            assert conn.scalar('PRAGMA synchronous') == 0
+            assert conn.scalar('PRAGMA mmap_size') == 1048576
+
+    def test_file_shared_between_engines(self, tmpdir):
+        url = 'sqlite:///' + str(tmpdir.join('cards.db'))
+        writer = build_engine(url)
+        sync(writer)
+        writer.execute(Game.__table__.insert(), name='persisted')
+
+        reader = build_engine(url)
+        names = [r.name for r in reader.execute(Game.__table__.select())]
+        assert names == ['persisted']
+
+    def test_file_read_only(self, tmpdir):
+        url = 'sqlite:///' + str(tmpdir.join('cards.db'))
+        writer = build_engine(url)
+        sync(writer)
+        writer.execute(Game.__table__.insert(), name='persisted')
+
+        reader = build_engine(url, read_only=True)
+        names = [r.name for r in reader.execute(Game.__table__.select())]
+        assert names == ['persisted']
+        assert reader.scalar('PRAGMA journal_mode') == 'wal'
+        with pytest.raises(exc.OperationalError):
+            reader.execute(Game.__table__.insert(), name='refused')
+
+    def test_memory_read_only(self):
+        with pytest.raises(ValueError):
+            build_engine('sqlite:///:memory:', read_only=True)